@@ -0,0 +1,167 @@
+import os
+import json
+import threading
+from typing import *
+from workbook import Workbook, Spreadsheet
+
+DEFAULT_AUTOSAVE_INTERVAL = 60.0
+
+
+class AutoSaver:
+    """
+    Periodically saves a workbook to a JSON file on a background thread.
+    The workbook is only locked while a snapshot of its dirty sheets is taken,
+    so the user can keep working while the snapshot is being written to disk.
+    """
+
+    def __init__(self, workbook: Workbook, filename: Optional[str] = None,
+                 interval: float = DEFAULT_AUTOSAVE_INTERVAL) -> None:
+        """
+        Initializes a new AutoSaver for the given workbook. The saver does not run until start() is called.
+
+        :param workbook: The workbook to save.
+        :param filename: The name of the file to save to, without the .json extension.
+        If not provided, the name of the workbook is used, like the 'save' command does.
+        :param interval: The number of seconds between two saves.
+        """
+        self.workbook = workbook
+        self.filename = filename
+        self.interval = interval
+        # The last snapshot of every sheet: (the sheet object, its version, the snapshot)
+        self._sheet_snapshots: Dict[str, Tuple[Spreadsheet, int, Spreadsheet]] = {}
+        self._workbook_version: Optional[int] = None
+        # Snapshots are numbered, so an old snapshot never overwrites a newer one on disk
+        self._snapshot_count = 0
+        self._written_count = 0
+        self._io_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def target_path(self) -> Optional[str]:
+        """
+        Retrieves the path of the file the workbook is saved to.
+
+        :return: The path of the JSON file, or None if neither a filename nor a workbook name was given.
+        """
+        name = self.filename if self.filename is not None else self.workbook.name
+        if not name:
+            return None
+        return name + ".json"
+
+    def is_running(self) -> bool:
+        """
+        Checks whether the background saving thread is running.
+
+        :return: True if the thread is running, False otherwise.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Starts the background thread that saves the workbook every 'interval' seconds.
+        Does nothing if the thread is already running.
+        """
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background thread, waiting for a save that is in progress to finish.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """
+        The body of the background thread: saves the workbook until stop() is called.
+        """
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.save_now()
+            except Exception as err:
+                print(f"Autosave failed: {str(err)}")
+
+    def take_snapshot(self, force: bool = False) -> Optional[Tuple[int, Workbook]]:
+        """
+        Takes a snapshot of the workbook while it is locked.
+        Only sheets that changed since the previous snapshot are copied,
+        the snapshots of the other sheets are reused.
+
+        :param force: If True, a snapshot is returned even if nothing changed.
+        :return: A tuple of the snapshot's number and the snapshot itself,
+        or None if nothing changed since the previous snapshot.
+        """
+        with self.workbook.lock:
+            changed = force or self.workbook.version != self._workbook_version
+            sheet_snapshots = {}
+            for sheet_name, sheet in self.workbook.sheets.items():
+                previous = self._sheet_snapshots.get(sheet_name)
+                if previous is not None and previous[0] is sheet and previous[1] == sheet.version:
+                    sheet_snapshots[sheet_name] = previous
+                else:
+                    with sheet.lock:
+                        sheet_snapshots[sheet_name] = (sheet, sheet.version, sheet.snapshot())
+                    changed = True
+            if not changed:
+                return None
+            self._sheet_snapshots = sheet_snapshots
+            self._workbook_version = self.workbook.version
+            self._snapshot_count += 1
+            number = self._snapshot_count
+
+        snapshot = Workbook(self.workbook.name)
+        snapshot.sheets = {sheet_name: entry[2] for sheet_name, entry in sheet_snapshots.items()}
+        for sheet in snapshot.sheets.values():
+            # Formulas of the snapshot that refer to other sheets read the snapshots of those sheets
+            sheet.workbook = snapshot
+        return number, snapshot
+
+    def write_snapshot(self, number: int, snapshot: Workbook, path: str) -> bool:
+        """
+        Writes a snapshot to the given path.
+        The file is written under a temporary name first and then replaced,
+        so a crash in the middle of a save never leaves a half written workbook behind.
+
+        :param number: The number of the snapshot, as returned by take_snapshot().
+        :param snapshot: The snapshot to write.
+        :param path: The path of the JSON file.
+        :return: True if the snapshot was written, False if a newer snapshot was already written.
+        """
+        with self._io_lock:
+            if number <= self._written_count:
+                return False
+            workbook_dict = snapshot.to_json_dict()
+            temp_path = path + ".tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(workbook_dict, f)
+            os.replace(temp_path, path)
+            self._written_count = number
+        return True
+
+    def save_now(self, force: bool = False) -> bool:
+        """
+        Saves the workbook immediately if something changed since the previous save.
+        This is what the background thread calls every 'interval' seconds,
+        and it can be called directly for an explicit save.
+
+        :param force: If True, the workbook is written even if nothing changed.
+        :return: True if the workbook was written, False otherwise.
+        """
+        path = self.target_path()
+        if path is None:
+            return False
+        taken = self.take_snapshot(force)
+        if taken is None:
+            return False
+        number, snapshot = taken
+        try:
+            return self.write_snapshot(number, snapshot, path)
+        except Exception:
+            # Make sure the next save retries instead of assuming the workbook is saved
+            self._workbook_version = None
+            raise
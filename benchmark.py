@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import tempfile
+from typing import *
+from workbook import *
+
+# Every benchmark is registered here by name, so it can be chosen from the command line
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(func: Callable[[], None]) -> Callable[[], None]:
+    """
+    Registers a function as a benchmark under its own name.
+
+    :param func: The benchmark function.
+    :return: The same function.
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def best_time(func: Callable[[], Any], repeat: int = 3) -> float:
+    """
+    Runs a function a few times and measures the fastest run.
+
+    :param func: The function to measure.
+    :param repeat: The number of runs.
+    :return: The time of the fastest run, in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def legacy_workbook_dict(workbook: Workbook) -> Dict[str, Dict[str, Any]]:
+    """
+    Converts a workbook to the dictionary that format version 1 files contain,
+    with the dependents of every cell and without a format version.
+
+    :param workbook: The workbook to convert.
+    :return: The version 1 dictionary representation of the workbook.
+    """
+    return {
+        sheet_name: {
+            cell_name: {'value': cell.value, 'formula': cell.formula, 'dependents': list(cell.dependents)}
+            for cell_name, cell in sheet.cells.items()
+        }
+        for sheet_name, sheet in workbook.sheets.items()
+    }
+
+
+def range_formula_workbook(rows: int) -> Workbook:
+    """
+    Builds a workbook with a column of numbers and a few formulas over the whole column.
+
+    :param rows: The number of rows in the column.
+    :return: The new workbook.
+    """
+    workbook = Workbook("benchmark")
+    spreadsheet = Spreadsheet("Sheet1")
+    workbook.sheets["Sheet1"] = spreadsheet
+    for row in range(1, rows + 1):
+        spreadsheet.set_cell(f"A{row}", row)
+    spreadsheet.set_cell("B1", formula=f"SUM(A1:A{rows})")
+    spreadsheet.set_cell("B2", formula=f"AVERAGE(A1:A{rows})")
+    spreadsheet.set_cell("B3", formula=f"MAX(A1:A{rows})")
+    return workbook
+
+
+@benchmark
+def file_format(rows: int = 100000) -> None:
+    """
+    Compares the size and the load time of format version 1 and format version 2 files
+    of a workbook with range formulas over a long column.
+
+    :param rows: The number of rows in the column.
+    """
+    workbook = range_formula_workbook(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_path = os.path.join(directory, "legacy.json")
+        with open(legacy_path, 'w') as f:
+            json.dump(legacy_workbook_dict(workbook), f)
+        workbook.export_to_json(os.path.join(directory, "current"))
+        current_path = os.path.join(directory, "current.json")
+
+        print(f"file format, {rows} rows and 3 range formulas")
+        print(f"{'format':<10}{'size (bytes)':>15}{'load (s)':>12}")
+        for label, path in [("1", legacy_path), (str(FORMAT_VERSION), current_path)]:
+            load_time = best_time(lambda: load_and_open_workbook(path))
+            print(f"{label:<10}{os.path.getsize(path):>15}{load_time:>12.3f}")
+
+
+@benchmark
+def render(rows: int = 100, cols: int = 100) -> None:
+    """
+    Measures how long it takes to render a fully visible sheet of numbers, text and formulas.
+
+    :param rows: The number of rows of the sheet.
+    :param cols: The number of columns of the sheet.
+    """
+    spreadsheet = grid_spreadsheet(rows, cols)
+    last_cell = f"{spreadsheet.col_index_to_letter(cols - 1)}{rows}"
+    plain_time = best_time(lambda: spreadsheet.render("A1", last_cell))
+    formatted_time = best_time(lambda: spreadsheet.render("A1", last_cell, number_format=",.2f", align_numbers=True))
+    print(f"render, {rows * cols} visible cells")
+    print(f"{'plain (ms)':>15}{'formatted (ms)':>18}")
+    print(f"{plain_time * 1000:>15.1f}{formatted_time * 1000:>18.1f}")
+
+
+@benchmark
+def bulk_update(rows: int = 100000) -> None:
+    """
+    Compares filling a column of formulas and then the column of numbers they depend on,
+    cell by cell and with set_many.
+
+    :param rows: The number of rows in the columns.
+    """
+    def one_by_one() -> None:
+        spreadsheet = Spreadsheet("Bulk")
+        for row in range(1, rows + 1):
+            spreadsheet.set_cell(f"B{row}", formula=f"A{row}*2")
+        for row in range(1, rows + 1):
+            spreadsheet.set_cell(f"A{row}", row)
+        spreadsheet.recalculate()
+
+    def in_batch() -> None:
+        spreadsheet = Spreadsheet("Bulk")
+        spreadsheet.set_many([(f"B{row}", None, f"A{row}*2") for row in range(1, rows + 1)] +
+                             [(f"A{row}", row, None) for row in range(1, rows + 1)])
+
+    print(f"bulk update, {rows} formulas and {rows} values")
+    print(f"{'set_cell (s)':>15}{'set_many (s)':>15}")
+    print(f"{best_time(one_by_one, 1):>15.3f}{best_time(in_batch, 1):>15.3f}")
+
+
+@benchmark
+def formula_backends(formulas: int = 100000, repeat: int = 3) -> None:
+    """
+    Compares the recalculations per second of the interpreted and the compiled formula backends
+    on a sheet of chained formulas, like a simulation that recalculates the whole sheet again and again.
+
+    :param formulas: The number of formulas in the sheet.
+    :param repeat: The number of recalculations to measure for each backend.
+    """
+    print(f"formula backends, {formulas} formulas")
+    print(f"{'backend':<15}{'recalc (s)':>12}{'recalcs/s':>12}")
+    for backend in FORMULA_BACKENDS:
+        spreadsheet = formula_chain_spreadsheet(formulas, backend)
+        formula_cells = {f"B{row}" for row in range(1, formulas + 1)}
+        recalc_time = best_time(lambda: spreadsheet.recalculate_cells(formula_cells), repeat)
+        print(f"{backend:<15}{recalc_time:>12.3f}{1 / recalc_time:>12.2f}")
+
+
+@benchmark
+def copied_down(rows: int = 100000) -> None:
+    """
+    Compares recalculating columns of copied-down formulas cell by cell and as array operations.
+
+    :param rows: The number of rows of the columns.
+    """
+    spreadsheet = Spreadsheet("Columns")
+    items = [(f"A{row}", row + 0.25, None) for row in range(1, rows + 1)]
+    items.extend((f"B{row}", row % 13 + 1.5, None) for row in range(1, rows + 1))
+    items.extend((f"C{row}", None, f"A{row}*B{row}+A{row}/2") for row in range(1, rows + 1))
+    items.extend((f"D{row}", None, f"SQRT(C{row})-B{row}") for row in range(1, rows + 1))
+    spreadsheet.set_many(items)
+    formula_cells = {f"{col}{row}" for col in "CD" for row in range(1, rows + 1)}
+
+    print(f"copied-down formulas, {len(formula_cells)} formulas in 2 columns")
+    print(f"{'cell by cell (s)':>18}{'vectorized (s)':>16}")
+    spreadsheet.vectorize_formulas = False
+    scalar_time = best_time(lambda: spreadsheet.recalculate_cells(formula_cells))
+    spreadsheet.vectorize_formulas = True
+    vectorized_time = best_time(lambda: spreadsheet.recalculate_cells(formula_cells))
+    print(f"{scalar_time:>18.3f}{vectorized_time:>16.3f}")
+
+
+@benchmark
+def range_aggregates(rows: int = 100000, formulas: int = 1000) -> None:
+    """
+    Compares cumulative totals and rolling windows over a long column,
+    with the ranges scanned cell by cell and answered from the range indexes.
+    Then a few values are changed and the formulas are recalculated after each change.
+
+    :param rows: The number of rows in the column.
+    :param formulas: The number of formulas of each kind.
+    """
+    step = rows // formulas
+    print(f"range aggregates, {rows} rows, {formulas} cumulative SUMs and {formulas} rolling MAX/AVERAGE windows")
+    print(f"{'ranges':<10}{'recalc (s)':>12}{'10 updates (s)':>16}")
+    for index_ranges in [False, True]:
+        spreadsheet = Spreadsheet("Ranges")
+        spreadsheet.index_ranges = index_ranges
+        items = [(f"A{row}", (row * 7919) % 1000 + 0.5, None) for row in range(1, rows + 1)]
+        for number in range(1, formulas + 1):
+            last = number * step
+            first = max(1, last - step * 10 + 1)
+            items.append((f"B{number}", None, f"SUM(A1:A{last})"))
+            items.append((f"C{number}", None, f"MAX(A{first}:A{last})-AVERAGE(A{first}:A{last})"))
+        spreadsheet.set_many(items)
+        formula_cells = {f"{col}{number}" for col in "BC" for number in range(1, formulas + 1)}
+        recalc_time = best_time(lambda: spreadsheet.recalculate_cells(formula_cells), 1)
+
+        def updates() -> None:
+            for number in range(10):
+                spreadsheet.set_cell(f"A{rows - number * step}", number + 0.25)
+                spreadsheet.recalculate()
+        label = "indexed" if index_ranges else "scanned"
+        print(f"{label:<10}{recalc_time:>12.3f}{best_time(updates, 1):>16.3f}")
+
+
+@benchmark
+def shared_ranges(rows: int = 5000, formulas: int = 1000) -> None:
+    """
+    Compares recalculating many formulas over the same range with and without the range cache,
+    with the ranges scanned and answered from the range indexes.
+
+    :param rows: The number of rows in the range.
+    :param formulas: The number of formulas.
+    """
+    print(f"shared ranges, {formulas} formulas over the same {rows} rows")
+    print(f"{'ranges':<10}{'cache':<7}{'recalc (s)':>12}{'hits':>8}{'misses':>8}")
+    for index_ranges in [False, True]:
+        for cache_ranges in [False, True]:
+            spreadsheet = Spreadsheet("Shared")
+            spreadsheet.index_ranges = index_ranges
+            spreadsheet.cache_ranges = cache_ranges
+            items = [(f"A{row}", row % 100 + 0.5, None) for row in range(1, rows + 1)]
+            items.extend((f"B{row}", None, f"SUM(A1:A{rows})/AVERAGE(A1:A{rows})+{row}")
+                         for row in range(1, formulas + 1))
+            spreadsheet.set_many(items)
+            formula_cells = {f"B{row}" for row in range(1, formulas + 1)}
+
+            def recalc() -> None:
+                # A new value in the range, so the range is calculated again at least once
+                spreadsheet.set_cell("A1", 1.5)
+                spreadsheet.recalculate_cells(formula_cells)
+            recalc_time = best_time(recalc)
+            info = spreadsheet.range_cache_info()
+            print(f"{'indexed' if index_ranges else 'scanned':<10}{'on' if cache_ranges else 'off':<7}"
+                  f"{recalc_time:>12.3f}{info['hits']:>8}{info['misses']:>8}")
+
+
+@benchmark
+def statistics_functions(rows: int = 1000000) -> None:
+    """
+    Measures the statistical functions over ranges of a million cells.
+
+    :param rows: The number of rows of the ranges.
+    """
+    spreadsheet = Spreadsheet("Statistics")
+    for row in range(1, rows + 1):
+        spreadsheet.cells[f"A{row}"] = Cell((row * 7919) % 100003 + 0.5)
+        spreadsheet.cells[f"B{row}"] = Cell(row % 7 - 3.0)
+    formulas = [f"COUNT(A1:A{rows})", f"COUNTA(A1:A{rows})", f"VAR(A1:A{rows})", f"STDEV(A1:A{rows})",
+                f"MEDIAN(A1:A{rows})", f"PERCENTILE(A1:A{rows}, 0.9)", f"SUMPRODUCT(A1:A{rows}, B1:B{rows})"]
+    print(f"statistical functions, {rows} rows")
+    print(f"{'formula':<36}{'first (s)':>11}{'again (s)':>11}")
+    for formula in formulas:
+        # COUNT builds the range index of the column the first time
+        first_time = best_time(lambda: spreadsheet.evaluate_formula(formula), 1)
+        print(f"{formula:<36}{first_time:>11.3f}{best_time(lambda: spreadsheet.evaluate_formula(formula), 1):>11.3f}")
+
+
+@benchmark
+def conditional_aggregates(rows: int = 100000, formulas: int = 100) -> None:
+    """
+    Compares SUMIF formulas with equality criteria over a long table,
+    with the table scanned and with the matching rows found in the value index.
+
+    :param rows: The number of rows of the table.
+    :param formulas: The number of SUMIF formulas, each one for a different category.
+    """
+    print(f"conditional aggregates, {formulas} SUMIF formulas over {rows} rows")
+    print(f"{'criteria':<10}{'recalc (s)':>12}")
+    for index_ranges in [False, True]:
+        spreadsheet = Spreadsheet("Conditional")
+        spreadsheet.index_ranges = index_ranges
+        for row in range(1, rows + 1):
+            spreadsheet.cells[f"A{row}"] = Cell(f"category{row % formulas}")
+            spreadsheet.cells[f"B{row}"] = Cell(row % 10 + 0.5)
+        # The formulas are not added to the dependencies of the table, so only their calculation is measured
+        for number in range(1, formulas + 1):
+            spreadsheet.cells[f"C{number}"] = Cell(formula=f'SUMIF(A1:A{rows},"category{number - 1}",B1:B{rows})')
+        formula_cells = {f"C{number}" for number in range(1, formulas + 1)}
+        label = "indexed" if index_ranges else "scanned"
+        print(f"{label:<10}{best_time(lambda: spreadsheet.recalculate_cells(formula_cells), 1):>12.3f}")
+
+
+@benchmark
+def lookups(rows: int = 100000, formulas: int = 200) -> None:
+    """
+    Compares exact and approximate VLOOKUP formulas against a long table,
+    with the table scanned and with the hash indexes and sorted snapshots of its first column.
+
+    :param rows: The number of rows of the table.
+    :param formulas: The number of lookups of each kind.
+    """
+    print(f"lookups, {formulas} exact and {formulas} approximate VLOOKUPs in {rows} rows")
+    print(f"{'table':<10}{'recalc (s)':>12}")
+    for index_ranges in [False, True]:
+        spreadsheet = Spreadsheet("Lookups")
+        spreadsheet.index_ranges = index_ranges
+        for row in range(1, rows + 1):
+            spreadsheet.cells[f"A{row}"] = Cell(f"key{row}")
+            spreadsheet.cells[f"B{row}"] = Cell(row * 10.0)
+            spreadsheet.cells[f"C{row}"] = Cell(row + 0.5)
+        # The formulas are not added to the dependencies of the table, so only their calculation is measured
+        for number in range(1, formulas + 1):
+            row = number * (rows // formulas)
+            spreadsheet.cells[f"D{number}"] = Cell(formula=f'VLOOKUP("key{row}",A1:C{rows},3,FALSE)')
+            spreadsheet.cells[f"E{number}"] = Cell(formula=f'VLOOKUP({row * 10 + 5},B1:C{rows},2)')
+        formula_cells = {f"{col}{number}" for col in "DE" for number in range(1, formulas + 1)}
+        label = "indexed" if index_ranges else "scanned"
+        print(f"{label:<10}{best_time(lambda: spreadsheet.recalculate_cells(formula_cells), 1):>12.3f}")
+
+
+@benchmark
+def parallel_recalculation(formulas: int = 1000000, workers: Optional[int] = None) -> None:
+    """
+    Compares recalculating a sheet serially and on a pool of processes,
+    on formulas in short chains that do not depend on each other, like the rows of a model.
+
+    :param formulas: The number of formulas in the sheet.
+    :param workers: The number of processes, the number of CPUs by default.
+    """
+    rows = formulas // 2
+    items = [(f"A{row}", row % 97 + 0.5, None) for row in range(1, rows + 1)]
+    items.extend((f"B{row}", None, f"MAX(A{row},10)*1.5+SQRT(A{row})") for row in range(1, rows + 1))
+    items.extend((f"C{row}", None, f"(B{row}-A{row})/3") for row in range(1, rows + 1))
+    spreadsheet = Spreadsheet("Parallel")
+    spreadsheet.set_many(items)
+    formula_cells = {f"{col}{row}" for col in "BC" for row in range(1, rows + 1)}
+
+    def recalculate(parallel: bool) -> None:
+        spreadsheet.dirty_cells.update(formula_cells)
+        spreadsheet.recalculate(parallel=parallel, workers=workers)
+
+    print(f"parallel recalculation, {len(formula_cells)} formulas, {workers or os.cpu_count()} workers")
+    print(f"{'serial (s)':>12}{'parallel (s)':>14}")
+    serial_time = best_time(lambda: recalculate(False), 1)
+    parallel_time = best_time(lambda: recalculate(True), 1)
+    print(f"{serial_time:>12.3f}{parallel_time:>14.3f}")
+
+
+@benchmark
+def parallel_sheets(sheets: int = 64, rows: int = 5000, workers: Optional[int] = None) -> None:
+    """
+    Compares recalculating the sheets of a workbook one by one and on a pool of processes,
+    on sheets that do not refer to each other.
+
+    :param sheets: The number of sheets.
+    :param rows: The number of rows of every sheet, each with two formulas.
+    :param workers: The number of processes, the number of CPUs by default.
+    """
+    workbook = Workbook("Sheets")
+    for index in range(sheets):
+        spreadsheet = Spreadsheet(f"Sheet{index}")
+        spreadsheet.set_many([(f"A{row}", (row * (index + 1)) % 89 + 0.5, None) for row in range(1, rows + 1)])
+        spreadsheet.set_many([(f"B{row}", None, f"MAX(A{row},10)*1.5+SQRT(A{row})") for row in range(1, rows + 1)])
+        spreadsheet.set_many([(f"C{row}", None, f"(B{row}-A{row})/3") for row in range(1, rows + 1)])
+        workbook.attach_sheet(spreadsheet.name, spreadsheet)
+
+    def recalculate(parallel: bool) -> None:
+        for spreadsheet in workbook.sheets.values():
+            spreadsheet.dirty_cells.update(f"{col}{row}" for col in "BC" for row in range(1, rows + 1))
+        workbook.recalculate(parallel=parallel, workers=workers)
+
+    print(f"parallel sheets, {sheets} sheets of {2 * rows} formulas, {workers or os.cpu_count()} workers")
+    print(f"{'serial (s)':>12}{'parallel (s)':>14}")
+    serial_time = best_time(lambda: recalculate(False), 1)
+    parallel_time = best_time(lambda: recalculate(True), 1)
+    print(f"{serial_time:>12.3f}{parallel_time:>14.3f}")
+
+
+def formula_chain_spreadsheet(rows: int, formula_backend: str = "interpreted") -> Spreadsheet:
+    """
+    Builds a sheet with a column of numbers and a column of formulas,
+    where every formula depends on the numbers and on the formula above it.
+
+    :param rows: The number of rows of the sheet.
+    :param formula_backend: The formula backend of the sheet.
+    :return: The new spreadsheet.
+    """
+    spreadsheet = Spreadsheet("Chain", formula_backend)
+    items = [(f"A{row}", row % 97 + 0.5, None) for row in range(1, rows + 2)]
+    items.append(("B1", None, "A1*2"))
+    items.extend((f"B{row}", None, f"(A{row}*1.5+A{row + 1}/2-B{row - 1})/3+SQRT(A{row})")
+                 for row in range(2, rows + 1))
+    spreadsheet.set_many(items)
+    return spreadsheet
+
+
+def grid_spreadsheet(rows: int, cols: int) -> Spreadsheet:
+    """
+    Builds a sheet where every cell is set: mostly numbers, one column of text and one column of formulas.
+
+    :param rows: The number of rows of the sheet.
+    :param cols: The number of columns of the sheet.
+    :return: The new spreadsheet.
+    """
+    spreadsheet = Spreadsheet("Grid")
+    for col in range(cols):
+        col_letter = spreadsheet.col_index_to_letter(col)
+        for row in range(1, rows + 1):
+            if col == 1:
+                spreadsheet.set_cell(f"{col_letter}{row}", f"item {row}")
+            elif col == 2:
+                spreadsheet.set_cell(f"{col_letter}{row}", formula=f"A{row}*2")
+            else:
+                spreadsheet.set_cell(f"{col_letter}{row}", row * col + 0.5)
+    return spreadsheet
+
+
+def main(names: List[str]) -> None:
+    """
+    Runs the benchmarks with the given names, or all of them if no name is given.
+
+    :param names: The names of the benchmarks to run.
+    """
+    for name in names or list(BENCHMARKS.keys()):
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available benchmarks: {', '.join(BENCHMARKS.keys())}")
+            continue
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,525 @@
+import os
+import sys
+import json
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import *
+from workbook import *
+from benchmark import best_time
+
+# The synthetic workbooks of the suite, by name. Every generator takes a size, about the number of formulas
+GENERATORS: Dict[str, Callable[[int], Workbook]] = {}
+
+# The operations the suite times on every workbook, by name
+OPERATIONS: Dict[str, Callable[[Workbook, str, int], float]] = {}
+
+# The size of the workbooks when no size is given
+DEFAULT_SIZE = 1000
+
+# A time has to grow by more than this fraction of the baseline to be reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Differences smaller than this, in seconds, are measurement noise and never reported as regressions
+MIN_REGRESSION_SECONDS = 0.002
+
+# The number of cells every formula refers to in the memory measurement of dependency edges
+DEFAULT_REFERENCES = 5
+
+
+def generator(func: Callable[[int], Workbook]) -> Callable[[int], Workbook]:
+    """
+    Registers a workbook generator under its own name, without the "_workbook" suffix.
+
+    :param func: The generator function.
+    :return: The same function.
+    """
+    GENERATORS[func.__name__[:-len("_workbook")]] = func
+    return func
+
+
+def operation(func: Callable[[Workbook, str, int], float]) -> Callable[[Workbook, str, int], float]:
+    """
+    Registers an operation under its own name, without the "time_" prefix.
+
+    :param func: The function that times the operation.
+    :return: The same function.
+    """
+    OPERATIONS[func.__name__[len("time_"):]] = func
+    return func
+
+
+def new_sheet(workbook: Workbook, sheet_name: str, items: List[Tuple[str, Any, Optional[str]]]) -> None:
+    """
+    Adds a sheet with the given cells to a workbook.
+
+    :param workbook: The workbook.
+    :param sheet_name: The name of the sheet.
+    :param items: The (cell name, value, formula) of every cell, see Spreadsheet.set_many.
+    The cells have to come after the cells they depend on.
+    """
+    spreadsheet = Spreadsheet(sheet_name)
+    workbook.attach_sheet(sheet_name, spreadsheet)
+    spreadsheet.set_many(items)
+
+
+@generator
+def chain_workbook(size: int) -> Workbook:
+    """
+    Builds a workbook with one long dependency chain, where every formula depends on the formula above it.
+
+    :param size: The number of formulas.
+    :return: The new workbook.
+    """
+    workbook = Workbook("chain")
+    items = [(f"A{row}", row % 89 + 0.5, None) for row in range(1, size + 1)]
+    items.append(("B1", None, "A1"))
+    items.extend((f"B{row}", None, f"B{row - 1}+A{row}/{row}") for row in range(2, size + 1))
+    new_sheet(workbook, "Chain", items)
+    return workbook
+
+
+@generator
+def wide_ranges_workbook(size: int) -> Workbook:
+    """
+    Builds a workbook with a block of numbers ten columns wide and aggregates over overlapping parts of it.
+
+    :param size: The number of rows of the block. There are size // 10 aggregates.
+    :return: The new workbook.
+    """
+    workbook = Workbook("wide_ranges")
+    items = [(f"{col}{row}", (row * 7 + ord(col)) % 101 + 0.25, None)
+             for row in range(1, size + 1) for col in "ABCDEFGHIJ"]
+    functions = ["SUM", "AVERAGE", "MIN", "MAX"]
+    for row in range(1, max(size // 10, 1) + 1):
+        last_row = max(size * row // max(size // 10, 1), 1)
+        items.append((f"L{row}", None, f"{functions[row % 4]}(A1:J{last_row})"))
+    new_sheet(workbook, "Ranges", items)
+    return workbook
+
+
+@generator
+def sparse_grid_workbook(size: int) -> Workbook:
+    """
+    Builds a workbook whose few cells are spread over a large area, so most of the used range is empty.
+    Every fourth cell is a formula of the cell before it.
+
+    :param size: The number of cells.
+    :return: The new workbook.
+    """
+    workbook = Workbook("sparse_grid")
+    items = []
+    previous = None
+    for index in range(size):
+        cell_name = f"{chr(ord('A') + index % 26)}{index * 10 + 1}"
+        if previous is not None and index % 4 == 3:
+            items.append((cell_name, None, f"{previous}*2+1"))
+        else:
+            items.append((cell_name, index + 0.5, None))
+        previous = cell_name
+    new_sheet(workbook, "Sparse", items)
+    return workbook
+
+
+@generator
+def many_sheets_workbook(size: int) -> Workbook:
+    """
+    Builds a workbook with many small sheets, each with a column of numbers, a column of formulas
+    and a total that adds the total of the sheet before it.
+
+    :param size: About the number of formulas, 100 in every sheet.
+    :return: The new workbook.
+    """
+    workbook = Workbook("many_sheets")
+    for index in range(1, max(size // 100, 2) + 1):
+        items = [(f"A{row}", row + index + 0.5, None) for row in range(1, 100)]
+        items.extend((f"B{row}", None, f"A{row}*2") for row in range(1, 100))
+        total = "SUM(B1:B99)" if index == 1 else f"SUM(B1:B99)+Sheet{index - 1}!C1"
+        items.append(("C1", None, total))
+        new_sheet(workbook, f"Sheet{index}", items)
+    return workbook
+
+
+def input_cells(spreadsheet: Spreadsheet) -> List[str]:
+    """
+    Finds the cells of a sheet that hold numbers and no formula.
+
+    :param spreadsheet: The spreadsheet.
+    :return: The names of the cells.
+    """
+    return [cell_name for cell_name, cell in spreadsheet.cells.items()
+            if not cell.formula and isinstance(cell.value, (int, float))]
+
+
+def formula_cells(spreadsheet: Spreadsheet) -> List[str]:
+    """
+    Finds the formula cells of a sheet, in the order they were set.
+
+    :param spreadsheet: The spreadsheet.
+    :return: The names of the cells.
+    """
+    return [cell_name for cell_name, cell in spreadsheet.cells.items() if cell.formula]
+
+
+def change_inputs(workbook: Workbook) -> None:
+    """
+    Sets every number of the workbook to a new value, which makes the formulas that depend on it dirty.
+
+    :param workbook: The workbook.
+    """
+    for spreadsheet in workbook.sheets.values():
+        for cell_name in input_cells(spreadsheet):
+            spreadsheet.set_cell(cell_name, spreadsheet.cells[cell_name].value + 1)
+
+
+def read_formulas(workbook: Workbook) -> None:
+    """
+    Reads the value of every formula of the workbook, sheet by sheet, in the order the formulas were set.
+
+    :param workbook: The workbook.
+    """
+    for spreadsheet in workbook.sheets.values():
+        for cell_name in formula_cells(spreadsheet):
+            spreadsheet.get_cell_value(cell_name)
+
+
+def timed(func: Callable[[], Any], setup: Optional[Callable[[], Any]] = None, repeat: int = 3) -> float:
+    """
+    Measures the fastest of a few runs of a function, each after an untimed setup.
+
+    :param func: The function to measure.
+    :param setup: A function that runs before every run, outside of the measured time.
+    :param repeat: The number of runs.
+    :return: The time of the fastest run, in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        best = min(best, best_time(func, 1))
+    return best
+
+
+@operation
+def time_set_cell(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times setting every number of the workbook, including marking the formulas that depend on it dirty.
+    """
+    return timed(lambda: change_inputs(workbook), lambda: read_formulas(workbook), repeat)
+
+
+@operation
+def time_get_cell_value(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times reading every formula of the workbook after its numbers have changed, which recalculates them.
+    """
+    return timed(lambda: read_formulas(workbook), lambda: change_inputs(workbook), repeat)
+
+
+@operation
+def time_evaluate_formula(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times evaluating the text of every formula of the workbook, without storing the result.
+    """
+    formulas = [(spreadsheet, spreadsheet.cells[cell_name].formula)
+                for spreadsheet in workbook.sheets.values() for cell_name in formula_cells(spreadsheet)]
+
+    def evaluate() -> None:
+        for spreadsheet, formula in formulas:
+            spreadsheet.evaluate_formula(formula)
+    return timed(evaluate, lambda: read_formulas(workbook), repeat)
+
+
+@operation
+def time_str(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times printing every sheet of the workbook, with str.
+    """
+    return timed(lambda: [str(spreadsheet) for spreadsheet in workbook.sheets.values()],
+                 lambda: read_formulas(workbook), repeat)
+
+
+@operation
+def time_export_to_json(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times saving the workbook to a JSON file.
+    """
+    return timed(lambda: workbook.export_to_json(os.path.join(directory, "export")), None, repeat)
+
+
+@operation
+def time_export_to_csv(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times exporting the workbook to CSV files.
+    """
+    return timed(lambda: workbook.export_to_csv(os.path.join(directory, "export")), None, repeat)
+
+
+@operation
+def time_export_to_excel(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times exporting the workbook to an Excel file.
+    """
+    return timed(lambda: workbook.export_to_excel(os.path.join(directory, "export")), None, repeat)
+
+
+@operation
+def time_export_to_pdf(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times exporting the workbook to PDF files.
+    """
+    return timed(lambda: workbook.export_to_pdf(os.path.join(directory, "export")), None, repeat)
+
+
+@operation
+def time_load_and_open_workbook(workbook: Workbook, directory: str, repeat: int) -> float:
+    """
+    Times loading the workbook from a JSON file.
+    """
+    path = os.path.join(directory, "load")
+    workbook.export_to_json(path)
+    return timed(lambda: load_and_open_workbook(path + ".json"), None, repeat)
+
+
+def run_suite(size: int = DEFAULT_SIZE, generators: Optional[List[str]] = None,
+              operations: Optional[List[str]] = None, repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Builds every workbook of the suite and times every operation on it.
+    What the operations print, like the messages of the exports, is not shown.
+
+    :param size: The size of the workbooks, see GENERATORS.
+    :param generators: The names of the workbooks to build, all of them by default.
+    :param operations: The names of the operations to time, all of them by default.
+    :param repeat: The number of runs of every operation, the fastest one is kept.
+    :return: The time of every operation in seconds, by workbook name and then by operation name.
+    :raises ValueError: If a workbook or an operation does not exist.
+    """
+    generators = generators or list(GENERATORS.keys())
+    operations = operations or list(OPERATIONS.keys())
+    for name in generators:
+        if name not in GENERATORS:
+            raise ValueError(f"Unknown workbook '{name}'. Available workbooks: {', '.join(GENERATORS.keys())}")
+    for name in operations:
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}'. Available operations: {', '.join(OPERATIONS.keys())}")
+    results = {}
+    for generator_name in generators:
+        workbook = GENERATORS[generator_name](size)
+        results[generator_name] = {}
+        with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+            for operation_name in operations:
+                with redirect_stdout(devnull):
+                    results[generator_name][operation_name] = OPERATIONS[operation_name](workbook, directory, repeat)
+    return results
+
+
+def save_results(results: Dict[str, Dict[str, float]], filename: str, size: int) -> None:
+    """
+    Saves the results of the suite to a JSON file, with the size and the machine they were measured on.
+
+    :param results: The results, see run_suite.
+    :param filename: The name of the file.
+    :param size: The size of the workbooks.
+    """
+    with open(filename, 'w') as f:
+        json.dump({'size': size, 'python': platform.python_version(), 'machine': platform.machine(),
+                   'results': results}, f, indent=4)
+
+
+def load_results(filename: str) -> Dict[str, Dict[str, float]]:
+    """
+    Loads the results of the suite from a JSON file created by save_results.
+
+    :param filename: The name of the file.
+    :return: The results, see run_suite.
+    """
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def compare_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                    tolerance: float = DEFAULT_TOLERANCE) -> List[Tuple[str, str, float, float]]:
+    """
+    Finds the operations that got slower than in a baseline.
+    Operations that are not in the baseline are skipped.
+
+    :param results: The new results, see run_suite.
+    :param baseline: The results to compare to.
+    :param tolerance: The fraction of the baseline time an operation may grow by without being reported.
+    :return: The (workbook, operation, baseline time, new time) of every regression.
+    """
+    regressions = []
+    for generator_name, times in results.items():
+        for operation_name, seconds in times.items():
+            baseline_seconds = baseline.get(generator_name, {}).get(operation_name)
+            if baseline_seconds is None:
+                continue
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > MIN_REGRESSION_SECONDS:
+                regressions.append((generator_name, operation_name, baseline_seconds, seconds))
+    return regressions
+
+
+def results_table(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None,
+                  tolerance: float = DEFAULT_TOLERANCE) -> str:
+    """
+    Creates a table of the results, with the change from a baseline if there is one.
+
+    :param results: The results, see run_suite.
+    :param baseline: The results to compare to, if any.
+    :param tolerance: The tolerance of the comparison, see compare_results.
+    :return: The table as a string.
+    """
+    regressions = {(generator_name, operation_name)
+                   for generator_name, operation_name, _, _ in compare_results(results, baseline or {}, tolerance)}
+    lines = [f"{'workbook':<14}{'operation':<24}{'time (ms)':>12}{'baseline (ms)':>16}{'change':>10}"]
+    for generator_name, times in results.items():
+        for operation_name, seconds in times.items():
+            line = f"{generator_name:<14}{operation_name:<24}{seconds * 1000:>12.2f}"
+            baseline_seconds = (baseline or {}).get(generator_name, {}).get(operation_name)
+            if baseline_seconds is not None:
+                change = (seconds - baseline_seconds) / baseline_seconds if baseline_seconds else 0.0
+                line += f"{baseline_seconds * 1000:>16.2f}{change:>+10.0%}"
+                if (generator_name, operation_name) in regressions:
+                    line += "  REGRESSION"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def allocated_bytes(before: tracemalloc.Snapshot) -> int:
+    """
+    Measures the memory allocated since a tracemalloc snapshot and not freed yet.
+
+    :param before: The snapshot.
+    :return: The number of bytes.
+    """
+    return sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+
+
+def measure_memory(size: int = DEFAULT_SIZE, references: int = DEFAULT_REFERENCES) -> Dict[str, Dict[str, float]]:
+    """
+    Measures the memory of the parts of a workbook with tracemalloc:
+    numbers set with Spreadsheet.set_cell, formulas of one cell set with Spreadsheet.set_cell_formula,
+    formulas of several cells, whose extra memory is the memory of their dependency edges,
+    and a whole workbook loaded with load_and_open_workbook.
+    The parsed formula cache is cleared first, so the parse trees of the formulas are counted too.
+
+    :param size: The number of numbers, and the number of formulas of each kind.
+    :param references: The number of cells every formula of several cells refers to, at least 2.
+    :return: The number of items, the bytes they take and the bytes per item,
+    by "cells", "formulas", "edges" and "loaded_cells".
+    """
+    references = max(references, 2)
+    parse_formula.cache_clear()
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        workbook = Workbook("memory")
+        spreadsheet = Spreadsheet("Sheet1")
+        workbook.attach_sheet("Sheet1", spreadsheet)
+
+        before = tracemalloc.take_snapshot()
+        for row in range(1, size + references + 1):
+            spreadsheet.set_cell(f"A{row}", row + 0.5)
+        cell_bytes = allocated_bytes(before)
+
+        before = tracemalloc.take_snapshot()
+        for row in range(1, size + 1):
+            cell = spreadsheet.cells[f"B{row}"] = Cell()
+            spreadsheet.set_cell_formula(cell, f"B{row}", f"A{row}*2")
+        single_bytes = allocated_bytes(before)
+
+        before = tracemalloc.take_snapshot()
+        for row in range(1, size + 1):
+            cell = spreadsheet.cells[f"C{row}"] = Cell()
+            spreadsheet.set_cell_formula(cell, f"C{row}", "+".join(f"A{row + offset}" for offset in range(references)))
+        multiple_bytes = allocated_bytes(before)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "memory")
+            workbook.export_to_json(path)
+            cell_count = len(spreadsheet.cells)
+            del workbook, spreadsheet, cell
+            parse_formula.cache_clear()
+            before = tracemalloc.take_snapshot()
+            loaded = load_and_open_workbook(path + ".json")
+            loaded_bytes = allocated_bytes(before)
+            del loaded
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    edge_bytes = (multiple_bytes - single_bytes) / (size * (references - 1))
+    measurements = {
+        'cells': (size + references, cell_bytes),
+        'formulas': (size * 2, single_bytes + multiple_bytes - edge_bytes * size * (references + 1)),
+        'edges': (size * (references + 1), edge_bytes * size * (references + 1)),
+        'loaded_cells': (cell_count, loaded_bytes),
+    }
+    return {name: {'count': count, 'bytes': total, 'bytes_per_item': total / count}
+            for name, (count, total) in measurements.items()}
+
+
+def memory_table(measurements: Dict[str, Dict[str, float]]) -> str:
+    """
+    Creates a table of memory measurements.
+
+    :param measurements: The measurements, see measure_memory.
+    :return: The table as a string.
+    """
+    lines = [f"{'item':<16}{'count':>10}{'bytes':>14}{'bytes per item':>18}"]
+    for name, measurement in measurements.items():
+        lines.append(f"{name:<16}{measurement['count']:>10}{measurement['bytes']:>14.0f}"
+                     f"{measurement['bytes_per_item']:>18.1f}")
+    return "\n".join(lines)
+
+
+def main(arguments: List[str]) -> int:
+    """
+    Runs the suite from the command line, for example:
+        python benchmark_suite.py --output baseline.json
+        python benchmark_suite.py --baseline baseline.json --workbooks chain wide_ranges
+        python benchmark_suite.py --memory --size 100000 --output memory.json
+
+    :param arguments: The command line arguments.
+    :return: The exit status, 1 if there are regressions.
+    """
+    parser = argparse.ArgumentParser(description="Times the spreadsheet operations on synthetic workbooks.")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="the size of the workbooks")
+    parser.add_argument("--repeat", type=int, default=3, help="the number of runs of every operation")
+    parser.add_argument("--workbooks", nargs="*", choices=list(GENERATORS.keys()), help="the workbooks to build")
+    parser.add_argument("--operations", nargs="*", choices=list(OPERATIONS.keys()), help="the operations to time")
+    parser.add_argument("--output", help="a JSON file to save the results to")
+    parser.add_argument("--baseline", help="a JSON file of earlier results to compare to")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="the fraction an operation may slow down by before it is a regression")
+    parser.add_argument("--memory", action="store_true",
+                        help="measure the bytes per cell, per formula and per dependency edge instead of times")
+    parser.add_argument("--references", type=int, default=DEFAULT_REFERENCES,
+                        help="the number of cells every formula refers to in the measurement of dependency edges")
+    args = parser.parse_args(arguments)
+
+    if args.memory:
+        measurements = measure_memory(args.size, args.references)
+        print(memory_table(measurements))
+        if args.output:
+            save_results(measurements, args.output, args.size)
+        return 0
+
+    results = run_suite(args.size, args.workbooks, args.operations, args.repeat)
+    baseline = load_results(args.baseline) if args.baseline else None
+    print(results_table(results, baseline, args.tolerance))
+    if args.output:
+        save_results(results, args.output, args.size)
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} operations are slower than the baseline.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,21 @@
 import re
 import math
+import logging
+import threading
+from contextlib import contextmanager
 from typing import *
-import matplotlib.pyplot as plt  # type: ignore
+from formula_parser import *
+from formula_compiler import *
+from formula_vectorizer import *
+from range_index import *
+from range_kernels import *
+from value_index import *
+from lookup_index import *
+from formula_profiler import *
+from formula_errors import *
+
+if TYPE_CHECKING:
+    from workbook import Workbook
 
 LETTERS_NUM = 26
 ALL_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -13,6 +27,24 @@ GRAPH_ERROR = "Invalid range. Please use the format 'graph [type] [range1] [rang
               "the second range should be the y-axis - represent values.\n" \
               "the start/end range of both axis should be lengths equal."
 
+# The number of cell evaluations in progress on the current thread, over all the sheets,
+# so a formula that overflows the stack is handled once, by the outermost evaluation
+evaluation_state = threading.local()
+
+# The ways a spreadsheet can evaluate formulas:
+# "interpreted" walks the parsed tree, "compiled" runs the formula compiled into closures
+FORMULA_BACKENDS = ["interpreted", "compiled"]
+
+
+def is_number(value: Any) -> bool:
+    """
+    Checks whether a value can be used in a calculation.
+
+    :param value: The value to check.
+    :return: True if the value is an int or a float, False otherwise.
+    """
+    return isinstance(value, int) or isinstance(value, float)
+
 
 class Cell:
     """
@@ -72,14 +104,32 @@ class Cell:
     def to_dict(self) -> Dict[str, Any]:
         """
         Converts the cell to a dictionary.
+        The dependents are not included, they are rebuilt from the formulas when a workbook is loaded.
 
         :return: A dictionary representation of the cell.
         """
-        return {
-            'value': self.value,
-            'formula': self.formula,
-            'dependents': list(self.dependents)
-        }
+        cell_dict = {'value': stored_value(self.value)}
+        if self.formula:
+            cell_dict['formula'] = self.formula
+        return cell_dict
+
+    def is_blank(self) -> bool:
+        """
+        Checks whether the cell has neither a value nor a formula.
+
+        :return: True if the cell is blank, False otherwise.
+        """
+        return self.value is None and not self.formula
+
+    def copy(self) -> 'Cell':
+        """
+        Creates an independent copy of the cell, including its own set of dependents.
+
+        :return: A new Cell instance with the same value, formula and dependents.
+        """
+        cell = Cell(self.value, self.formula)
+        cell.dependents = set(self.dependents)
+        return cell
 
     def update_dependents(self, dependents: List[str]) -> None:
         """
@@ -95,12 +145,65 @@ class Spreadsheet:
     Represents a spreadsheet page, similar to an Excel page.
     """
 
-    def __init__(self, sheet_name=None) -> None:
+    def __init__(self, sheet_name=None, formula_backend: str = "interpreted") -> None:
         """
         Initializes a new Spreadsheet instance with an empty dictionary of cells.
+
+        :param sheet_name: The name of the sheet.
+        :param formula_backend: How formulas are evaluated, one of FORMULA_BACKENDS.
+        The compiled backend is faster for sheets that are recalculated many times.
         """
+        if formula_backend not in FORMULA_BACKENDS:
+            raise ValueError(f"Unknown formula backend '{formula_backend}'. "
+                             f"Available backends: {', '.join(FORMULA_BACKENDS)}")
         self.cells: Dict[str, Cell] = {}
         self.name = sheet_name
+        # The workbook the sheet belongs to, which resolves the references to other sheets
+        self.workbook: Optional['Workbook'] = None
+        # The cells of other sheets that every formula refers to, by formula cell name and then by sheet name
+        self.sheet_references: Dict[str, Dict[str, List[str]]] = {}
+        self.formula_backend = formula_backend
+        # The compiled formulas of the compiled backend, by formula text
+        self.compiled_formulas: Dict[str, Callable[[], Any]] = {}
+        # The logger of the diagnostics of formula errors, see formula_errors
+        self.logger: logging.Logger = logger
+        # The profiler that records the evaluation times of the formulas, None when profiling is off
+        self.profiler: Optional[FormulaProfiler] = None
+        # If True, runs of copied-down formulas are recalculated as array operations (when numpy is installed)
+        self.vectorize_formulas = True
+        # The formula, position and relative template of formula cells, by cell name
+        self.formula_templates: Dict[str, Tuple[str, Tuple[int, int, Optional[tuple]]]] = {}
+        # If True, aggregates of large ranges and equality criteria are answered from per-column indexes,
+        # see range_index and value_index
+        self.index_ranges = True
+        # The range index of every column that a large range aggregate has used, by column letter
+        self.range_indexes: Dict[str, ColumnIndex] = {}
+        # If True, the aggregates of every range are calculated once and shared until a cell in the range changes
+        self.cache_ranges = True
+        # The aggregates of ranges that were already calculated, by (first column, first row, last column, last row),
+        # and the cached ranges that cover every column, by column letter
+        self.range_cache: Dict[Tuple[int, int, int, int], RangeStatistics] = {}
+        self.range_cache_columns: Dict[str, Set[Tuple[int, int, int, int]]] = {}
+        self.range_cache_hits = 0
+        self.range_cache_misses = 0
+        # The value to rows index of every column that an equality criteria was used on, by column letter
+        self.value_indexes: Dict[str, ColumnValueIndex] = {}
+        # The sorted snapshots of the ranges that approximate lookups were made in,
+        # by column letter and then by (first row, last row)
+        self.lookup_snapshots: Dict[str, Dict[Tuple[int, int], SortedSnapshot]] = {}
+        # Formula cells whose stored value is out of date
+        self.dirty_cells: Set[str] = set()
+        # If True, new formulas are not evaluated when they are set, only marked dirty
+        self.defer_recalculation = False
+        # While a batch is open: the state of every changed cell before the batch,
+        # (value, formula, was dirty), or None if the cell did not exist
+        self.batch_changes: Optional[Dict[str, Optional[Tuple[Any, Optional[str], bool]]]] = None
+        # Incremented on every change, so savers can tell whether the sheet is dirty
+        self.version = 0
+        # The number of cells and the used range that was computed for them
+        self.used_range_cache: Optional[Tuple[int, Tuple[int, int]]] = None
+        # Guards the cells against being copied while they are being modified
+        self.lock = threading.RLock()
 
     def is_valid_cell_name(self, cell_name: str) -> bool:
         """
@@ -150,40 +253,110 @@ class Spreadsheet:
 
         :return str: A string representing the spreadsheet in a structured table format.
         """
+        return self.render()
+
+    def render(self, first_cell: str = "A1", last_cell: Optional[str] = None, number_format: Optional[str] = None,
+               align_numbers: bool = False, min_width: int = 10, max_width: Optional[int] = None) -> str:
+        """
+        Generates a string representation of a rectangular part of the spreadsheet in a table format,
+        in the same format as printing the whole spreadsheet.
+        Only the cells inside the part are evaluated, so showing a small part of a large spreadsheet is fast.
+        The part is clipped to the used cells of the spreadsheet.
+        Every column is as wide as its longest value, so long values do not break the alignment.
+
+        :param first_cell: The top left cell of the part to show.
+        :param last_cell: The bottom right cell of the part to show.
+        If not provided, the part ends at the last used row and column.
+        :param number_format: A format specification for numbers, for example ".2f" or ",.0f".
+        If not provided, numbers are shown as they are.
+        :param align_numbers: If True, columns that contain only numbers are aligned to the right.
+        :param min_width: The minimum width of a column.
+        :param max_width: The maximum width of a column. Longer values are cut and end with "~".
+        :return: A string representing the part of the spreadsheet in a structured table format.
+        """
         if not self.cells:
             return "The spreadsheet is empty."
+        max_col_index, max_row = self.used_range()
+        first_col_index, first_row = self.cell_coordinates(first_cell)
+        last_col_index, last_row = max_col_index, max_row
+        if last_cell is not None:
+            last_col_index, last_row = self.cell_coordinates(last_cell)
+            last_col_index, last_row = min(last_col_index, max_col_index), min(last_row, max_row)
+        if first_col_index > last_col_index or first_row > last_row:
+            return "There are no cells in this part of the spreadsheet."
+
+        # The column letters and the row numbers are computed once, not once per cell
+        col_headers = [self.col_index_to_letter(i) for i in range(first_col_index, last_col_index + 1)]
+        row_labels = [str(row_num) for row_num in range(first_row, last_row + 1)]
+        label_width = max(4, len(row_labels[-1]))
+
+        # Format every column in one pass, finding its width and whether it contains only numbers
+        columns = [[label.ljust(label_width) for label in row_labels]]
+        headers = [' ' * label_width]
+        for col_letter in col_headers:
+            texts = []
+            numeric = True
+            for row_label in row_labels:
+                cell_name = col_letter + row_label
+                cell = self.cells.get(cell_name)
+                if cell is None:
+                    texts.append("-")
+                    continue
+                cell_value = self.updated_value(cell_name, cell)
+                if cell_value is None:
+                    texts.append("-")
+                elif isinstance(cell_value, (int, float)) and not isinstance(cell_value, bool):
+                    texts.append(str(cell_value) if number_format is None else format(cell_value, number_format))
+                else:
+                    numeric = False
+                    texts.append(str(cell_value))
+            width = max(min_width, len(col_letter), max(map(len, texts)))
+            if max_width is not None and width > max_width:
+                width = max(max_width, len(col_letter))
+                texts = [text if len(text) <= width else text[:width - 1] + "~" for text in texts]
+            if align_numbers and numeric:
+                columns.append([text.rjust(width) for text in texts])
+            else:
+                columns.append([text.ljust(width) for text in texts])
+            headers.append(col_letter.ljust(width))
+
+        header = ' '.join(headers)
+        rows = [header, '-' * len(header)]
+        rows.extend(' '.join(row_parts) for row_parts in zip(*columns))
+        return '\n'.join(rows)
+
+    def cell_coordinates(self, cell_name: str) -> Tuple[int, int]:
+        """
+        Splits a cell name into its column index and its row number.
+        for example: "A1" -> (0, 1), "AB12" -> (27, 12)
+
+        :param cell_name: A valid cell name.
+        :return: A tuple of the column index and the row number.
+        """
+        col = cell_name.rstrip(ALL_DIGITS)
+        return self.col_letter_to_index(col), int(cell_name[len(col):])
+
+    def used_range(self) -> Tuple[int, int]:
+        """
+        Retrieves the maximum column index and the maximum row that have been used in the spreadsheet.
+        Cells are never deleted from the cell's dictionary, only cleared,
+        so the result is kept until new cells are added.
 
-            # Identify the max column and row
+        :return: A tuple of the maximum column index and the maximum row, (0, 0) if there are no cells.
+        """
+        if self.used_range_cache is not None and self.used_range_cache[0] == len(self.cells):
+            return self.used_range_cache[1]
         max_col_index = 0
         max_row = 0
-        for cell_name in self.cells.keys():
+        for cell_name in list(self.cells.keys()):
             try:
-                col, row = cell_name.rstrip(ALL_DIGITS), int(cell_name.lstrip(ALL_LETTERS))
-                col_index = self.col_letter_to_index(col)
+                col_index, row = self.cell_coordinates(cell_name)
                 max_col_index = max(max_col_index, col_index)
                 max_row = max(max_row, row)
             except:
                 continue
-
-        # Generate column headers
-        col_headers = [self.col_index_to_letter(i) for i in range(max_col_index + 1)]
-        header = '     ' + ' '.join(f'{col: <10}' for col in col_headers)
-        separator = '-' * len(header)
-
-        # Generate the table rows
-        rows = [header, separator]
-        for row_num in range(1, max_row + 1):
-            row_cells = [f'{row_num: <4}']
-            for i in range(max_col_index + 1):
-                col_letter = self.col_index_to_letter(i)
-                cell_name = f"{col_letter}{row_num}"
-                cell_value = self.get_cell_value(cell_name)
-                cell_value = "-" if cell_value is None else cell_value
-                cell_str = f'{str(cell_value): <10}'
-                row_cells.append(cell_str)
-            rows.append(' '.join(row_cells))
-
-        return '\n'.join(rows)
+        self.used_range_cache = (len(self.cells), (max_col_index, max_row))
+        return max_col_index, max_row
 
     def set_cell(self, cell_name: str, value: Optional[Any] = None, formula: Optional[str] = None) -> None:
         """
@@ -191,6 +364,7 @@ class Spreadsheet:
         If the cell does not exist, it is created.
         If a value is provided, the cell's formula (if any) is removed.
         If a formula is provided, the cell's value is updated based on the formula.
+        The cells that depend on this cell are marked dirty and recalculated when they are read.
 
         :param cell_name: The name of the cell to set.
         :param value: The value to set in the cell.
@@ -201,18 +375,27 @@ class Spreadsheet:
                   f" Cell names must be in the format 'A1', 'B2', 'AZ10' etc.")
             return
 
-        # Ensure the cell exists in the dictionary; if not, create a new one
-        if cell_name not in self.cells:
-            self.cells[cell_name] = Cell()
-
-        # Update the cell's value or formula
-        cell = self.cells[cell_name]
-        if value is not None:
-            if cell.formula:
-                self.remove_cell(cell_name)
-            self.set_cell_value(cell, value)
-        if formula is not None:
-            self.set_cell_formula(cell, cell_name, formula)
+        with self.lock:
+            self.version += 1
+            if self.batch_changes is not None:
+                self.set_cell_in_batch(cell_name, value, formula)
+                return
+            # Ensure the cell exists in the dictionary; if not, create a new one
+            if cell_name not in self.cells:
+                self.cells[cell_name] = Cell()
+
+            # Update the cell's value or formula
+            cell = self.cells[cell_name]
+            self.dirty_cells.discard(cell_name)
+            self.invalidate_ranges(cell_name)
+            if value is not None:
+                if cell.formula:
+                    self.remove_cell(cell_name)
+                self.set_cell_value(cell, value)
+            if formula is not None:
+                self.set_cell_formula(cell, cell_name, formula)
+            # Everything that depends on the cell is out of date now
+            self.mark_dependents_dirty(cell_name)
 
     def set_cell_value(self, cell: Cell, value: Any) -> None:
         """
@@ -231,8 +414,9 @@ class Spreadsheet:
     def set_cell_formula(self, cell: Cell, cell_name: str, formula: str) -> None:
         """
         Sets the formula of a cell in the spreadsheet.
-        If the formula is a cell name, the cell's value is updated based on the referenced cell's value.
-        If the formula is a range of cells, the cell's value is updated based on the values of the cells in the range.
+        The cells that the formula refers to are recorded as dependencies,
+        and the cell's value is updated based on the formula,
+        unless recalculation is deferred, in which case the cell is only marked dirty.
 
         :param cell: The cell to set the formula for.
         :param cell_name: The name of the cell to set the formula for.
@@ -241,63 +425,197 @@ class Spreadsheet:
         if isinstance(formula, int) or isinstance(formula, float):
             cell.value = formula
             cell.formula = None
+            self.update_sheet_references(cell_name, {})
             return
-        # Check if the formula is a cell name
-        if self.is_valid_cell_name(formula):
-            referenced_cell = self.get_cell(formula)
-            if formula == cell_name:
-                print("The cell cannot be dependent on itself.")
-                return
-            if referenced_cell:
-                cell.value = referenced_cell.value
-                cell.formula = formula
-                # Add the referenced cell to the dependents of the current cell
-                cell.add_dependent(formula)
+        try:
+            parse_formula(formula)
+        except FormulaSyntaxError as err:
+            print(f"Error: {str(err)}")
+            return
+        dependencies = self.formula_dependencies(formula)
+        sheet_references = self.formula_sheet_references(formula)
+        if cell_name in dependencies or cell_name in sheet_references.get(self.name, []):
+            print("The cell cannot be dependent on itself.")
+            return
+        # Forget the dependencies of the previous formula, if there was one
+        if cell.formula:
+            for dep_name in self.formula_dependencies(cell.formula):
+                if dep_name in self.cells:
+                    self.cells[dep_name].remove_dependent(cell_name)
+        for dep_name in dependencies:
+            if dep_name not in self.cells:
+                self.cells[dep_name] = Cell()
+            # Add the cell to the dependents of the referenced cells
+            self.cells[dep_name].add_dependent(cell_name)
+        self.update_sheet_references(cell_name, sheet_references)
+        cell.formula = formula
+        if self.defer_recalculation:
+            # The formula is evaluated when the cell is read or when recalculate() is called
+            self.dirty_cells.add(cell_name)
         else:
-            # If the formula is not a cell name, it might be a range of cells,
-            # unless it's a SQRT formula
-            dependencies = []
-            if formula.startswith("SQRT"):
-                # Iterate over the formula to find the opening parenthesis
-                for index in range(len(formula)):
-                    if formula[index] == "(":
-                        # Remove the operation and the opening parenthesis from the formula
-                        check_formula = formula[index + 1:]
-                        # Remove the closing parenthesis from the formula
-                        check_formula = check_formula.replace(")", "")
-                        if not self.is_valid_cell_name(check_formula):
-                            print("SQRT formula must be in the format 'SQRT(cell)'.\n"
-                                  "For example: 'SQRT(A1)'.")
-                        else:
-                            dependencies.append(check_formula)
-                        break
-            if ":" in formula:
-                cells = self.valid_cells_index(formula)
-                # Get the list of cell names in the range
-                if cells:
-                    dependencies = self.get_range_cells(cells[0], cells[1])
+            cell.value = self.evaluate_cell(cell_name, cell)
+
+    def formula_dependencies(self, formula: str) -> List[str]:
+        """
+        Finds the names of the cells of the spreadsheet that a formula refers to.
+        for example: "A1+B2" -> ["A1", "B2"], "SUM(A1:A3)" -> ["A1", "A2", "A3"]
+        References to other sheets are found by formula_sheet_references.
+
+        :param formula: The formula, without the "=" sign.
+        :return: A list of the cell names the formula depends on. Empty if the formula is not valid.
+        """
+        try:
+            node = parse_formula(formula)
+        except FormulaSyntaxError:
+            return []
+        dependencies = []
+        for reference in formula_references(node):
+            if reference.sheet is not None:
+                continue
+            if isinstance(reference, CellRef):
+                dependencies.append(reference.name)
             else:
-                # If the formula is not a range of cells, it might be a single cell
-                for index, sign in enumerate(formula):
-                    if sign in ['*', '/', '+', '-']:
-                        parts = [formula[:index], sign, formula[index + 1]]
-                        if self.is_valid_cell_name(parts[0]):
-                            dependencies.append(parts[0])
-                        if self.is_valid_cell_name(parts[2]):
-                            dependencies.append(parts[2])
-                        break
-            if cell_name in dependencies:
-                print("The cell cannot be dependent on itself.")
-                return
-            for dep_name in dependencies:
-                if dep_name not in self.cells:
-                    self.cells[dep_name] = Cell()
-                # Add the cell to the dependents of the referenced cells
-                self.cells[dep_name].add_dependent(cell_name)
-            cell.formula = formula
-            cell.value = cell.calculated_value(self)
-            if cell.value is None:
-                return
+                dependencies.extend(self.get_range_cells(reference.start, reference.end) or [])
+        return dependencies
+
+    def formula_sheet_references(self, formula: str) -> Dict[str, List[str]]:
+        """
+        Finds the cells of other sheets that a formula refers to.
+        for example: "Sheet2!A1+SUM('My Sheet'!B1:B2)" -> {"Sheet2": ["A1"], "My Sheet": ["B1", "B2"]}
+        A reference that names the formula's own sheet is counted as well, since it is resolved by the workbook.
+
+        :param formula: The formula, without the "=" sign.
+        :return: The referenced cell names, by sheet name. Empty if the formula is not valid.
+        """
+        if "!" not in formula:
+            return {}
+        try:
+            node = parse_formula(formula)
+        except FormulaSyntaxError:
+            return {}
+        references: Dict[str, List[str]] = {}
+        for reference in formula_references(node):
+            if reference.sheet is None:
+                continue
+            if isinstance(reference, CellRef):
+                references.setdefault(reference.sheet, []).append(reference.name)
+            else:
+                cell_names = self.get_range_cells(reference.start, reference.end) or []
+                references.setdefault(reference.sheet, []).extend(cell_names)
+        return references
+
+    def update_sheet_references(self, cell_name: str, sheet_references: Dict[str, List[str]]) -> None:
+        """
+        Replaces the cells of other sheets that a formula cell refers to, in the spreadsheet and in its workbook,
+        so a change in one of those cells marks the formula dirty.
+
+        :param cell_name: The name of the formula cell.
+        :param sheet_references: The new references of the cell, see formula_sheet_references.
+        Empty if the cell has no formula anymore.
+        """
+        old_references = self.sheet_references.pop(cell_name, None)
+        if sheet_references:
+            self.sheet_references[cell_name] = sheet_references
+        if self.workbook is not None:
+            if old_references:
+                self.workbook.remove_references(self, cell_name, old_references)
+            if sheet_references:
+                self.workbook.add_references(self, cell_name, sheet_references)
+
+    def sheet_by_name(self, sheet_name: Optional[str]) -> 'Spreadsheet':
+        """
+        Finds the sheet that a reference refers to, in the spreadsheet's workbook.
+
+        :param sheet_name: The name of the sheet, None for the spreadsheet itself.
+        :return: The Spreadsheet object.
+        :raises FormulaErrorException: With #REF! if the workbook has no sheet with that name.
+        """
+        if sheet_name is None:
+            return self
+        sheet = self.workbook.sheets.get(sheet_name) if self.workbook is not None else None
+        if sheet is None:
+            raise FormulaErrorException(REF_ERROR, f"Sheet '{sheet_name}' does not exist.")
+        return sheet
+
+    def mark_dependents_dirty(self, cell_name: str) -> None:
+        """
+        Marks every cell that depends on the given cell, directly or through other cells, as dirty.
+        A dirty cell keeps its last computed value until it is read again, and then it is recalculated.
+        Formulas of other sheets that refer to one of these cells are marked dirty as well, see mark_dirty.
+
+        :param cell_name: The name of the cell that was changed.
+        """
+        sheet_dependents = self.sheet_dependents()
+        stack = [cell_name]
+        while stack:
+            name = stack.pop()
+            if sheet_dependents and name in sheet_dependents:
+                for sheet, dependent in sheet_dependents[name]:
+                    sheet.mark_dirty(dependent)
+            cell = self.cells.get(name)
+            if cell is None:
+                continue
+            for dependent in cell.dependents:
+                # A dirty cell's dependents are already dirty as well
+                if dependent not in self.dirty_cells:
+                    self.dirty_cells.add(dependent)
+                    self.invalidate_ranges(dependent)
+                    stack.append(dependent)
+
+    def mark_dirty(self, cell_name: str) -> None:
+        """
+        Marks a formula dirty because a cell of another sheet that it refers to has changed,
+        and everything that depends on it.
+
+        :param cell_name: The name of the formula cell.
+        """
+        if cell_name in self.dirty_cells:
+            return
+        # The saved values of the sheet are out of date, even though nothing in it was set
+        self.version += 1
+        self.dirty_cells.add(cell_name)
+        self.invalidate_ranges(cell_name)
+        self.mark_dependents_dirty(cell_name)
+
+    def sheet_dependents(self) -> Optional[Dict[str, Set[Tuple['Spreadsheet', str]]]]:
+        """
+        Retrieves the formulas of the workbook that refer to the cells of the spreadsheet by its name.
+
+        :return: The (sheet, cell name) of the formulas, by referenced cell name,
+        or None if the spreadsheet is not in a workbook or nothing refers to it.
+        """
+        if self.workbook is None:
+            return
+        return self.workbook.reference_dependents.get(self.name)
+
+    def rebuild_dependencies(self) -> None:
+        """
+        Rebuilds the dependents of every cell from the formulas in the spreadsheet, in a single pass.
+        Formulas that appear in more than one cell are parsed only once.
+        """
+        dependents: Dict[str, Set[str]] = {}
+        parsed: Dict[str, List[str]] = {}
+        for cell_name in list(self.sheet_references):
+            self.update_sheet_references(cell_name, {})
+        for cell_name, cell in self.cells.items():
+            if not cell.formula:
+                continue
+            if "!" in cell.formula:
+                self.update_sheet_references(cell_name, self.formula_sheet_references(cell.formula))
+            if cell.formula not in parsed:
+                parsed[cell.formula] = self.formula_dependencies(cell.formula)
+            for dep_name in parsed[cell.formula]:
+                if dep_name in dependents:
+                    dependents[dep_name].add(cell_name)
+                else:
+                    dependents[dep_name] = {cell_name}
+        for cell_name, cell in self.cells.items():
+            cell.dependents = dependents.pop(cell_name, set())
+        # Whatever is left are referenced cells that were never set
+        for dep_name, names in dependents.items():
+            cell = Cell()
+            cell.dependents = names
+            self.cells[dep_name] = cell
 
     def get_cell(self, cell_name: str) -> Any:
         """
@@ -315,7 +633,8 @@ class Spreadsheet:
     def get_cell_value(self, cell_name: str) -> Any:
         """
         Retrieves the value of a cell in the spreadsheet.
-        If the cell has a formula, the formula is evaluated and the result is returned.
+        If the cell has a formula, its computed value is returned,
+        and the formula is evaluated only if the cell is dirty.
 
         :param cell_name: The name of the cell to retrieve the value for.
         :return: The value of the cell, or an error message if the cell does not exist.
@@ -326,136 +645,1021 @@ class Spreadsheet:
             return
         cell = self.get_cell(cell_name)
         if cell:
+            return self.updated_value(cell_name, cell)
+        return
+
+    def updated_value(self, cell_name: str, cell: Cell) -> Any:
+        """
+        Retrieves the value of a cell, recalculating its formula first if the cell is dirty.
+
+        :param cell_name: The name of the cell.
+        :param cell: The Cell object stored under that name.
+        :return: The up-to-date value of the cell.
+        """
+        if cell.formula and cell_name in self.dirty_cells:
+            # A formula that reads the cell while it is calculated, directly or through other cells,
+            # is part of a circular reference and gets #CYCLE!
+            self.dirty_cells.discard(cell_name)
+            cell.value = CYCLE_ERROR
+            too_deep = False
+            depth = getattr(evaluation_state, 'depth', 0)
+            evaluation_state.depth = depth + 1
             try:
-                return cell.calculated_value(self)
+                cell.value = self.evaluate_cell(cell_name, cell)
+            except RecursionError:
+                # The cells in progress are calculated again, by the outermost evaluation
+                self.dirty_cells.add(cell_name)
+                if depth > 0:
+                    raise
+                too_deep = True
+            except FORMULA_EXCEPTIONS as err:
+                self.logger.debug("Error in cell %s: %s", cell_name, err)
+                cell.value = error_of_exception(err)
             except Exception as err:
+                self.logger.warning("Unexpected error in cell %s", cell_name, exc_info=True)
+                cell.value = VALUE_ERROR.with_message(str(err))
+            finally:
+                evaluation_state.depth = depth
+            if too_deep:
+                self.recalculate_chain(cell_name, cell)
+        return cell.value
+
+    def recalculate_chain(self, cell_name: str, cell: Cell) -> None:
+        """
+        Recalculates a cell whose evaluation went deeper than the Python stack allows,
+        like the last cell of a long chain of dirty formulas, each of which reads the one before it.
+        The dirty formulas the cell depends on, directly or not, are found without recursion
+        and recalculated in topological order, so every formula only reads cells that are up to date.
+
+        :param cell_name: The name of the cell.
+        :param cell: The Cell object stored under that name.
+        """
+        chain = {cell_name}
+        pending = [cell_name]
+        while pending:
+            formula = self.cells[pending.pop()].formula
+            for dep_name in self.formula_dependencies(formula):
+                dep_cell = self.cells.get(dep_name)
+                if dep_name not in chain and dep_cell is not None and dep_cell.formula \
+                        and dep_name in self.dirty_cells:
+                    chain.add(dep_name)
+                    pending.append(dep_name)
+        if len(chain) == 1:
+            # Nothing it depends on is dirty, so the formula itself is nested too deeply
+            self.dirty_cells.discard(cell_name)
+            cell.value = NUM_ERROR.with_message(f"The formula of {cell_name} is nested too deeply.")
+            return
+        self.recalculate_cells(chain)
+
+    def evaluate_cell(self, cell_name: str, cell: Cell) -> Any:
+        """
+        Calculates the formula of a cell, recording the time it took when profiling is on.
+
+        :param cell_name: The name of the cell.
+        :param cell: The Cell object stored under that name.
+        :return: The value of the formula.
+        """
+        if self.profiler is None:
+            return cell.calculated_value(self)
+        return self.profiler.measure(self.profiler.cells, cell_name, self, cell.calculated_value, self)
+
+    def start_profiling(self) -> FormulaProfiler:
+        """
+        Starts recording the evaluation count and time of every formula cell and every function.
+        While profiling, runs of copied-down formulas are evaluated cell by cell
+        and compiled formulas go through call_function, so every evaluation is counted.
+
+        :return: The new profiler, see formula_profiler.
+        """
+        self.profiler = FormulaProfiler(self.name)
+        self.compiled_formulas.clear()
+        return self.profiler
+
+    def stop_profiling(self) -> Optional[FormulaProfiler]:
+        """
+        Stops recording evaluation times.
+
+        :return: The profiler with the recorded statistics, or None if profiling was off.
+        """
+        profiler, self.profiler = self.profiler, None
+        self.compiled_formulas.clear()
+        return profiler
+
+    def recalculate(self, parallel: bool = False, workers: Optional[int] = None) -> None:
+        """
+        Recalculates every dirty cell in the spreadsheet, each one once,
+        in an order where every cell is calculated after the cells it depends on.
+
+        :param parallel: If True, groups of cells that do not depend on each other
+        are recalculated on a pool of processes, see parallel_recalc.
+        :param workers: The number of processes, the number of CPUs by default.
+        """
+        cell_names = set(self.dirty_cells)
+        # Cells recalculated by other processes would not be profiled
+        if parallel and self.profiler is None:
+            # Imported here, since the parallel recalculation imports this module
+            from parallel_recalc import recalculate_in_parallel
+            cell_names = recalculate_in_parallel(self, cell_names, workers)
+        self.recalculate_cells(cell_names)
+
+    def recalculate_cells(self, cell_names: Set[str]) -> None:
+        """
+        Recalculates the formulas of the given cells once, in topological order.
+
+        Runs of copied-down formulas are evaluated as one array operation, see formula_vectorizer.
+
+        :param cell_names: The names of the cells to recalculate.
+        """
+        order = None
+        if self.vectorize_formulas and self.profiler is None and len(cell_names) >= VECTORIZE_MIN_RUN:
+            order = vectorized_order(self, cell_names)
+        if order is None:
+            order = self.topological_order(cell_names)
+        for item in order:
+            if isinstance(item, list):
+                if not evaluate_run(self, item):
+                    for cell_name in item:
+                        self.recalculate_cell(cell_name)
+                continue
+            self.recalculate_cell(item)
+
+    def recalculate_cell(self, cell_name: str) -> None:
+        """
+        Recalculates the formula of a single cell, even if the cell is not dirty.
+
+        :param cell_name: The name of the cell to recalculate.
+        """
+        cell = self.cells.get(cell_name)
+        if cell is None:
+            self.dirty_cells.discard(cell_name)
+            return
+        # Mark the cell dirty so updated_value evaluates it even if it was clean
+        if cell.formula:
+            self.dirty_cells.add(cell_name)
+        self.updated_value(cell_name, cell)
+
+    def topological_order(self, cell_names: Set[str]) -> List[str]:
+        """
+        Orders cells so that every cell comes after the cells it depends on, using Kahn's algorithm.
+        Cells that are part of a circular reference are put at the end.
+
+        :param cell_names: The names of the cells to order.
+        :return: A list of the cell names in topological order.
+        """
+        in_degree = dict.fromkeys(cell_names, 0)
+        for cell_name in cell_names:
+            cell = self.cells.get(cell_name)
+            if cell is None:
+                continue
+            for dependent in cell.dependents:
+                if dependent in in_degree:
+                    in_degree[dependent] += 1
+        order = [cell_name for cell_name, degree in in_degree.items() if degree == 0]
+        index = 0
+        while index < len(order):
+            cell = self.cells.get(order[index])
+            index += 1
+            if cell is None:
+                continue
+            for dependent in cell.dependents:
+                if dependent in in_degree:
+                    in_degree[dependent] -= 1
+                    if in_degree[dependent] == 0:
+                        order.append(dependent)
+        if len(order) < len(in_degree):
+            ordered = set(order)
+            order.extend(cell_name for cell_name in in_degree if cell_name not in ordered)
+        return order
+
+    @contextmanager
+    def batch(self) -> Iterator['Spreadsheet']:
+        """
+        Groups many changes into one transaction:
+            with spreadsheet.batch():
+                spreadsheet.set_cell('A1', 10)
+                spreadsheet.set_cell('B1', formula='A1*2')
+        Inside the batch, formulas are not evaluated and dependencies are not recorded.
+        When the batch ends, the dependencies of the changed cells are updated
+        and the affected cells are recalculated once, in topological order.
+        If an exception leaves the batch, every change made in it is rolled back.
+        A batch inside another batch joins the outer one.
+
+        :return: The spreadsheet itself.
+        """
+        with self.lock:
+            if self.batch_changes is not None:
+                yield self
+                return
+            self.batch_changes = {}
+            try:
+                yield self
+            except BaseException:
+                changes, self.batch_changes = self.batch_changes, None
+                self.rollback_batch(changes)
+                raise
+            changes, self.batch_changes = self.batch_changes, None
+            self.commit_batch(changes)
+
+    def set_many(self, items: Iterable[Tuple[str, Optional[Any], Optional[str]]]) -> None:
+        """
+        Sets many cells in one batch, see batch().
+        for example: set_many([("A1", 10, None), ("B1", None, "A1*2")])
+
+        :param items: (cell name, value, formula) triples, like the arguments of set_cell.
+        """
+        with self.batch():
+            for cell_name, value, formula in items:
+                self.set_cell(cell_name, value, formula)
+
+    def record_batch_change(self, cell_name: str) -> None:
+        """
+        Remembers the state of a cell before the open batch first changes it, so the batch can be rolled back.
+
+        :param cell_name: The name of the cell that is about to change.
+        """
+        if cell_name not in self.batch_changes:
+            cell = self.cells.get(cell_name)
+            if cell is None:
+                self.batch_changes[cell_name] = None
+            else:
+                self.batch_changes[cell_name] = (cell.value, cell.formula, cell_name in self.dirty_cells)
+
+    def set_cell_in_batch(self, cell_name: str, value: Optional[Any], formula: Optional[str]) -> None:
+        """
+        Sets the value or formula of a cell inside an open batch,
+        without evaluating the formula or recording its dependencies.
+        A formula that cannot be parsed is not set, like in set_cell_formula.
+
+        :param cell_name: The name of the cell to set.
+        :param value: The value to set in the cell.
+        :param formula: The formula to set in the cell.
+        """
+        if isinstance(formula, str):
+            try:
+                parse_formula(formula)
+            except FormulaSyntaxError as err:
                 print(f"Error: {str(err)}")
                 return
-        return
+        self.record_batch_change(cell_name)
+        self.invalidate_ranges(cell_name)
+        if cell_name not in self.cells:
+            self.cells[cell_name] = Cell()
+        cell = self.cells[cell_name]
+        if value is not None:
+            cell.formula = None
+            self.set_cell_value(cell, value)
+        if isinstance(formula, int) or isinstance(formula, float):
+            cell.value = formula
+            cell.formula = None
+        elif formula is not None:
+            cell.formula = formula
+
+    def commit_batch(self, changes: Dict[str, Optional[Tuple[Any, Optional[str], bool]]]) -> None:
+        """
+        Updates the dependencies of the cells changed in a batch and recalculates the affected cells.
+
+        :param changes: The state of every changed cell before the batch, as recorded by record_batch_change.
+        """
+        for cell_name, before in changes.items():
+            cell = self.cells[cell_name]
+            old_formula = before[1] if before is not None else None
+            if cell.formula == old_formula:
+                continue
+            if old_formula:
+                for dep_name in self.formula_dependencies(old_formula):
+                    if dep_name in self.cells:
+                        self.cells[dep_name].remove_dependent(cell_name)
+            if not cell.formula:
+                self.update_sheet_references(cell_name, {})
+                continue
+            dependencies = self.formula_dependencies(cell.formula)
+            sheet_references = self.formula_sheet_references(cell.formula)
+            if cell_name in dependencies or cell_name in sheet_references.get(self.name, []):
+                print("The cell cannot be dependent on itself.")
+                # Keep what the cell had before the batch, like set_cell does
+                dependencies = self.formula_dependencies(old_formula) if old_formula else []
+                sheet_references = self.formula_sheet_references(old_formula) if old_formula else {}
+                cell.value, cell.formula = (before[0], before[1]) if before is not None else (None, None)
+            self.update_sheet_references(cell_name, sheet_references)
+            for dep_name in dependencies:
+                if dep_name not in self.cells:
+                    self.cells[dep_name] = Cell()
+                self.cells[dep_name].add_dependent(cell_name)
+
+        # The changed cells and everything that depends on them
+        affected = set()
+        sheet_dependents = self.sheet_dependents()
+        stack = list(changes.keys())
+        while stack:
+            cell_name = stack.pop()
+            if cell_name in affected:
+                continue
+            affected.add(cell_name)
+            self.invalidate_ranges(cell_name)
+            if sheet_dependents and cell_name in sheet_dependents:
+                for sheet, dependent in sheet_dependents[cell_name]:
+                    sheet.mark_dirty(dependent)
+            stack.extend(self.cells[cell_name].dependents)
+        self.recalculate_cells({cell_name for cell_name in affected if self.cells[cell_name].formula})
+        for cell_name in affected:
+            self.dirty_cells.discard(cell_name)
+
+    def rollback_batch(self, changes: Dict[str, Optional[Tuple[Any, Optional[str], bool]]]) -> None:
+        """
+        Undoes every change made in a batch.
+        The dependencies were not touched inside the batch, so only the cells themselves are restored.
+
+        :param changes: The state of every changed cell before the batch, as recorded by record_batch_change.
+        """
+        for cell_name, before in changes.items():
+            self.invalidate_ranges(cell_name)
+            if before is None:
+                del self.cells[cell_name]
+                self.dirty_cells.discard(cell_name)
+                continue
+            cell = self.cells[cell_name]
+            cell.value, cell.formula, was_dirty = before
+            if was_dirty:
+                self.dirty_cells.add(cell_name)
+            else:
+                self.dirty_cells.discard(cell_name)
+        # Cells may have been deleted, so the used range and the compiled formulas
+        # that read the deleted cells have to be computed again
+        self.used_range_cache = None
+        self.compiled_formulas.clear()
+        self.version += 1
 
     def regular_formula(self, formula: str) -> Any:
         """
-        regular formula stands for formulas with one/two cells and regular operation (*,/,+,-)
-        for example: "A1/A2", "A3*4"
+        regular formula stands for formulas of numbers, cells and regular operations (*,/,+,-),
+        with parentheses and functions as well, for example: "A1/A2", "A3*4", "-(A1+A2)*SUM(B1:B3)/2"
+        It is evaluated the same way as any other formula.
 
         :param formula: a string with the formula
         :return: the answer of the formula. if the formula doesn't meet the string requirements, None.
         """
-        # Iterate over the formula to find the opening parenthesis
-        for index in range(len(formula)):
-            if formula[index] == "(":
-                # Remove the operation and the opening parenthesis from the formula
-                formula = formula[index + 1:]
-                break
-        # Remove the closing parenthesis from the formula
-        formula = formula.replace(")", "")
-        if self.is_valid_cell_name(formula):
-            return self.get_cell_value(formula)
-        parts = []
-        for index, sign in enumerate(formula):
-            if sign in ['*', '/', '+', '-']:
-                parts = [formula[:index], sign, formula[index + 1:]]
-        if len(parts) == 3:
-            side1, operation, side2 = parts
-            # Try converting the first operand to a number, if it fails, treat it as a cell reference
-            try:
-                value1 = float(side1)
-            except ValueError:
-                value1 = self.get_cell_value(side1)
-                if not isinstance(value1, int) and not isinstance(value1, float):
-                    return
-            # Repeat the process for the second operand
-            try:
-                value2 = float(side2)
-            except ValueError:
-                value2 = self.get_cell_value(side2)
-                if not isinstance(value2, int) and not isinstance(value2, float):
+        return self.evaluate_formula(formula)
+
+    def evaluate_formula(self, formula: str) -> Any:
+        """
+        Evaluates a formula in the spreadsheet.
+        The formula can combine numbers, cells, the operations +, -, *, / and parentheses,
+        and the special formulas "AVERAGE", "SUM", "MIN", "MAX", and "SQRT", which can be nested.
+        for example: "SUM(A1:A10)/MAX(A1:A10)*2"
+
+        Errors give an error value instead of raising, see formula_errors,
+        and are logged at the debug level to the spreadsheet's logger.
+        Other exceptions are bugs of the spreadsheet itself: they give #VALUE! too,
+        but are logged as warnings with their traceback.
+
+        :param formula: The formula to evaluate.
+        :return: The result of the formula, or an error value if the formula is invalid or cannot be calculated.
+        """
+        try:
+            if self.formula_backend == "compiled":
+                return self.compiled_formula(formula)()
+            return self.evaluate_node(parse_formula(formula))
+        except FORMULA_EXCEPTIONS as err:
+            self.logger.debug("Error in formula '%s': %s", formula, err)
+            return error_of_exception(err)
+        except RecursionError:
+            # Inside the evaluation of a cell, updated_value recalculates the cells it depends on in order
+            if getattr(evaluation_state, 'depth', 0) > 0:
+                raise
+            return NUM_ERROR.with_message(f"The formula '{formula}' is nested too deeply.")
+        except Exception as err:
+            self.logger.warning("Unexpected error in formula '%s'", formula, exc_info=True)
+            return VALUE_ERROR.with_message(str(err))
+
+    def compiled_formula(self, formula: str) -> Callable[[], Any]:
+        """
+        Retrieves a formula compiled into closures, compiling it the first time it is used.
+        Cells with the same formula share the compiled function, since cell references are absolute.
+
+        :param formula: The formula to compile.
+        :return: A function without arguments that calculates the formula.
+        :raises FormulaSyntaxError: If the formula is not valid.
+        """
+        function = self.compiled_formulas.get(formula)
+        if function is None:
+            function = compile_formula(parse_formula(formula), self)
+            self.compiled_formulas[formula] = function
+        return function
+
+    def cell_reader(self, cell_name: str) -> Callable[[], Any]:
+        """
+        Creates a function that reads the up-to-date value of a cell, for compiled formulas.
+        The Cell object is looked up once, here, instead of every time the value is read.
+
+        :param cell_name: The name of the cell to read.
+        :return: A function without arguments that returns the value of the cell.
+        """
+        cells = self.cells
+        dirty_cells = self.dirty_cells
+        cell = cells.get(cell_name)
+        if cell is None:
+            # The cell may be created later, so it has to be looked up on every read
+            def read_missing() -> Any:
+                missing_cell = cells.get(cell_name)
+                if missing_cell is None:
                     return
-            if value2 is None or value1 is None:
+                return self.updated_value(cell_name, missing_cell)
+            return read_missing
+
+        def read() -> Any:
+            if cell_name in dirty_cells:
+                return self.updated_value(cell_name, cell)
+            return cell.value
+        return read
+
+    def sheet_cell_reader(self, sheet_name: str, cell_name: str) -> Callable[[], Any]:
+        """
+        Creates a function that reads the up-to-date value of a cell of another sheet, for compiled formulas.
+        The sheet is looked up on every read, since it may be removed from the workbook or added later.
+
+        :param sheet_name: The name of the sheet.
+        :param cell_name: The name of the cell to read.
+        :return: A function without arguments that returns the value of the cell.
+        """
+        def read() -> Any:
+            sheet = self.sheet_by_name(sheet_name)
+            cell = sheet.cells.get(cell_name)
+            if cell is None:
+                return
+            return sheet.updated_value(cell_name, cell)
+        return read
+
+    def evaluate_node(self, node: Any) -> Any:
+        """
+        Evaluates a node of a parsed formula.
+        Operations on empty cells give None, operations on text give #VALUE!,
+        and operations on errors give the same error.
+
+        :param node: The node to evaluate.
+        :return: The value of the node.
+        :raises ValueError: If the node cannot be evaluated, for example a division by zero.
+        """
+        if isinstance(node, (Number, String)):
+            return node.value
+        if isinstance(node, CellRef):
+            sheet = self if node.sheet is None else self.sheet_by_name(node.sheet)
+            cell = sheet.cells.get(node.name)
+            if cell is None:
                 return
+            return sheet.updated_value(node.name, cell)
+        if isinstance(node, BinaryOp):
+            value1 = self.evaluate_node(node.left)
+            value2 = self.evaluate_node(node.right)
+            if not is_number(value1) or not is_number(value2):
+                return operand_error(value1, value2)
             # checks the operation
-            if operation == '+':
+            if node.op == '+':
                 return value1 + value2
-            elif operation == '-':
+            elif node.op == '-':
                 return value1 - value2
-            elif operation == '*':
+            elif node.op == '*':
                 return value1 * value2
-            elif operation == '/':
-                if value2 != 0:
-                    return value1 / value2
-                else:
-                    print("Error: Division by zero.")
-                    return
-            else:
-                print("Unsupported operation.")
+            elif value2 != 0:
+                return value1 / value2
+            return DIV_ZERO
+        if isinstance(node, UnaryOp):
+            value = self.evaluate_node(node.operand)
+            if not is_number(value):
+                return operand_error(value)
+            return -value
+        if isinstance(node, FunctionCall):
+            return self.call_function(node.name, node.args)
+        raise ValueError("A range of cells can only be used inside a function, for example: SUM(A1:A3).")
+
+    def call_function(self, name: str, args: Tuple[Any, ...]) -> Any:
+        """
+        Calculates a special formula.
+        The range functions take ranges, cells and numbers, for example: SUM(A1:A3, B5, 10).
+
+        :param name: The name of the function, in uppercase.
+        :param args: The nodes of the function's arguments.
+        :return: The result of the function.
+        :raises ValueError: If the function does not exist or its arguments are not valid.
+        """
+        if self.profiler is not None:
+            return self.profiler.measure(self.profiler.functions, name, self, self.calculate_function, name, args)
+        return self.calculate_function(name, args)
+
+    def calculate_function(self, name: str, args: Tuple[Any, ...]) -> Any:
+        """
+        Calculates a special formula, see call_function.
+
+        :param name: The name of the function, in uppercase.
+        :param args: The nodes of the function's arguments.
+        :return: The result of the function.
+        :raises ValueError: If the function does not exist or its arguments are not valid.
+        """
+        if name in RANGE_FUNCTIONS:
+            if len(args) == 1 and isinstance(args[0], RangeRef):
+                # The common case of a single range
+                sheet = self.sheet_by_name(args[0].sheet)
+                return getattr(sheet, RANGE_FUNCTIONS[name])(args[0].start, args[0].end)
+            values = self.arguments_values_list(args)
+            if isinstance(values, FormulaError):
+                return values
+            if not values:
                 return
-        else:
-            print("Invalid formula format.")
+            if name == "SUM":
+                return sum(values)
+            if name == "AVERAGE":
+                return sum(values) / len(values)
+            if name == "MIN":
+                return min(values)
+            return max(values)
+        if name in FORMULA_FUNCTIONS:
+            return getattr(self, FORMULA_FUNCTIONS[name])(args)
+        if name == "SQRT":
+            if len(args) != 1:
+                raise ValueError("SQRT formula must be in the format 'SQRT(cell)'. For example: 'SQRT(A1)'.")
+            value = self.evaluate_node(args[0])
+            if not is_number(value):
+                return operand_error(value)
+            if value < 0:
+                return NUM_ERROR
+            return math.sqrt(value)
+        raise FormulaErrorException(NAME_ERROR, f"Unknown function '{name}'.")
+
+    def arguments_values_list(self, args: Tuple[Any, ...]) -> Union[List[float], FormulaError]:
+        """
+        Retrieves a list with all the numbers in the arguments of a range function,
+        the same way cells_values_list does for a single range.
+
+        :param args: The nodes of the function's arguments.
+        :return: list of the numbers in all the arguments, or the first error in them
+        """
+        values = []
+        for value in self.argument_values(args):
+            if is_number(value):
+                values.append(float(value))
+            elif isinstance(value, FormulaError):
+                return value
+        return values
+
+    def argument_values(self, args: Tuple[Any, ...]) -> Iterator[Any]:
+        """
+        Reads the values of a function's arguments one by one, every cell of a range once,
+        without building a list of them.
+
+        :param args: The nodes of the function's arguments.
+        :return: An iterator over the values, including empty cells (None) and text.
+        :raises ValueError: If a range is not valid.
+        """
+        for arg in args:
+            if isinstance(arg, RangeRef):
+                yield from self.sheet_by_name(arg.sheet).range_values(arg.start, arg.end)
+            else:
+                yield self.evaluate_node(arg)
+
+    def argument_numbers(self, args: Tuple[Any, ...]) -> Iterator[float]:
+        """
+        Reads the numbers in a function's arguments one by one, see argument_values.
+
+        :param args: The nodes of the function's arguments.
+        :return: An iterator over the numbers, as floats.
+        :raises FormulaErrorException: If an argument holds an error.
+        """
+        for value in self.argument_values(args):
+            if is_number(value):
+                yield float(value)
+            elif isinstance(value, FormulaError):
+                raise FormulaErrorException(value)
+
+    def range_values(self, start: str, end: str) -> Iterator[Any]:
+        """
+        Reads the values of the cells in a range one by one, column by column.
+
+        :param start: The starting cell name of the range.
+        :param end: The ending cell name of the range.
+        :return: An iterator over the values, None for empty cells.
+        :raises FormulaErrorException: With #REF! if the range is not valid.
+        """
+        cell_names = self.get_range_cells(start, end)
+        if cell_names is None:
+            raise FormulaErrorException(REF_ERROR, f"Invalid cells range '{start}:{end}'.")
+        for cell_name in cell_names:
+            cell = self.cells.get(cell_name)
+            yield None if cell is None else self.updated_value(cell_name, cell)
+
+    def calculate_count(self, args: Tuple[Any, ...]) -> int:
+        """
+        Counts the numbers in the arguments, like COUNT(A1:A10, B3).
+        The numbers of a range are counted by range_statistics, so large ranges are counted from their index.
+
+        :param args: The nodes of the function's arguments.
+        :return: The number of numbers.
+        """
+        count = 0
+        for arg in args:
+            if isinstance(arg, RangeRef):
+                sheet = self.sheet_by_name(arg.sheet)
+                # An invalid range gives #REF!, like in the other range functions
+                sheet.range_bounds(arg)
+                count += sheet.range_statistics(arg.start, arg.end).count
+            elif is_number(self.evaluate_node(arg)):
+                count += 1
+        return count
+
+    def calculate_counta(self, args: Tuple[Any, ...]) -> int:
+        """
+        Counts the values that are not empty in the arguments, numbers and text alike, like COUNTA(A1:A10).
+
+        :param args: The nodes of the function's arguments.
+        :return: The number of values that are not empty.
+        """
+        return sum(1 for value in self.argument_values(args) if value is not None and value != "")
+
+    def calculate_variance(self, args: Tuple[Any, ...]) -> Optional[float]:
+        """
+        Calculates the sample variance of the numbers in the arguments in a single pass, like VAR(A1:A10).
+
+        :param args: The nodes of the function's arguments.
+        :return: The sample variance, or None if there are less than two numbers.
+        """
+        return variance(self.argument_numbers(args))
+
+    def calculate_stdev(self, args: Tuple[Any, ...]) -> Optional[float]:
+        """
+        Calculates the sample standard deviation of the numbers in the arguments, like STDEV(A1:A10).
+
+        :param args: The nodes of the function's arguments.
+        :return: The sample standard deviation, or None if there are less than two numbers.
+        """
+        result = variance(self.argument_numbers(args))
+        if result is None:
             return
+        return math.sqrt(result)
 
-    def evaluate_formula(self, formula: str) -> Any:
+    def calculate_median(self, args: Tuple[Any, ...]) -> Optional[float]:
         """
-        Evaluates a formula in the spreadsheet.
-        The formula can be a regular formula, or a special formula like "AVERAGE", "SUM", "MIN", "MAX", or "SQRT".
+        Finds the median of the numbers in the arguments by selection, without sorting them, like MEDIAN(A1:A10).
 
-        :param formula: The formula to evaluate.
-        :return: The result of the formula, or an error message if the formula is invalid.
+        :param args: The nodes of the function's arguments.
+        :return: The median, or None if there are no numbers.
         """
-        # Check if the formula starts with "AVERAGE"
-        if formula.startswith("AVERAGE"):
-            try:
-                # Extract the range of cells from the formula
-                cells = self.valid_cells_index(formula)
-                # Calculate and return the average of the cells in the range
-                return self.calculate_average(cells[0], cells[1])
-            except Exception as err:
-                print(f"Error: {str(err)}")
-                return
-        # Check if the formula starts with "SUM"
-        if formula.startswith("SUM"):
-            try:
-                # Extract the range of cells from the formula
-                cells = self.valid_cells_index(formula)
-                # Calculate and return the sum of the cells in the range
-                return self.calculate_sum(cells[0], cells[1])
-            except Exception as err:
-                print(f"Error: {str(err)}")
-                return
+        return median(list(self.argument_numbers(args)))
 
-        # Check if the formula starts with "MIN"
-        if formula.startswith("MIN"):
-            try:
-                # Extract the range of cells from the formula
-                cells = self.valid_cells_index(formula)
-                # Find and return the minimum value in the range
-                return self.find_min(cells[0], cells[1])
-            except Exception as err:
-                print(f"Error: {str(err)}")
-                return
+    def calculate_percentile(self, args: Tuple[Any, ...]) -> Optional[float]:
+        """
+        Finds a percentile of numbers by selection, like PERCENTILE(A1:A10, 0.9).
+        The last argument is the percentile, between 0 and 1, and the others are the numbers.
 
-        # Check if the formula starts with "MAX"
-        if formula.startswith("MAX"):
-            try:
-                # Extract the range of cells from the formula
-                cells = self.valid_cells_index(formula)
-                # Find and return the maximum value in the range
-                return self.find_max(cells[0], cells[1])
-            except Exception as err:
-                print(f"Error: {str(err)}")
+        :param args: The nodes of the function's arguments.
+        :return: The percentile, or None if there are no numbers.
+        """
+        if len(args) < 2:
+            raise ValueError("PERCENTILE formula must be in the format 'PERCENTILE(range, k)'. "
+                             "For example: 'PERCENTILE(A1:A10, 0.9)'.")
+        fraction = self.evaluate_node(args[-1])
+        if not is_number(fraction) or not 0 <= fraction <= 1:
+            raise ValueError("The percentile must be a number between 0 and 1.")
+        return percentile(list(self.argument_numbers(args[:-1])), fraction)
+
+    def calculate_sumproduct(self, args: Tuple[Any, ...]) -> float:
+        """
+        Multiplies the cells in the same position of ranges of the same size and sums the products,
+        reading every range once, like SUMPRODUCT(A1:A10, B1:B10). Cells without numbers count as 0.
+
+        :param args: The nodes of the function's arguments, which must be ranges.
+        :return: The sum of the products.
+        """
+        sizes = set()
+        for arg in args:
+            if not isinstance(arg, RangeRef):
+                raise ValueError("SUMPRODUCT formula must be in the format 'SUMPRODUCT(range1, range2, ...)'. "
+                                 "For example: 'SUMPRODUCT(A1:A10, B1:B10)'.")
+            start_col_index, first_row, end_col_index, last_row = self.range_bounds(arg)
+            sizes.add((end_col_index - start_col_index, last_row - first_row))
+        if len(sizes) != 1:
+            raise ValueError("The ranges of SUMPRODUCT must have the same size.")
+        total = 0.0
+        for values in zip(*[self.sheet_by_name(arg.sheet).range_values(arg.start, arg.end) for arg in args]):
+            product = 1.0
+            for value in values:
+                if isinstance(value, FormulaError):
+                    return value
+                if not is_number(value):
+                    product = 0.0
+                    break
+                product *= value
+            total += product
+        return total
+
+    def range_bounds(self, arg: RangeRef) -> Tuple[int, int, int, int]:
+        """
+        Retrieves the first and last column and row of a range.
+
+        :param arg: The node of the range.
+        :return: The first column index, the first row, the last column index and the last row.
+        :raises FormulaErrorException: With #REF! if the range is not valid.
+        """
+        if self.is_valid_cell_name(arg.start) and self.is_valid_cell_name(arg.end):
+            start_col_index, first_row = self.cell_coordinates(arg.start)
+            end_col_index, last_row = self.cell_coordinates(arg.end)
+            if start_col_index <= end_col_index and first_row <= last_row:
+                return start_col_index, first_row, end_col_index, last_row
+        raise FormulaErrorException(REF_ERROR, f"Invalid cells range '{arg.start}:{arg.end}'.")
+
+    def calculate_sumif(self, args: Tuple[Any, ...]) -> float:
+        """
+        Sums the cells that meet a criteria, like SUMIF(A1:A10, ">5") or SUMIF(A1:A10, "apple", B1:B10).
+        With a third range, the cells in the same position of that range are summed instead.
+
+        :param args: The nodes of the function's arguments.
+        :return: The sum of the numbers, 0 if no cell meets the criteria.
+        """
+        return sum(float(value) for value in self.conditional_values("SUMIF", args) if is_number(value))
+
+    def calculate_countif(self, args: Tuple[Any, ...]) -> int:
+        """
+        Counts the cells that meet a criteria, like COUNTIF(A1:A10, "apple").
+
+        :param args: The nodes of the function's arguments.
+        :return: The number of cells that meet the criteria.
+        """
+        if len(args) != 2:
+            raise ValueError("COUNTIF formula must be in the format 'COUNTIF(range, criteria)'. "
+                             "For example: 'COUNTIF(A1:A10, \">5\")'.")
+        return len(self.conditional_cells(args[0], self.evaluate_node(args[1])))
+
+    def calculate_averageif(self, args: Tuple[Any, ...]) -> Any:
+        """
+        Calculates the average of the cells that meet a criteria, like AVERAGEIF(A1:A10, "apple", B1:B10).
+
+        :param args: The nodes of the function's arguments.
+        :return: The average of the numbers, or #DIV/0! if there are no numbers that meet the criteria.
+        """
+        values = [float(value) for value in self.conditional_values("AVERAGEIF", args) if is_number(value)]
+        if not values:
+            return DIV_ZERO.with_message("AVERAGEIF found no numbers that meet the criteria.")
+        return sum(values) / len(values)
+
+    def conditional_values(self, name: str, args: Tuple[Any, ...]) -> List[Any]:
+        """
+        Retrieves the values to aggregate for SUMIF and AVERAGEIF:
+        the values of the cells that meet the criteria, or of the cells in the same position of the third range.
+
+        :param name: The name of the function, for the error message.
+        :param args: The nodes of the function's arguments.
+        :return: The values, including empty cells (None) and text.
+        """
+        if len(args) not in [2, 3] or len(args) == 3 and not isinstance(args[2], RangeRef):
+            raise ValueError(f"{name} formula must be in the format '{name}(range, criteria, [range])'. "
+                             f"For example: '{name}(A1:A10, \">5\", B1:B10)'.")
+        offsets = self.conditional_cells(args[0], self.evaluate_node(args[1]))
+        target = args[-1] if len(args) == 3 else args[0]
+        sheet = self.sheet_by_name(target.sheet)
+        start_col_index, first_row = self.cell_coordinates(target.start)
+        values = []
+        for col_offset, row_offset in offsets:
+            cell_name = f"{self.col_index_to_letter(start_col_index + col_offset)}{first_row + row_offset}"
+            cell = sheet.cells.get(cell_name)
+            values.append(None if cell is None else sheet.updated_value(cell_name, cell))
+        return values
+
+    def conditional_cells(self, arg: Any, criteria: Any) -> List[Tuple[int, int]]:
+        """
+        Finds the cells of a range that meet a criteria.
+        Equality criteria are answered from the value index of every column of the range,
+        in O(matching rows), other criteria scan the range.
+
+        :param arg: The node of the range.
+        :param criteria: The criteria, see parse_criteria.
+        :return: The (column offset, row offset) of every matching cell from the range's first cell,
+        column by column.
+        """
+        if not isinstance(arg, RangeRef):
+            raise ValueError("The first argument of a conditional formula must be a range, for example: A1:A10.")
+        sheet = self.sheet_by_name(arg.sheet)
+        if sheet is not self:
+            # The indexes of a range belong to the range's own sheet
+            return sheet.conditional_cells(arg._replace(sheet=None), criteria)
+        start_col_index, first_row, end_col_index, last_row = self.range_bounds(arg)
+        operator, operand = parse_criteria(criteria)
+        offsets = []
+        if self.index_ranges and operator == "=" and operand is not None:
+            for col_index in range(start_col_index, end_col_index + 1):
+                index = self.column_value_index(self.col_index_to_letter(col_index), first_row, last_row)
+                offsets.extend((col_index - start_col_index, row - first_row)
+                               for row in index.matching_rows(operand, first_row, last_row))
+            return offsets
+        rows = last_row - first_row + 1
+        for position, value in enumerate(self.range_values(arg.start, arg.end)):
+            if matches_criteria(operator, operand, value):
+                offsets.append((position // rows, position % rows))
+        return offsets
+
+    def column_value_index(self, col_letter: str, first_row: int, last_row: int) -> ColumnValueIndex:
+        """
+        Retrieves the value index of a column, building it the first time, or again when a query reaches below it,
+        and indexes its stale rows again.
+        Stale formula cells outside the queried rows that are still dirty stay stale,
+        so they are not calculated out of order.
+
+        :param col_letter: The letter of the column.
+        :param first_row: The first row of the query.
+        :param last_row: The last row of the query.
+        :return: The value index of the column, up to date for the queried rows.
+        """
+        index = self.value_indexes.get(col_letter)
+        if index is None or index.rows < last_row:
+            rows = max(last_row, 2 * index.rows if index is not None else 0)
+            keys = {}
+            stale_rows = []
+            for row in range(1, rows + 1):
+                cell_name = f"{col_letter}{row}"
+                cell = self.cells.get(cell_name)
+                if cell is None:
+                    continue
+                if cell.formula and cell_name in self.dirty_cells:
+                    stale_rows.append(row)
+                else:
+                    keys[row] = value_key(cell.value)
+            index = ColumnValueIndex(rows, keys, stale_rows)
+            self.value_indexes[col_letter] = index
+        for row in list(index.stale):
+            cell_name = f"{col_letter}{row}"
+            cell = self.cells.get(cell_name)
+            if cell is None:
+                index.set_key(row, None)
+            elif first_row <= row <= last_row or not (cell.formula and cell_name in self.dirty_cells):
+                index.set_key(row, value_key(self.updated_value(cell_name, cell)))
+        return index
+
+    def calculate_vlookup(self, args: Tuple[Any, ...]) -> Any:
+        """
+        Looks up a value in the first column of a table and retrieves the cell in the same row of another column,
+        like VLOOKUP(A1, D1:F100, 3, FALSE).
+        The lookup is exact if the last argument is FALSE (or 0), otherwise the first column has to be sorted,
+        and the row of the largest value that is not greater than the looked up value is used.
+
+        :param args: The nodes of the function's arguments.
+        :return: The value of the cell that was found, or #N/A if the value is not found.
+        """
+        return self.table_lookup("VLOOKUP", args, vertical=True)
+
+    def calculate_hlookup(self, args: Tuple[Any, ...]) -> Any:
+        """
+        Looks up a value in the first row of a table and retrieves the cell in the same column of another row,
+        like HLOOKUP(A1, D1:Z3, 2, FALSE). See calculate_vlookup.
+
+        :param args: The nodes of the function's arguments.
+        :return: The value of the cell that was found, or #N/A if the value is not found.
+        """
+        return self.table_lookup("HLOOKUP", args, vertical=False)
+
+    def table_lookup(self, name: str, args: Tuple[Any, ...], vertical: bool) -> Any:
+        """
+        Calculates VLOOKUP or HLOOKUP.
+
+        :param name: The name of the function, for the messages.
+        :param args: The nodes of the function's arguments.
+        :param vertical: True for VLOOKUP, False for HLOOKUP.
+        :return: The value of the cell that was found, or #N/A if the value is not found.
+        :raises ValueError: If the arguments are not valid.
+        """
+        if len(args) not in [3, 4] or not isinstance(args[1], RangeRef):
+            raise ValueError(f"{name} formula must be in the format '{name}(value, table, index, [approximate])'. "
+                             f"For example: '{name}(A1, D1:F100, 2, FALSE)'.")
+        value = self.evaluate_node(args[0])
+        if isinstance(value, FormulaError):
+            return value
+        start_col_index, first_row, end_col_index, last_row = self.range_bounds(args[1])
+        index = self.evaluate_node(args[2])
+        approximate = self.evaluate_node(args[3]) if len(args) == 4 else True
+        size = end_col_index - start_col_index + 1 if vertical else last_row - first_row + 1
+        if not is_number(index) or not 1 <= int(index) <= size:
+            raise ValueError(f"The index of {name} must be between 1 and {size}.")
+        match_type = 1 if approximate else 0
+        sheet = self.sheet_by_name(args[1].sheet)
+        if vertical:
+            offset = sheet.find_in_column(value, self.col_index_to_letter(start_col_index), first_row, last_row,
+                                          match_type)
+            cell_name = f"{self.col_index_to_letter(start_col_index + int(index) - 1)}" \
+                        f"{first_row + (offset or 0)}"
+        else:
+            cell_names = [f"{self.col_index_to_letter(col_index)}{first_row}"
+                          for col_index in range(start_col_index, end_col_index + 1)]
+            offset = sheet.find_in_cells(value, cell_names, match_type)
+            cell_name = f"{self.col_index_to_letter(start_col_index + (offset or 0))}{first_row + int(index) - 1}"
+        if offset is None:
+            return NA_ERROR.with_message(f"{name} did not find {value!r}.")
+        cell = sheet.cells.get(cell_name)
+        return None if cell is None else sheet.updated_value(cell_name, cell)
+
+    def calculate_match(self, args: Tuple[Any, ...]) -> Any:
+        """
+        Finds the position of a value in a range of one column or one row, like MATCH(A1, D1:D100, 0).
+        The match type is 0 for an exact match, 1 (the default) for the largest value that is not greater
+        in an ascending range, and -1 for the smallest value that is not less in a descending range.
+
+        :param args: The nodes of the function's arguments.
+        :return: The position of the value in the range, starting at 1, or #N/A if the value is not found.
+        :raises ValueError: If the arguments are not valid.
+        """
+        if len(args) not in [2, 3] or not isinstance(args[1], RangeRef):
+            raise ValueError("MATCH formula must be in the format 'MATCH(value, range, [match type])'. "
+                             "For example: 'MATCH(A1, D1:D100, 0)'.")
+        value = self.evaluate_node(args[0])
+        if isinstance(value, FormulaError):
+            return value
+        start_col_index, first_row, end_col_index, last_row = self.range_bounds(args[1])
+        match_type = self.evaluate_node(args[2]) if len(args) == 3 else 1
+        if match_type not in [-1, 0, 1]:
+            raise ValueError("The match type of MATCH must be -1, 0 or 1.")
+        sheet = self.sheet_by_name(args[1].sheet)
+        if start_col_index == end_col_index:
+            offset = sheet.find_in_column(value, self.col_index_to_letter(start_col_index), first_row, last_row,
+                                          int(match_type))
+        elif first_row == last_row:
+            offset = sheet.find_in_cells(value, self.get_range_cells(args[1].start, args[1].end), int(match_type))
+        else:
+            raise ValueError("The range of MATCH must be a single column or a single row.")
+        if offset is None:
+            return NA_ERROR.with_message(f"MATCH did not find {value!r}.")
+        return offset + 1
+
+    def calculate_index(self, args: Tuple[Any, ...]) -> Any:
+        """
+        Retrieves the cell in a position of a range, like INDEX(D1:F100, 5, 2).
+        In a range of one column or one row a single position can be given, like INDEX(D1:D100, 5).
+
+        :param args: The nodes of the function's arguments.
+        :return: The value of the cell, or #REF! if the position is outside the range.
+        :raises ValueError: If the arguments are not valid.
+        """
+        if len(args) not in [2, 3] or not isinstance(args[0], RangeRef):
+            raise ValueError("INDEX formula must be in the format 'INDEX(range, row, [column])'. "
+                             "For example: 'INDEX(D1:F100, 5, 2)'.")
+        start_col_index, first_row, end_col_index, last_row = self.range_bounds(args[0])
+        positions = [self.evaluate_node(arg) for arg in args[1:]]
+        if not all(is_number(position) for position in positions):
+            raise ValueError("The positions of INDEX must be numbers.")
+        if len(positions) == 1:
+            # A single position in a range of one row is a column
+            positions = [1, positions[0]] if first_row == last_row else [positions[0], 1]
+        row, col = int(positions[0]), int(positions[1])
+        if not 1 <= row <= last_row - first_row + 1 or not 1 <= col <= end_col_index - start_col_index + 1:
+            return REF_ERROR.with_message("The position of INDEX is outside the range.")
+        cell_name = f"{self.col_index_to_letter(start_col_index + col - 1)}{first_row + row - 1}"
+        sheet = self.sheet_by_name(args[0].sheet)
+        cell = sheet.cells.get(cell_name)
+        return None if cell is None else sheet.updated_value(cell_name, cell)
+
+    def find_in_column(self, value: Any, col_letter: str, first_row: int, last_row: int,
+                       match_type: int) -> Optional[int]:
+        """
+        Finds a value in the rows of a column.
+        Exact matches are found in the value index of the column,
+        other matches with a binary search in a sorted snapshot of the rows, which is kept until one of them changes.
+
+        :param value: The value to find.
+        :param col_letter: The letter of the column.
+        :param first_row: The first row to look in.
+        :param last_row: The last row to look in.
+        :param match_type: 0 for an exact match, 1 or -1 for an approximate match, see calculate_match.
+        :return: The offset of the row that was found from the first row, or None if the value is not found.
+        """
+        if not self.index_ranges:
+            cell_names = [f"{col_letter}{row}" for row in range(first_row, last_row + 1)]
+            return self.find_in_cells(value, cell_names, match_type)
+        key = value_key(value)
+        if match_type == 0:
+            if key is None:
                 return
-        # Check if the formula starts with "SQRT"
-        if formula.startswith("SQRT"):
-            try:
-                # Extract the cell name from the formula
-                formula = formula[5:-1]
-                value = float(self.get_cell_value(formula))
-                return math.sqrt(value)
-            except Exception as err:
-                print(f"Error: {str(err)}")
+            rows = self.column_value_index(col_letter, first_row, last_row).matching_rows(key, first_row, last_row)
+            return rows[0] - first_row if rows else None
+        snapshots = self.lookup_snapshots.setdefault(col_letter, {})
+        snapshot = snapshots.get((first_row, last_row))
+        if snapshot is None:
+            snapshot = SortedSnapshot([value_key(cell_value) for cell_value in
+                                       self.range_values(f"{col_letter}{first_row}", f"{col_letter}{last_row}")])
+            snapshots[first_row, last_row] = snapshot
+        return snapshot.last_matching(key, descending=match_type < 0)
+
+    def find_in_cells(self, value: Any, cell_names: List[str], match_type: int) -> Optional[int]:
+        """
+        Finds a value in a list of cells by reading all of them, for lookups along a row.
+
+        :param value: The value to find.
+        :param cell_names: The names of the cells to look in, in order.
+        :param match_type: 0 for an exact match, 1 or -1 for an approximate match, see calculate_match.
+        :return: The position of the cell that was found in the list, or None if the value is not found.
+        """
+        key = value_key(value)
+        keys = []
+        for cell_name in cell_names:
+            cell = self.cells.get(cell_name)
+            keys.append(None if cell is None else value_key(self.updated_value(cell_name, cell)))
+        if match_type == 0:
+            if key is None or key not in keys:
                 return
-        # If the formula does not start with any of the special keywords,
-        # treat it as a regular formula
-        return self.regular_formula(formula)
+            return keys.index(key)
+        return SortedSnapshot(keys).last_matching(key, descending=match_type < 0)
 
     def cells_values_list(self, start: str, end: str) -> Any:
         """
@@ -466,14 +1670,181 @@ class Spreadsheet:
         :return: list of values of all the cells in the range
         """
         cell_names = self.get_range_cells(start, end)
-        # Retrieve values and filtering out cells that do not exist or have None as their value.
+        # Retrieve the numbers, filtering out cells that do not exist or do not contain a number.
         values = []
         for name in cell_names:
-            if self.get_cell_value(name):
-                if isinstance(self.get_cell_value(name), int) or isinstance(self.get_cell_value(name), float):
-                    values.append(float(self.get_cell_value(name)))
+            cell = self.cells.get(name)
+            if cell is None:
+                continue
+            value = self.updated_value(name, cell)
+            if is_number(value):
+                values.append(float(value))
         return values
 
+    def range_statistics(self, start: str, end: str) -> Optional[RangeStatistics]:
+        """
+        Aggregates the numbers in a range of cells.
+        Large ranges are answered from the range indexes of their columns in O(log n) per column,
+        small ranges are scanned directly.
+
+        :param start: The starting cell name of the range.
+        :param end: The ending cell name of the range.
+        :return: The sum, the count, the minimum and the maximum of the numbers in the range
+        and the first error in it, or None if the range is not valid.
+        """
+        if not self.is_valid_cell_name(start) or not self.is_valid_cell_name(end):
+            self.logger.debug("Invalid cell name in the range '%s:%s'.", start, end)
+            return
+        start_col_index, first_row = self.cell_coordinates(start)
+        end_col_index, last_row = self.cell_coordinates(end)
+        if start_col_index > end_col_index or first_row > last_row:
+            self.logger.debug("Invalid cells range. '%s' comes after '%s'.", end, start)
+            return
+        if not self.cache_ranges:
+            return self.calculate_range_statistics(start_col_index, first_row, end_col_index, last_row)
+        key = (start_col_index, first_row, end_col_index, last_row)
+        statistics = self.range_cache.get(key)
+        if statistics is not None:
+            self.range_cache_hits += 1
+            return statistics
+        self.range_cache_misses += 1
+        statistics = self.calculate_range_statistics(start_col_index, first_row, end_col_index, last_row)
+        self.cache_range_statistics(key, statistics)
+        return statistics
+
+    def calculate_range_statistics(self, start_col_index: int, first_row: int,
+                                   end_col_index: int, last_row: int) -> RangeStatistics:
+        """
+        Aggregates the numbers in a valid range of cells, without the range cache.
+
+        :param start_col_index: The index of the range's first column.
+        :param first_row: The range's first row.
+        :param end_col_index: The index of the range's last column.
+        :param last_row: The range's last row.
+        :return: The sum, the count, the minimum and the maximum of the numbers in the range,
+        and the error of the first cell that holds one, beside them so COUNT can ignore it.
+        """
+        cells_count = (end_col_index - start_col_index + 1) * (last_row - first_row + 1)
+        if not self.index_ranges or cells_count < RANGE_INDEX_MIN_CELLS:
+            values = []
+            error = None
+            for value in self.range_values(f"{self.col_index_to_letter(start_col_index)}{first_row}",
+                                           f"{self.col_index_to_letter(end_col_index)}{last_row}"):
+                if is_number(value):
+                    values.append(float(value))
+                elif error is None and isinstance(value, FormulaError):
+                    error = value
+            if not values:
+                return RangeStatistics(0.0, 0, math.inf, -math.inf, error)
+            return RangeStatistics(sum(values), len(values), min(values), max(values), error)
+
+        total, count, minimum, maximum = 0.0, 0, math.inf, -math.inf
+        error = None
+        for col_index in range(start_col_index, end_col_index + 1):
+            col_letter = self.col_index_to_letter(col_index)
+            index = self.column_index(col_letter, last_row)
+            for row in index.stale_rows(first_row, last_row):
+                cell_name = f"{col_letter}{row}"
+                cell = self.cells.get(cell_name)
+                index.set_value(row, None if cell is None else self.updated_value(cell_name, cell))
+            if error is None and index.errors:
+                error = index.first_error(first_row, last_row)
+            statistics = index.query(first_row, last_row)
+            total += statistics.total
+            count += statistics.count
+            minimum = min(minimum, statistics.minimum)
+            maximum = max(maximum, statistics.maximum)
+        return RangeStatistics(total, count, minimum, maximum, error)
+
+    def column_index(self, col_letter: str, last_row: int) -> ColumnIndex:
+        """
+        Retrieves the range index of a column, building it the first time the column is queried,
+        or again when a query reaches below the rows it covers.
+        Formula cells that are dirty are marked stale instead of being calculated,
+        so building the index does not calculate cells out of order.
+
+        :param col_letter: The letter of the column.
+        :param last_row: The last row that the index has to cover.
+        :return: The range index of the column.
+        """
+        index = self.range_indexes.get(col_letter)
+        if index is not None and index.size >= last_row:
+            return index
+        # Doubling the rows when the index grows keeps the number of rebuilds logarithmic
+        index = ColumnIndex(max(last_row, 2 * index.size if index is not None else 0))
+        values = {}
+        stale_rows = []
+        errors = {}
+        # The index covers every row up to its size, which is rounded up to a power of two,
+        # so the rows past last_row are loaded too
+        for row in range(1, index.size + 1):
+            cell_name = f"{col_letter}{row}"
+            cell = self.cells.get(cell_name)
+            if cell is None:
+                continue
+            if cell.formula and cell_name in self.dirty_cells:
+                stale_rows.append(row)
+            elif is_number(cell.value):
+                values[row] = float(cell.value)
+            elif isinstance(cell.value, FormulaError):
+                errors[row] = cell.value
+        index.load(values, stale_rows, errors)
+        self.range_indexes[col_letter] = index
+        return index
+
+    def cache_range_statistics(self, key: Tuple[int, int, int, int], statistics: RangeStatistics) -> None:
+        """
+        Stores the aggregates of a range, so formulas with the same range share them.
+        When the cache is full it is emptied, so it never grows without limit.
+
+        :param key: The range, as (first column, first row, last column, last row).
+        :param statistics: The aggregates of the range.
+        """
+        if len(self.range_cache) >= RANGE_CACHE_MAX_ENTRIES:
+            self.range_cache.clear()
+            self.range_cache_columns.clear()
+        self.range_cache[key] = statistics
+        for col_index in range(key[0], key[2] + 1):
+            self.range_cache_columns.setdefault(self.col_index_to_letter(col_index), set()).add(key)
+
+    def range_cache_info(self) -> Dict[str, int]:
+        """
+        Retrieves the counters of the range cache, for monitoring.
+
+        :return: The number of hits, misses and cached ranges.
+        """
+        return {'hits': self.range_cache_hits, 'misses': self.range_cache_misses, 'entries': len(self.range_cache)}
+
+    def invalidate_ranges(self, cell_name: str) -> None:
+        """
+        Called before the value of a cell may change.
+        Marks the cell as stale in the range index and the value index of its column, if there are,
+        and drops the cached aggregates and lookup snapshots of the ranges that contain it.
+
+        :param cell_name: The name of the cell.
+        """
+        if not self.range_indexes and not self.range_cache and not self.value_indexes and not self.lookup_snapshots:
+            return
+        col_letter = cell_name.rstrip(ALL_DIGITS)
+        row = int(cell_name[len(col_letter):])
+        index = self.range_indexes.get(col_letter)
+        if index is not None:
+            index.mark_stale(row)
+        value_index = self.value_indexes.get(col_letter)
+        if value_index is not None:
+            value_index.mark_stale(row)
+        snapshots = self.lookup_snapshots.get(col_letter)
+        if snapshots:
+            for rows in [rows for rows in snapshots if rows[0] <= row <= rows[1]]:
+                del snapshots[rows]
+        keys = self.range_cache_columns.get(col_letter)
+        if not keys:
+            return
+        for key in [key for key in keys if key[1] <= row <= key[3]]:
+            del self.range_cache[key]
+            for col_index in range(key[0], key[2] + 1):
+                self.range_cache_columns[self.col_index_to_letter(col_index)].discard(key)
+
     def find_min(self, start: str, end: str) -> Any:
         """
         finds the minimum cell value in a specific range that was given
@@ -482,10 +1853,14 @@ class Spreadsheet:
         :param end: The ending cell name of the range.
         :return: float: the minimum value in the range.
         """
-        cell_names = self.cells_values_list(start, end)
-        if cell_names:
-            return min(cell_names)
-        return
+        statistics = self.range_statistics(start, end)
+        if statistics is None:
+            return REF_ERROR
+        if statistics.error is not None:
+            return statistics.error
+        if not statistics.count:
+            return
+        return statistics.minimum
 
     def find_max(self, start: str, end: str) -> Any:
         """
@@ -495,10 +1870,14 @@ class Spreadsheet:
         :param end: The ending cell name of the range.
         :return: float: the maximum value in the range.
         """
-        cell_names = self.cells_values_list(start, end)
-        if cell_names:
-            return max(cell_names)
-        return
+        statistics = self.range_statistics(start, end)
+        if statistics is None:
+            return REF_ERROR
+        if statistics.error is not None:
+            return statistics.error
+        if not statistics.count:
+            return
+        return statistics.maximum
 
     def calculate_sum(self, start: str, end: str) -> Any:
         """
@@ -508,13 +1887,14 @@ class Spreadsheet:
         :param end: The ending cell name of the range.
         :return: float: the sum of all the values in the range.
         """
-        values_list = self.cells_values_list(start, end)
-        if values_list:
-            try:
-                return sum(values_list)
-            except Exception as err:
-                return f"Error: {str(err)}"
-        return
+        statistics = self.range_statistics(start, end)
+        if statistics is None:
+            return REF_ERROR
+        if statistics.error is not None:
+            return statistics.error
+        if not statistics.count:
+            return
+        return statistics.total
 
     def valid_cells_index(self, formula: str) -> Any:
         """
@@ -550,13 +1930,14 @@ class Spreadsheet:
         :return None if any cell was not found, else,
         The average value of the cells in the range, ignoring cells without a value.
         """
-        values_list = self.cells_values_list(start, end)
-        if values_list:
-            try:
-                return sum(values_list) / len(values_list)
-            except Exception as err:
-                print(f"Error: {str(err)}")
-        return
+        statistics = self.range_statistics(start, end)
+        if statistics is None:
+            return REF_ERROR
+        if statistics.error is not None:
+            return statistics.error
+        if not statistics.count:
+            return
+        return statistics.total / statistics.count
 
     def col_letter_to_index(self, col: str) -> int:
         """
@@ -595,14 +1976,14 @@ class Spreadsheet:
         :return List[str]: A list of cell names within the specified range.
         """
         if not self.is_valid_cell_name(start) or not self.is_valid_cell_name(end):
-            print(f"Invalid cell name. Cell names must be in the format 'A1', 'B2', 'AZ10' etc.")
+            self.logger.debug("Invalid cell name in the range '%s:%s'.", start, end)
             return
         # Use regular expressions to separate the letters and digits in each cell
         start_match = re.match(r"([A-Z]+)([0-9]+)", start)
         end_match = re.match(r"([A-Z]+)([0-9]+)", end)
 
         if start_match is None or end_match is None:
-            print(f"Invalid cell name. Cell names must be in the format 'A1', 'B2', 'AZ10' etc.")
+            self.logger.debug("Invalid cell name in the range '%s:%s'.", start, end)
             return
 
         start_col, start_row = start_match.groups()
@@ -611,16 +1992,14 @@ class Spreadsheet:
         start_col_index = self.col_letter_to_index(start_col)
         end_col_index = self.col_letter_to_index(end_col)
 
-        if start_col_index > end_col_index or start_row > end_row:
-            print(f"Invalid cells range. '{end}' comes after '{start}")
+        if start_col_index > end_col_index or int(start_row) > int(end_row):
+            self.logger.debug("Invalid cells range. '%s' comes after '%s'.", end, start)
             return
         # Creates the list of all the indexes as strings.
         cells = []
         for col in range(start_col_index, end_col_index + 1):
-            for row in range(int(start_row), int(end_row) + 1):
-                col_letter = self.col_index_to_letter(col)
-                cell_name = f"{col_letter}{row}"
-                cells.append(cell_name)
+            col_letter = self.col_index_to_letter(col)
+            cells.extend([f"{col_letter}{row}" for row in range(int(start_row), int(end_row) + 1)])
         return cells
 
     def remove_cell(self, cell_name: str) -> None:
@@ -631,16 +2010,27 @@ class Spreadsheet:
         :param cell_name: The name of the cell to remove.
         """
         if cell_name in self.cells:
-            cell = self.get_cell(cell_name)
-            if cell.formula:
-                # If the cell has a formula, it might be a dependent of other cells
-                for other_cell in self.cells.values():
-                    if cell_name in other_cell.dependents:
-                        # If the cell is a dependent of another cell, remove it
-                        other_cell.remove_dependent(cell_name)
-            # remove the cell's arguments
-            cell.value = None
-            cell.formula = None
+            with self.lock:
+                self.version += 1
+                self.invalidate_ranges(cell_name)
+                if self.batch_changes is not None:
+                    self.record_batch_change(cell_name)
+                    self.cells[cell_name].value = None
+                    self.cells[cell_name].formula = None
+                    return
+                cell = self.get_cell(cell_name)
+                if cell.formula:
+                    # If the cell has a formula, it might be a dependent of other cells
+                    for other_cell in self.cells.values():
+                        if cell_name in other_cell.dependents:
+                            # If the cell is a dependent of another cell, remove it
+                            other_cell.remove_dependent(cell_name)
+                    self.update_sheet_references(cell_name, {})
+                # remove the cell's arguments
+                cell.value = None
+                cell.formula = None
+                self.dirty_cells.discard(cell_name)
+                self.mark_dependents_dirty(cell_name)
 
     def max_row(self) -> int:
         """
@@ -651,8 +2041,7 @@ class Spreadsheet:
         # If there are no cells, return 0
         if not self.cells:
             return 0
-        rows = [int(cell.lstrip(ALL_LETTERS)) for cell in self.cells.keys()]
-        return max(rows)
+        return self.used_range()[1]
 
     def max_col_index(self) -> int:
         """
@@ -663,32 +2052,46 @@ class Spreadsheet:
         # If there are no cells, return 0
         if not self.cells:
             return 0
-        cols = [self.col_letter_to_index(cell.rstrip(ALL_DIGITS)) for cell in self.cells.keys()]
-        return max(cols)
+        return self.used_range()[0]
 
     def to_dict(self) -> Dict[str, Dict[str, Any]]:
         """
         Converts the spreadsheet to a dictionary.
+        Blank cells are left out, like the empty cells that a range formula refers to.
 
         :return: A dictionary representation of the spreadsheet.
         """
         return {
             cell_name: self.update_and_get_cell_dict(cell_name)
-            for cell_name in self.cells.keys()
+            for cell_name, cell in self.cells.items() if not cell.is_blank()
         }
 
     def update_and_get_cell_dict(self, cell_name: str) -> Dict[str, Any]:
         """
-        Updates the value of a cell (if it has a formula) and returns its dictionary representation.
+        Updates the value of a cell (if it has a formula and is dirty) and returns its dictionary representation.
 
         :param cell_name: The name of the cell to update and convert to a dictionary.
         :return: A dictionary representation of the cell.
         """
         cell = self.cells[cell_name]
-        if cell.formula:
-            cell.value = cell.calculated_value(self)
+        self.updated_value(cell_name, cell)
         return cell.to_dict()
 
+    def snapshot(self) -> 'Spreadsheet':
+        """
+        Creates a detached copy of the spreadsheet that can be serialised on another thread.
+        Every cell is copied while the sheet is locked,
+        so changes made to this spreadsheet afterwards do not affect the snapshot.
+
+        :return: A new Spreadsheet instance holding copies of the cells.
+        """
+        with self.lock:
+            copy = Spreadsheet(self.name, self.formula_backend)
+            copy.cells = {cell_name: cell.copy() for cell_name, cell in self.cells.items()}
+            copy.dirty_cells = set(self.dirty_cells)
+            copy.version = self.version
+            return copy
+
     def create_graph(self, graph_type: str, x_range: str, y_range: str) -> None:
         """
         Creates a graph based on the values of the cells in two ranges in the spreadsheet.
@@ -697,6 +2100,8 @@ class Spreadsheet:
         :param x_range: The range of cells to use for the x-axis of the graph.
         :param y_range: The range of cells to use for the y-axis of the graph.
         """
+        # matplotlib takes a long time to import, so it is only imported when a graph is created
+        import matplotlib.pyplot as plt  # type: ignore
         try:
             # Get the cell names for the x and y data
             x_cells = self.get_range_cells(*x_range.split(':'))
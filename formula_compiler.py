@@ -0,0 +1,122 @@
+import math
+from typing import *
+from formula_parser import *
+from formula_errors import *
+
+if TYPE_CHECKING:
+    from electronic_sheet import Spreadsheet
+
+
+def compile_formula(node: Any, spreadsheet: 'Spreadsheet') -> Callable[[], Any]:
+    """
+    Compiles a parsed formula into nested closures.
+    Cell references are resolved once, when the formula is compiled, to a reader of the Cell object,
+    so evaluating the formula does not walk the tree, parse cell names or look cells up by name.
+    The result is the same as Spreadsheet.evaluate_node for the same tree.
+
+    :param node: The root node of the parsed formula.
+    :param spreadsheet: The spreadsheet the formula belongs to.
+    :return: A function without arguments that calculates the formula.
+    It gives the same error values, and raises ValueError in the same cases, that evaluate_node does.
+    """
+    if isinstance(node, (Number, String)):
+        value = node.value
+        return lambda: value
+    if isinstance(node, CellRef):
+        if node.sheet is not None:
+            return spreadsheet.sheet_cell_reader(node.sheet, node.name)
+        return spreadsheet.cell_reader(node.name)
+    if isinstance(node, BinaryOp):
+        return compile_binary_op(node.op, compile_formula(node.left, spreadsheet),
+                                 compile_formula(node.right, spreadsheet))
+    if isinstance(node, UnaryOp):
+        operand = compile_formula(node.operand, spreadsheet)
+
+        def negate() -> Any:
+            value = operand()
+            if not isinstance(value, (int, float)):
+                return operand_error(value)
+            return -value
+        return negate
+    if isinstance(node, FunctionCall):
+        return compile_function(node, spreadsheet)
+
+    def invalid_range() -> Any:
+        raise ValueError("A range of cells can only be used inside a function, for example: SUM(A1:A3).")
+    return invalid_range
+
+
+def compile_binary_op(op: str, left: Callable[[], Any], right: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    Compiles an operation on two operands. Every operation gets its own closure,
+    so the operation sign is not checked again on every evaluation.
+
+    :param op: The operation sign: +, -, * or /.
+    :param left: The compiled left operand.
+    :param right: The compiled right operand.
+    :return: A function without arguments that calculates the operation.
+    """
+    if op == '+':
+        def add() -> Any:
+            value1, value2 = left(), right()
+            if not isinstance(value1, (int, float)) or not isinstance(value2, (int, float)):
+                return operand_error(value1, value2)
+            return value1 + value2
+        return add
+    if op == '-':
+        def subtract() -> Any:
+            value1, value2 = left(), right()
+            if not isinstance(value1, (int, float)) or not isinstance(value2, (int, float)):
+                return operand_error(value1, value2)
+            return value1 - value2
+        return subtract
+    if op == '*':
+        def multiply() -> Any:
+            value1, value2 = left(), right()
+            if not isinstance(value1, (int, float)) or not isinstance(value2, (int, float)):
+                return operand_error(value1, value2)
+            return value1 * value2
+        return multiply
+
+    def divide() -> Any:
+        value1, value2 = left(), right()
+        if not isinstance(value1, (int, float)) or not isinstance(value2, (int, float)):
+            return operand_error(value1, value2)
+        if value2 != 0:
+            return value1 / value2
+        return DIV_ZERO
+    return divide
+
+
+def compile_function(node: FunctionCall, spreadsheet: 'Spreadsheet') -> Callable[[], Any]:
+    """
+    Compiles a function call.
+    A range function of a single range of the formula's own sheet is bound to the spreadsheet's method for it,
+    SQRT gets a compiled argument, and any other call is handed to Spreadsheet.call_function.
+    While the spreadsheet is profiled, every call is handed to Spreadsheet.call_function, which records it.
+
+    :param node: The node of the function call.
+    :param spreadsheet: The spreadsheet the formula belongs to.
+    :return: A function without arguments that calculates the function call.
+    """
+    name, args = node.name, node.args
+    if spreadsheet.profiler is not None:
+        call_function = spreadsheet.call_function
+        return lambda: call_function(name, args)
+    if name in RANGE_FUNCTIONS and len(args) == 1 and isinstance(args[0], RangeRef) and args[0].sheet is None:
+        method = getattr(spreadsheet, RANGE_FUNCTIONS[name])
+        start, end = args[0].start, args[0].end
+        return lambda: method(start, end)
+    if name == "SQRT" and len(args) == 1:
+        operand = compile_formula(args[0], spreadsheet)
+
+        def square_root() -> Any:
+            value = operand()
+            if not isinstance(value, (int, float)):
+                return operand_error(value)
+            if value < 0:
+                return NUM_ERROR
+            return math.sqrt(value)
+        return square_root
+    call_function = spreadsheet.call_function
+    return lambda: call_function(name, args)
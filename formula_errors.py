@@ -0,0 +1,146 @@
+import logging
+from typing import *
+from formula_parser import FormulaSyntaxError
+
+# The logger of the diagnostics of formula errors. The messages are at the debug level,
+# so errors cost nothing more than a level check unless a handler asks for them
+logger = logging.getLogger("spreadsheet")
+
+
+class FormulaError:
+    """
+    The value of a formula that cannot be calculated, like #DIV/0! in Excel.
+    Errors are ordinary values: they are stored in cells, and an operation or a function
+    that gets an error as an argument gives the same error, so it propagates to every dependent cell.
+    Two errors are equal if they have the same code, whatever their message.
+    """
+    __slots__ = ('code', 'message')
+
+    def __init__(self, code: str, message: Optional[str] = None) -> None:
+        """
+        Initializes an error.
+
+        :param code: The code of the error, one of ERROR_CODES.
+        :param message: What caused the error, for diagnostics.
+        """
+        self.code = code
+        self.message = message
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, FormulaError) and other.code == self.code
+
+    def __hash__(self) -> int:
+        return hash(self.code)
+
+    def __str__(self) -> str:
+        return self.code
+
+    def __repr__(self) -> str:
+        return f"FormulaError('{self.code}')"
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return FormulaError, (self.code, self.message)
+
+    def with_message(self, message: str) -> 'FormulaError':
+        """
+        Creates the same error with a message.
+
+        :param message: What caused the error.
+        :return: The new error.
+        """
+        return FormulaError(self.code, message)
+
+
+DIV_ZERO = FormulaError("#DIV/0!")
+REF_ERROR = FormulaError("#REF!")
+VALUE_ERROR = FormulaError("#VALUE!")
+CYCLE_ERROR = FormulaError("#CYCLE!")
+NA_ERROR = FormulaError("#N/A")
+NAME_ERROR = FormulaError("#NAME?")
+NUM_ERROR = FormulaError("#NUM!")
+
+# Every error by its code, to read errors back from saved files
+ERROR_CODES: Dict[str, FormulaError] = {error.code: error for error in
+                                        [DIV_ZERO, REF_ERROR, VALUE_ERROR, CYCLE_ERROR, NA_ERROR, NAME_ERROR, NUM_ERROR]}
+
+
+class FormulaErrorException(ValueError):
+    """
+    Raised by the parts of a function that cannot return an error value directly, like the reading of a range
+    or the lookup of a sheet. Spreadsheet.evaluate_formula turns it back into its error value.
+    """
+
+    def __init__(self, error: FormulaError, message: Optional[str] = None) -> None:
+        """
+        Initializes the exception.
+
+        :param error: The error value of the formula.
+        :param message: What caused the error, the message of the error value by default.
+        """
+        super().__init__(message or error.message or error.code)
+        self.error = error
+
+
+# The exceptions that mean a formula cannot be calculated, as opposed to a bug of the spreadsheet itself
+FORMULA_EXCEPTIONS = (FormulaErrorException, ArithmeticError, FormulaSyntaxError, ValueError)
+
+
+def error_of_exception(err: Exception) -> FormulaError:
+    """
+    Finds the error value of a formula whose evaluation raised an exception.
+
+    :param err: The exception.
+    :return: The error value, with the message of the exception.
+    """
+    if isinstance(err, FormulaErrorException):
+        error = err.error
+    elif isinstance(err, ZeroDivisionError):
+        error = DIV_ZERO
+    elif isinstance(err, ArithmeticError):
+        # An overflow, like 10^400
+        error = NUM_ERROR
+    elif isinstance(err, FormulaSyntaxError):
+        error = NAME_ERROR
+    else:
+        error = VALUE_ERROR
+    return error.with_message(str(err))
+
+
+def operand_error(value1: Any, value2: Any = None) -> Any:
+    """
+    Finds the result of an operation whose operands are not both numbers:
+    the first error among the operands, #VALUE! if an operand is text, or None if an operand is empty.
+
+    :param value1: The first operand.
+    :param value2: The second operand, None for an operation of one operand.
+    :return: The error, or None.
+    """
+    if isinstance(value1, FormulaError):
+        return value1
+    if isinstance(value2, FormulaError):
+        return value2
+    if isinstance(value1, str) or isinstance(value2, str):
+        return VALUE_ERROR
+    return
+
+
+def stored_value(value: Any) -> Any:
+    """
+    Converts a cell value to the value saved in a file. Errors are saved as their code.
+
+    :param value: The value of a cell.
+    :return: The value to save.
+    """
+    return value.code if isinstance(value, FormulaError) else value
+
+
+def loaded_value(value: Any) -> Any:
+    """
+    Converts a value saved for a formula cell back to the value of the cell, the opposite of stored_value.
+
+    :param value: The saved value.
+    :return: The error of the code if the value is an error code, otherwise the value itself.
+    """
+    if isinstance(value, str):
+        return ERROR_CODES.get(value, value)
+    return value
@@ -0,0 +1,404 @@
+import re
+from functools import lru_cache
+from typing import *
+
+CELL_NAME_ERROR = "Invalid cell name '{}'. Cell names must be in the format 'A1', 'B2', 'AZ10' etc."
+
+# The binary operations and their precedence, a higher number binds stronger
+BINARY_PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2}
+
+# The range functions and the Spreadsheet methods that calculate them for a single range
+RANGE_FUNCTIONS = {"SUM": "calculate_sum", "AVERAGE": "calculate_average", "MIN": "find_min", "MAX": "find_max"}
+
+# The other functions and the Spreadsheet methods that calculate them from the nodes of their arguments
+FORMULA_FUNCTIONS = {"COUNT": "calculate_count", "COUNTA": "calculate_counta", "VAR": "calculate_variance",
+                     "STDEV": "calculate_stdev", "MEDIAN": "calculate_median", "PERCENTILE": "calculate_percentile",
+                     "SUMPRODUCT": "calculate_sumproduct", "SUMIF": "calculate_sumif",
+                     "COUNTIF": "calculate_countif", "AVERAGEIF": "calculate_averageif",
+                     "VLOOKUP": "calculate_vlookup", "HLOOKUP": "calculate_hlookup", "MATCH": "calculate_match",
+                     "INDEX": "calculate_index"}
+
+# The names that stand for numbers, like the last argument of VLOOKUP
+CONSTANT_NAMES = {"TRUE": 1.0, "FALSE": 0.0}
+
+# A cell name that starts with digits, like 2B, is invalid, unless it is a number with an exponent, like 1e3
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<invalid>(?![0-9]+[eE][+-]?[0-9]+(?![A-Za-z0-9_]))[0-9]+[A-Za-z][A-Za-z0-9]*)
+    |(?P<string>"(?:[^"]|"")*")
+    |(?P<sheet>(?:'(?:[^']|'')+'|[A-Za-z_][A-Za-z0-9_.]*)!)
+    |(?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)
+    |(?P<cell>[A-Z]+[0-9]+(?![A-Za-z0-9_]))
+    |(?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+    |(?P<symbol>[-+*/(),:])
+""", re.VERBOSE)
+
+# The sheet names that can be written in a formula without quotes
+PLAIN_SHEET_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_.]*")
+
+
+class FormulaSyntaxError(ValueError):
+    """
+    Raised when a formula cannot be parsed.
+    """
+
+
+class Number(NamedTuple):
+    """
+    A number in a formula, for example: 2.5
+    """
+    value: float
+
+
+class String(NamedTuple):
+    """
+    A text in double quotes in a formula, for example: ">5", used as the criteria of SUMIF
+    """
+    value: str
+
+
+class CellRef(NamedTuple):
+    """
+    A reference to a single cell, for example: A1, or a cell of another sheet: Sheet2!A1
+    """
+    name: str
+    # The name of the sheet, None for a cell of the formula's own sheet
+    sheet: Optional[str] = None
+
+
+class RangeRef(NamedTuple):
+    """
+    A reference to a range of cells, for example: A1:B10, or a range of another sheet: 'My Sheet'!A1:B10
+    """
+    start: str
+    end: str
+    # The name of the sheet, None for a range of the formula's own sheet
+    sheet: Optional[str] = None
+
+
+class UnaryOp(NamedTuple):
+    """
+    An operation on one operand, for example: -A1
+    """
+    op: str
+    operand: Any
+
+
+class BinaryOp(NamedTuple):
+    """
+    An operation on two operands, for example: A1*2
+    """
+    op: str
+    left: Any
+    right: Any
+
+
+class FunctionCall(NamedTuple):
+    """
+    A call to a function, for example: SUM(A1:A10, 5)
+    """
+    name: str
+    args: Tuple[Any, ...]
+
+
+def tokenize(formula: str) -> List[Tuple[str, str]]:
+    """
+    Splits a formula into tokens.
+    for example: "SUM(A1:A3)*2" -> [("name", "SUM"), ("symbol", "("), ("cell", "A1"), ("symbol", ":"), ...]
+
+    :param formula: The formula, without the "=" sign.
+    :return: A list of (kind, text) tuples. Spaces are left out.
+    :raises FormulaSyntaxError: If the formula contains something that is not a valid token.
+    """
+    tokens = []
+    position = 0
+    while position < len(formula):
+        match = TOKEN_PATTERN.match(formula, position)
+        if match is None:
+            raise FormulaSyntaxError(f"Unexpected character '{formula[position]}' in the formula.")
+        kind = match.lastgroup
+        text = match.group()
+        if kind == "invalid":
+            raise FormulaSyntaxError(CELL_NAME_ERROR.format(text))
+        if kind == "cell" and text.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ") == "0":
+            raise FormulaSyntaxError(CELL_NAME_ERROR.format(text))
+        if kind != "space":
+            tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """
+    A precedence climbing parser for formulas.
+    The grammar is:
+        expression := unary (binary-operation unary)*
+        unary      := ("-" | "+") unary | primary
+        primary    := number | string | TRUE | FALSE | [sheet "!"] cell | [sheet "!"] cell ":" cell
+                      | name "(" [argument ("," argument)*] ")" | "(" expression ")"
+    Ranges are only allowed as function arguments.
+    Sheet names that are not a plain name are written in single quotes, for example: 'My Sheet'!A1
+    """
+
+    def __init__(self, formula: str) -> None:
+        """
+        Initializes a new Parser for a formula.
+
+        :param formula: The formula to parse, without the "=" sign.
+        """
+        self.formula = formula
+        self.tokens = tokenize(formula)
+        self.position = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        """
+        Retrieves the next token without consuming it.
+
+        :return: The next token, or None at the end of the formula.
+        """
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self) -> Tuple[str, str]:
+        """
+        Consumes the next token.
+
+        :return: The consumed token.
+        :raises FormulaSyntaxError: At the end of the formula.
+        """
+        token = self.peek()
+        if token is None:
+            raise FormulaSyntaxError("The formula ended unexpectedly.")
+        self.position += 1
+        return token
+
+    def expect(self, symbol: str) -> None:
+        """
+        Consumes the next token, which must be the given symbol.
+
+        :param symbol: The expected symbol.
+        :raises FormulaSyntaxError: If the next token is something else.
+        """
+        kind, text = self.next()
+        if kind != "symbol" or text != symbol:
+            raise FormulaSyntaxError(f"Expected '{symbol}' but found '{text}'.")
+
+    def parse(self) -> Any:
+        """
+        Parses the whole formula.
+
+        :return: The root node of the formula's tree.
+        :raises FormulaSyntaxError: If the formula is not valid.
+        """
+        if not self.tokens:
+            raise FormulaSyntaxError("The formula is empty.")
+        node = self.parse_expression(1)
+        token = self.peek()
+        if token is not None:
+            raise FormulaSyntaxError(f"Unexpected '{token[1]}' in the formula.")
+        return node
+
+    def parse_expression(self, min_precedence: int) -> Any:
+        """
+        Parses operations whose precedence is at least min_precedence.
+        Operations of the same precedence are grouped from the left: "A1-A2-A3" is "(A1-A2)-A3".
+
+        :param min_precedence: The lowest precedence to parse.
+        :return: The node of the expression.
+        """
+        left = self.parse_unary()
+        while True:
+            token = self.peek()
+            if token is None or token[0] != "symbol" or token[1] not in BINARY_PRECEDENCE:
+                return left
+            precedence = BINARY_PRECEDENCE[token[1]]
+            if precedence < min_precedence:
+                return left
+            self.next()
+            right = self.parse_expression(precedence + 1)
+            left = BinaryOp(token[1], left, right)
+
+    def parse_unary(self) -> Any:
+        """
+        Parses a signed operand, for example: -A1, --2
+
+        :return: The node of the operand.
+        """
+        token = self.peek()
+        if token is not None and token[0] == "symbol" and token[1] in ["-", "+"]:
+            self.next()
+            operand = self.parse_unary()
+            if token[1] == "+":
+                return operand
+            if isinstance(operand, Number):
+                return Number(-operand.value)
+            return UnaryOp("-", operand)
+        return self.parse_primary()
+
+    def parse_primary(self) -> Any:
+        """
+        Parses a number, a text, a cell, a function call or an expression in parentheses.
+
+        :return: The node of the operand.
+        """
+        kind, text = self.next()
+        if kind == "number":
+            return Number(float(text))
+        if kind == "string":
+            # Two double quotes inside a text stand for one
+            return String(text[1:-1].replace('""', '"'))
+        following = self.peek()
+        if kind in ["name", "cell"] and following == ("symbol", "("):
+            return self.parse_function(text.upper())
+        if kind == "cell":
+            return CellRef(text)
+        if kind == "sheet":
+            return CellRef(self.expect_cell(), sheet_name(text))
+        if kind == "symbol" and text == "(":
+            node = self.parse_expression(1)
+            self.expect(")")
+            return node
+        if kind == "name" and text.upper() in CONSTANT_NAMES:
+            return Number(CONSTANT_NAMES[text.upper()])
+        if kind == "name":
+            raise FormulaSyntaxError(f"Unknown name '{text}'. Functions need parentheses, for example: SUM(A1:A3).")
+        raise FormulaSyntaxError(f"Unexpected '{text}' in the formula.")
+
+    def parse_function(self, name: str) -> FunctionCall:
+        """
+        Parses the arguments of a function call, after its name.
+
+        :param name: The name of the function.
+        :return: The node of the function call.
+        """
+        self.expect("(")
+        args = []
+        if self.peek() == ("symbol", ")"):
+            self.next()
+            return FunctionCall(name, tuple(args))
+        while True:
+            args.append(self.parse_argument())
+            kind, text = self.next()
+            if kind == "symbol" and text == ")":
+                return FunctionCall(name, tuple(args))
+            if kind != "symbol" or text != ",":
+                raise FormulaSyntaxError(f"Expected ',' or ')' but found '{text}'.")
+
+    def parse_argument(self) -> Any:
+        """
+        Parses a function argument, which can be a range as well as an expression.
+
+        :return: The node of the argument.
+        """
+        sheet = None
+        position = self.position
+        token = self.peek()
+        if token is not None and token[0] == "sheet":
+            sheet = sheet_name(token[1])
+            position += 1
+        if position + 2 < len(self.tokens) and self.tokens[position][0] == "cell" \
+                and self.tokens[position + 1] == ("symbol", ":"):
+            self.position = position
+            start = self.next()[1]
+            self.next()
+            return RangeRef(start, self.expect_cell(), sheet)
+        return self.parse_expression(1)
+
+    def expect_cell(self) -> str:
+        """
+        Consumes the next token, which must be a cell name.
+
+        :return: The cell name.
+        :raises FormulaSyntaxError: If the next token is something else.
+        """
+        kind, text = self.next()
+        if kind != "cell":
+            raise FormulaSyntaxError(CELL_NAME_ERROR.format(text))
+        return text
+
+
+def sheet_name(token: str) -> str:
+    """
+    Retrieves the sheet name of a sheet token.
+    for example: "Sheet2!" -> "Sheet2", "'My Sheet'!" -> "My Sheet", "'Bob''s'!" -> "Bob's"
+
+    :param token: The text of the token, with the "!".
+    :return: The name of the sheet.
+    """
+    name = token[:-1]
+    if name.startswith("'"):
+        # Two single quotes inside a quoted name stand for one
+        return name[1:-1].replace("''", "'")
+    return name
+
+
+def sheet_prefix(name: str) -> str:
+    """
+    Writes the prefix that refers to a sheet in a formula, quoting the name if it is not a plain name.
+    for example: "Sheet2" -> "Sheet2!", "My Sheet" -> "'My Sheet'!"
+
+    :param name: The name of the sheet.
+    :return: The prefix, with the "!".
+    """
+    if PLAIN_SHEET_NAME.fullmatch(name):
+        return f"{name}!"
+    return "'" + name.replace("'", "''") + "'!"
+
+
+def rename_sheet_references(formula: str, old_name: str, new_name: str) -> str:
+    """
+    Rewrites the references of a formula to a sheet that was renamed, leaving everything else as it was.
+    for example: ("Sheet2!A1+A1", "Sheet2", "Data") -> "Data!A1+A1"
+
+    :param formula: The formula, without the "=" sign.
+    :param old_name: The old name of the sheet.
+    :param new_name: The new name of the sheet.
+    :return: The rewritten formula.
+    """
+    pieces = []
+    position = 0
+    while position < len(formula):
+        match = TOKEN_PATTERN.match(formula, position)
+        if match is None:
+            # Not a valid formula, the rest is kept as it is
+            pieces.append(formula[position:])
+            break
+        text = match.group()
+        if match.lastgroup == "sheet" and sheet_name(text) == old_name:
+            text = sheet_prefix(new_name)
+        pieces.append(text)
+        position = match.end()
+    return "".join(pieces)
+
+
+@lru_cache(maxsize=65536)
+def parse_formula(formula: str) -> Any:
+    """
+    Parses a formula into a tree of nodes. Parsed formulas are cached, since the nodes never change.
+    for example: "A1+2*B1" -> BinaryOp('+', CellRef('A1'), BinaryOp('*', Number(2.0), CellRef('B1')))
+
+    :param formula: The formula, without the "=" sign.
+    :return: The root node of the formula's tree.
+    :raises FormulaSyntaxError: If the formula is not valid.
+    """
+    return Parser(formula).parse()
+
+
+def formula_references(node: Any) -> Iterator[Any]:
+    """
+    Finds the cell and range references in a formula's tree, of its own sheet and of other sheets.
+
+    :param node: The root node of the tree.
+    :return: An iterator over the CellRef and RangeRef nodes, from left to right.
+    """
+    if isinstance(node, (CellRef, RangeRef)):
+        yield node
+    elif isinstance(node, UnaryOp):
+        yield from formula_references(node.operand)
+    elif isinstance(node, BinaryOp):
+        yield from formula_references(node.left)
+        yield from formula_references(node.right)
+    elif isinstance(node, FunctionCall):
+        for arg in node.args:
+            yield from formula_references(arg)
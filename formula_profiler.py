@@ -0,0 +1,172 @@
+import json
+import marshal
+import time
+from typing import *
+
+if TYPE_CHECKING:
+    from electronic_sheet import Spreadsheet
+
+# The number of hottest cells the profile command shows by default
+PROFILE_TOP_CELLS = 10
+
+
+class EvaluationStatistics:
+    """
+    The evaluation statistics of one cell or one function.
+    The total time of an evaluation includes the cells and functions it evaluated on the way,
+    and the own time does not, like the cumulative and the total time of cProfile.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initializes statistics without evaluations.
+        """
+        self.count = 0
+        self.total_time = 0.0
+        self.own_time = 0.0
+        self.max_time = 0.0
+        self.cache_hits = 0
+
+    def record(self, elapsed: float, own_time: float, cache_hits: int) -> None:
+        """
+        Adds an evaluation to the statistics.
+
+        :param elapsed: The time the evaluation took, in seconds.
+        :param own_time: The part of that time that was not spent in nested evaluations.
+        :param cache_hits: The range cache hits during the evaluation.
+        """
+        self.count += 1
+        self.total_time += elapsed
+        self.own_time += own_time
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self.cache_hits += cache_hits
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Converts the statistics to a dictionary.
+
+        :return: The count, the total, own and max time and the cache hits.
+        """
+        return {'count': self.count, 'total_time': self.total_time, 'own_time': self.own_time,
+                'max_time': self.max_time, 'cache_hits': self.cache_hits}
+
+
+class FormulaProfiler:
+    """
+    Records how many times every formula cell and every function is evaluated, and how long it takes.
+    A profiler is attached to a spreadsheet by Spreadsheet.start_profiling, and costs nothing when it is not.
+    """
+
+    def __init__(self, sheet_name: Optional[str] = None) -> None:
+        """
+        Initializes an empty profiler.
+
+        :param sheet_name: The name of the profiled sheet, used in the exported files.
+        """
+        self.sheet_name = sheet_name
+        self.cells: Dict[str, EvaluationStatistics] = {}
+        self.functions: Dict[str, EvaluationStatistics] = {}
+        # The time spent in nested evaluations of every evaluation in progress, innermost last
+        self.nested_times: List[float] = []
+
+    def measure(self, statistics: Dict[str, EvaluationStatistics], key: str, spreadsheet: 'Spreadsheet',
+                function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Calls a function and records the time it took under a key.
+
+        :param statistics: The statistics to record in, the cells or the functions.
+        :param key: The name of the cell or the function.
+        :param spreadsheet: The spreadsheet whose range cache hits are counted.
+        :param function: The function to call.
+        :param args: The arguments of the function.
+        :return: The result of the function.
+        """
+        cache_hits = spreadsheet.range_cache_hits
+        self.nested_times.append(0.0)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested_time = self.nested_times.pop()
+            if self.nested_times:
+                self.nested_times[-1] += elapsed
+            entry = statistics.get(key)
+            if entry is None:
+                entry = statistics[key] = EvaluationStatistics()
+            entry.record(elapsed, elapsed - nested_time, spreadsheet.range_cache_hits - cache_hits)
+
+    def hottest_cells(self, count: int = PROFILE_TOP_CELLS) -> List[Tuple[str, EvaluationStatistics]]:
+        """
+        Finds the cells that took the most time.
+
+        :param count: The number of cells to return.
+        :return: The names and statistics of the cells, from the slowest.
+        """
+        cells = sorted(self.cells.items(), key=lambda item: item[1].total_time, reverse=True)
+        return cells[:count]
+
+    def stats(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        Retrieves all the statistics.
+
+        :return: The statistics of every cell and every function, by name, see EvaluationStatistics.to_dict.
+        """
+        return {'cells': {name: entry.to_dict() for name, entry in self.cells.items()},
+                'functions': {name: entry.to_dict() for name, entry in self.functions.items()}}
+
+    def report(self, count: int = PROFILE_TOP_CELLS) -> str:
+        """
+        Creates a table of the hottest cells and of the functions.
+
+        :param count: The number of cells to show.
+        :return: The table as a string.
+        """
+        lines = [f"{'cell':<10}{'count':>8}{'total ms':>12}{'own ms':>12}{'max ms':>12}{'cache hits':>12}"]
+        for name, entry in self.hottest_cells(count):
+            lines.append(self.report_line(name, entry))
+        if self.functions:
+            lines.append("")
+            lines.append(f"{'function':<10}{'count':>8}{'total ms':>12}{'own ms':>12}{'max ms':>12}{'cache hits':>12}")
+            functions = sorted(self.functions.items(), key=lambda item: item[1].total_time, reverse=True)
+            for name, entry in functions:
+                lines.append(self.report_line(name, entry))
+        return "\n".join(lines)
+
+    @staticmethod
+    def report_line(name: str, entry: EvaluationStatistics) -> str:
+        """
+        Creates a line of the report table.
+
+        :param name: The name of the cell or the function.
+        :param entry: Its statistics.
+        :return: The line.
+        """
+        return (f"{name:<10}{entry.count:>8}{entry.total_time * 1000:>12.3f}{entry.own_time * 1000:>12.3f}"
+                f"{entry.max_time * 1000:>12.3f}{entry.cache_hits:>12}")
+
+    def export_json(self, filename: str) -> None:
+        """
+        Saves the statistics to a JSON file.
+
+        :param filename: The name of the file.
+        """
+        with open(filename, 'w') as file:
+            json.dump({'sheet': self.sheet_name, **self.stats()}, file, indent=4)
+
+    def export_pstats(self, filename: str) -> None:
+        """
+        Saves the statistics in the format of cProfile, so they can be read with pstats.Stats(filename)
+        or with tools like snakeviz. Cells are listed as functions of a file named after the sheet,
+        and the functions of the formulas as functions of a file named "functions".
+
+        :param filename: The name of the file.
+        """
+        entries = {}
+        sheet_name = self.sheet_name or "sheet"
+        for file_name, statistics in ((sheet_name, self.cells), ("functions", self.functions)):
+            for name, entry in statistics.items():
+                entries[(file_name, 0, name)] = (entry.count, entry.count, entry.own_time, entry.total_time, {})
+        with open(filename, 'wb') as file:
+            marshal.dump(entries, file)
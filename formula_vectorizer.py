@@ -0,0 +1,273 @@
+from typing import *
+from formula_parser import *
+
+if TYPE_CHECKING:
+    from electronic_sheet import Spreadsheet
+
+# The shortest run of copied-down formulas that is evaluated as one array operation
+VECTORIZE_MIN_RUN = 16
+
+# The numpy module once it was imported, or None if it is not installed
+_numpy: Any = False
+
+
+def numpy_module() -> Any:
+    """
+    Imports numpy the first time it is needed, so the spreadsheet works without it.
+
+    :return: The numpy module, or None if numpy is not installed.
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+
+def relative_template(node: Any, col_index: int, row: int, spreadsheet: 'Spreadsheet') -> Optional[tuple]:
+    """
+    Converts a parsed formula into a template where every cell reference is relative to the formula's cell.
+    Copied-down formulas have the same template, for example: A1*B1 in C1 and A2*B2 in C2.
+    Only numbers, cells of the formula's own sheet, the operations +, -, *, / and SQRT can be evaluated on arrays.
+
+    :param node: The root node of the parsed formula.
+    :param col_index: The column index of the formula's cell.
+    :param row: The row of the formula's cell.
+    :param spreadsheet: The spreadsheet the formula belongs to.
+    :return: The template as nested tuples, or None if the formula cannot be evaluated on arrays.
+    """
+    if isinstance(node, Number):
+        # The exact bits of the number, so 0.0 and -0.0 get different templates
+        return 'num', node.value.hex()
+    if isinstance(node, CellRef) and node.sheet is None:
+        ref_col_index, ref_row = spreadsheet.cell_coordinates(node.name)
+        return 'ref', ref_col_index - col_index, ref_row - row
+    if isinstance(node, BinaryOp):
+        left = relative_template(node.left, col_index, row, spreadsheet)
+        right = relative_template(node.right, col_index, row, spreadsheet)
+        if left is None or right is None:
+            return
+        return 'bin', node.op, left, right
+    if isinstance(node, UnaryOp):
+        operand = relative_template(node.operand, col_index, row, spreadsheet)
+        return None if operand is None else ('neg', operand)
+    if isinstance(node, FunctionCall) and node.name == "SQRT" and len(node.args) == 1:
+        operand = relative_template(node.args[0], col_index, row, spreadsheet)
+        return None if operand is None else ('sqrt', operand)
+    return
+
+
+def template_offsets(template: tuple) -> Iterator[Tuple[int, int]]:
+    """
+    Finds the cell references of a template.
+
+    :param template: A template created by relative_template.
+    :return: An iterator over the (column offset, row offset) of every reference.
+    """
+    kind = template[0]
+    if kind == 'ref':
+        yield template[1], template[2]
+    elif kind == 'bin':
+        yield from template_offsets(template[2])
+        yield from template_offsets(template[3])
+    elif kind in ['neg', 'sqrt']:
+        yield from template_offsets(template[1])
+
+
+def evaluate_template(template: tuple, sources: Dict[Tuple[int, int], Any], numpy: Any) -> Any:
+    """
+    Evaluates a template on arrays of the referenced cells' values.
+    Every operation is done on float64 arrays, element by element,
+    so the results have the same bits as the same operations on Python floats.
+
+    :param template: A template created by relative_template.
+    :param sources: The values of every reference, by its offsets, as float64 arrays.
+    :param numpy: The numpy module.
+    :return: The results, or None if a cell would fail on its own, like a division by zero,
+    and the run has to be evaluated cell by cell to report it.
+    """
+    kind = template[0]
+    if kind == 'num':
+        return float.fromhex(template[1])
+    if kind == 'ref':
+        return sources[template[1], template[2]]
+    if kind == 'neg':
+        operand = evaluate_template(template[1], sources, numpy)
+        return None if operand is None else -operand
+    if kind == 'sqrt':
+        operand = evaluate_template(template[1], sources, numpy)
+        if operand is None or numpy.any(operand < 0):
+            return
+        return numpy.sqrt(operand)
+    op = template[1]
+    left = evaluate_template(template[2], sources, numpy)
+    right = evaluate_template(template[3], sources, numpy)
+    if left is None or right is None:
+        return
+    if op == '+':
+        return left + right
+    if op == '-':
+        return left - right
+    if op == '*':
+        return left * right
+    if numpy.any(right == 0):
+        return
+    return left / right
+
+
+def cell_template(spreadsheet: 'Spreadsheet', cell_name: str, formula: str) -> Tuple[int, int, Optional[tuple]]:
+    """
+    Retrieves the position and the template of a formula cell, computing the template the first time.
+
+    :param spreadsheet: The spreadsheet of the cell.
+    :param cell_name: The name of the cell.
+    :param formula: The cell's formula.
+    :return: The column index, the row and the template (None if the formula cannot be evaluated on arrays).
+    """
+    cached = spreadsheet.formula_templates.get(cell_name)
+    if cached is not None and cached[0] == formula:
+        return cached[1]
+    col_index, row = spreadsheet.cell_coordinates(cell_name)
+    try:
+        template = relative_template(parse_formula(formula), col_index, row, spreadsheet)
+    except FormulaSyntaxError:
+        template = None
+    if template is not None and next(template_offsets(template), None) is None:
+        # A formula without cells has nothing to evaluate on arrays
+        template = None
+    spreadsheet.formula_templates[cell_name] = (formula, (col_index, row, template))
+    return col_index, row, template
+
+
+def formula_runs(spreadsheet: 'Spreadsheet', cell_names: Set[str]) -> List[List[str]]:
+    """
+    Finds runs of copied-down formulas: cells in consecutive rows of one column with the same template.
+    A run whose formulas refer to cells of the same run is left out, since its cells depend on each other.
+
+    :param spreadsheet: The spreadsheet of the cells.
+    :param cell_names: The names of the cells to look in.
+    :return: The runs, each one a list of cell names from top to bottom.
+    """
+    groups: Dict[Tuple[int, tuple], List[Tuple[int, str]]] = {}
+    for cell_name in cell_names:
+        cell = spreadsheet.cells.get(cell_name)
+        if cell is None or not cell.formula:
+            continue
+        col_index, row, template = cell_template(spreadsheet, cell_name, cell.formula)
+        if template is not None:
+            groups.setdefault((col_index, template), []).append((row, cell_name))
+
+    runs = []
+    for (col_index, template), cells in groups.items():
+        if len(cells) < VECTORIZE_MIN_RUN:
+            continue
+        cells.sort()
+        start = 0
+        for index in range(1, len(cells) + 1):
+            if index < len(cells) and cells[index][0] == cells[index - 1][0] + 1:
+                continue
+            length = index - start
+            overlapping = any(col_offset == 0 and abs(row_offset) < length
+                              for col_offset, row_offset in template_offsets(template))
+            if length >= VECTORIZE_MIN_RUN and not overlapping:
+                runs.append([cell_name for _, cell_name in cells[start:index]])
+            start = index
+    return runs
+
+
+def vectorized_order(spreadsheet: 'Spreadsheet', cell_names: Set[str]) -> Optional[List[Any]]:
+    """
+    Orders cells for recalculation like Spreadsheet.topological_order,
+    with every run of copied-down formulas as a single item that comes after everything the run depends on.
+
+    :param spreadsheet: The spreadsheet of the cells.
+    :param cell_names: The names of the cells to order.
+    :return: A list of cell names and runs (lists of cell names) in topological order,
+    or None if there are no runs or the runs cannot be ordered, for example because of a circular reference.
+    """
+    runs = formula_runs(spreadsheet, cell_names)
+    if not runs:
+        return
+    # Every run is one unit and every other cell is a unit of its own
+    units: List[Any] = list(runs)
+    unit_of: Dict[str, int] = {}
+    for index, run in enumerate(runs):
+        for cell_name in run:
+            unit_of[cell_name] = index
+    for cell_name in cell_names:
+        if cell_name not in unit_of:
+            unit_of[cell_name] = len(units)
+            units.append(cell_name)
+
+    edges: List[List[int]] = [[] for _ in units]
+    in_degree = [0] * len(units)
+    for cell_name in cell_names:
+        cell = spreadsheet.cells.get(cell_name)
+        if cell is None:
+            continue
+        unit = unit_of[cell_name]
+        for dependent in cell.dependents:
+            dependent_unit = unit_of.get(dependent)
+            if dependent_unit is None:
+                continue
+            if dependent_unit == unit:
+                if unit < len(runs):
+                    return
+                continue
+            edges[unit].append(dependent_unit)
+            in_degree[dependent_unit] += 1
+
+    order = [unit for unit, degree in enumerate(in_degree) if degree == 0]
+    index = 0
+    while index < len(order):
+        for dependent_unit in edges[order[index]]:
+            in_degree[dependent_unit] -= 1
+            if in_degree[dependent_unit] == 0:
+                order.append(dependent_unit)
+        index += 1
+    if len(order) < len(units):
+        return
+    return [units[unit] for unit in order]
+
+
+def evaluate_run(spreadsheet: 'Spreadsheet', run: List[str]) -> bool:
+    """
+    Evaluates a run of copied-down formulas as one array operation and stores the results in the cells.
+    The run is only evaluated if every referenced cell holds a float,
+    otherwise it is left for the cell by cell evaluation, which handles text, empty cells and errors.
+
+    :param spreadsheet: The spreadsheet of the run.
+    :param run: The names of the run's cells, from top to bottom.
+    :return: True if the run was evaluated, False if it has to be evaluated cell by cell.
+    """
+    numpy = numpy_module()
+    if numpy is None:
+        return False
+    cells = spreadsheet.cells
+    dirty_cells = spreadsheet.dirty_cells
+    col_index, first_row, template = cell_template(spreadsheet, run[0], cells[run[0]].formula)
+    sources = {}
+    for col_offset, row_offset in set(template_offsets(template)):
+        col_letter = spreadsheet.col_index_to_letter(col_index + col_offset)
+        values = []
+        for row in range(first_row + row_offset, first_row + row_offset + len(run)):
+            cell_name = f"{col_letter}{row}"
+            cell = cells.get(cell_name)
+            if cell is None:
+                return False
+            value = spreadsheet.updated_value(cell_name, cell) if cell_name in dirty_cells else cell.value
+            if type(value) is not float:
+                return False
+            values.append(value)
+        sources[col_offset, row_offset] = numpy.array(values, dtype=numpy.float64)
+    with numpy.errstate(all='ignore'):
+        results = evaluate_template(template, sources, numpy)
+    if results is None:
+        return False
+    for cell_name, value in zip(run, results.tolist()):
+        cells[cell_name].value = value
+        dirty_cells.discard(cell_name)
+    return True
@@ -0,0 +1,230 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import *
+from workbook import *
+from workbook_server import WorkbookServer, DEFAULT_HOST
+
+# The number of connections that send requests at the same time
+DEFAULT_CONNECTIONS = 16
+
+# The number of requests of a load test, over all the connections
+DEFAULT_REQUESTS = 2000
+
+# The fraction of the requests that change a cell, the others read a cell or a range
+DEFAULT_WRITE_RATIO = 0.1
+
+# The number of rows of the workbook the load test serves when it starts its own server
+DEFAULT_ROWS = 1000
+
+# The number of rows a range request reads
+RANGE_ROWS = 10
+
+
+class HttpClient:
+    """
+    A minimal HTTP/1.1 client that sends all its requests on one kept-alive connection.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        """
+        Initializes a client. The connection is opened by connect().
+
+        :param host: The address of the server.
+        :param port: The port of the server.
+        """
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self) -> None:
+        """
+        Opens the connection.
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self) -> None:
+        """
+        Closes the connection.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    async def request(self, method: str, path: str, body: Any = None) -> Tuple[int, Any]:
+        """
+        Sends a request and reads its response.
+
+        :param method: The HTTP method, like "GET".
+        :param path: The path of the request, like "/sheets".
+        :param body: The body, which is converted to JSON, or None for a request without a body.
+        :return: The status and the JSON body of the response.
+        """
+        payload = b"" if body is None else json.dumps(body).encode()
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n")
+        self.writer.write(head.encode("latin-1") + payload)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("The server closed the connection.")
+        status = int(status_line.split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        data = await self.reader.readexactly(length) if length else b""
+        return status, json.loads(data) if data else None
+
+
+def load_test_workbook(rows: int) -> Workbook:
+    """
+    Creates the workbook a load test serves: values in column A, formulas on them in column B
+    and a total of column B in C1.
+
+    :param rows: The number of rows.
+    :return: The workbook.
+    """
+    workbook = Workbook("load_test")
+    spreadsheet = Spreadsheet("Sheet1")
+    workbook.attach_sheet("Sheet1", spreadsheet)
+    items = []
+    for row in range(1, rows + 1):
+        items.append((f"A{row}", row, None))
+        items.append((f"B{row}", None, f"A{row}*2"))
+    items.append(("C1", None, f"SUM(B1:B{rows})"))
+    spreadsheet.set_many(items)
+    return workbook
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """
+    Finds a percentile of the latencies, by the nearest rank.
+
+    :param latencies: The latencies, sorted.
+    :param fraction: The percentile as a fraction, like 0.99.
+    :return: The latency, 0 if there are no latencies.
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+async def run_load_test(host: str, port: int, connections: int = DEFAULT_CONNECTIONS,
+                        requests: int = DEFAULT_REQUESTS, write_ratio: float = DEFAULT_WRITE_RATIO,
+                        rows: int = DEFAULT_ROWS, sheet: str = "Sheet1", seed: int = 0) -> Dict[str, Any]:
+    """
+    Sends requests to a server from several kept-alive connections at the same time.
+    Reads ask for a cell of column B or for a range of column A, writes set a cell of column A.
+
+    :param host: The address of the server.
+    :param port: The port of the server.
+    :param connections: The number of connections.
+    :param requests: The number of requests, over all the connections.
+    :param write_ratio: The fraction of the requests that set a cell.
+    :param rows: The number of rows the requests address.
+    :param sheet: The sheet the requests address.
+    :param seed: The seed of the random choice of requests, so runs can be compared.
+    :return: The number of requests and errors, the time, the requests per second and the latency percentiles in ms.
+    """
+    generator = random.Random(seed)
+    plans = []
+    for index in range(requests):
+        row = generator.randint(1, rows)
+        if generator.random() < write_ratio:
+            plans.append(("PUT", f"/sheets/{sheet}/cells/A{row}", {'value': generator.randint(1, 1000)}))
+        elif index % 2:
+            plans.append(("GET", f"/sheets/{sheet}/cells/B{row}", None))
+        else:
+            last = min(rows, row + RANGE_ROWS - 1)
+            plans.append(("GET", f"/sheets/{sheet}/ranges/A{row}:A{last}", None))
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker(plan: List[Tuple[str, str, Any]]) -> None:
+        nonlocal errors
+        client = HttpClient(host, port)
+        await client.connect()
+        try:
+            for method, path, body in plan:
+                start = time.perf_counter()
+                status, _ = await client.request(method, path, body)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors += 1
+        finally:
+            await client.close()
+
+    connections = max(1, min(connections, requests))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(plans[index::connections]) for index in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': errors, 'connections': connections, 'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000}
+
+
+async def run_local_load_test(rows: int = DEFAULT_ROWS, **options: Any) -> Dict[str, Any]:
+    """
+    Starts a server of a load test workbook on a free port of localhost, runs a load test against it and stops it.
+    The server shares the event loop of the clients, so the results include the time of the clients too.
+
+    :param rows: The number of rows of the workbook.
+    :param options: The other arguments of run_load_test.
+    :return: The results of run_load_test.
+    """
+    server = WorkbookServer(load_test_workbook(rows), DEFAULT_HOST, 0)
+    await server.start()
+    try:
+        return await run_load_test(DEFAULT_HOST, server.port, rows=rows, **options)
+    finally:
+        await server.stop()
+
+
+def main(arguments: List[str]) -> None:
+    """
+    Runs a load test from the command line, for example:
+        python load_test.py --connections 32 --requests 10000
+        python load_test.py --port 8080 --rows 500
+
+    Without --port, a server of a generated workbook is started on localhost for the test.
+    With --port, the server should serve a sheet with values in the given number of rows of column A.
+
+    :param arguments: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Measures the requests per second and the latency of a workbook server.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="the address of the server")
+    parser.add_argument("--port", type=int, help="the port of a running server, by default a local one is started")
+    parser.add_argument("--sheet", default="Sheet1", help="the sheet the requests address")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="the number of connections")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="the number of requests")
+    parser.add_argument("--write-ratio", type=float, default=DEFAULT_WRITE_RATIO,
+                        help="the fraction of the requests that set a cell")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="the number of rows the requests address")
+    args = parser.parse_args(arguments)
+
+    options = {'connections': args.connections, 'requests': args.requests,
+               'write_ratio': args.write_ratio, 'rows': args.rows, 'sheet': args.sheet}
+    if args.port is None:
+        results = asyncio.run(run_local_load_test(**options))
+    else:
+        results = asyncio.run(run_load_test(args.host, args.port, **options))
+    print(f"{results['requests']} requests on {results['connections']} connections in {results['seconds']:.3f} s, "
+          f"{results['errors']} errors")
+    print(f"{results['requests_per_second']:.1f} requests per second")
+    print(f"latency: p50 {results['p50_ms']:.3f} ms, p99 {results['p99_ms']:.3f} ms, max {results['max_ms']:.3f} ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
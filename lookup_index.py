@@ -0,0 +1,68 @@
+from typing import *
+
+
+def last_true(count: int, predicate: Callable[[int], bool]) -> Optional[int]:
+    """
+    Binary searches for the last position where a predicate holds,
+    for a predicate that holds up to some position and not after it.
+
+    :param count: The number of positions.
+    :param predicate: The predicate of a position.
+    :return: The last position where the predicate holds, or None if it holds nowhere.
+    """
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(middle):
+            low = middle + 1
+        else:
+            high = middle
+    return low - 1 if low else None
+
+
+class SortedSnapshot:
+    """
+    A copy of the values of a lookup range, split into numbers and texts, for approximate lookups.
+    Like in Excel, the range has to be sorted, ascending or descending,
+    and a lookup finds its position with a binary search in O(log n).
+    Numbers are only looked up among numbers and texts among texts.
+    """
+
+    def __init__(self, keys: List[Any]) -> None:
+        """
+        Initializes a snapshot of a range.
+
+        :param keys: The index key of every cell of the range, in order, see value_key.
+        """
+        self.numbers: List[float] = []
+        self.number_positions: List[int] = []
+        self.texts: List[str] = []
+        self.text_positions: List[int] = []
+        for position, key in enumerate(keys):
+            if isinstance(key, float):
+                self.numbers.append(key)
+                self.number_positions.append(position)
+            elif key is not None:
+                self.texts.append(key)
+                self.text_positions.append(position)
+
+    def last_matching(self, key: Any, descending: bool = False) -> Optional[int]:
+        """
+        Finds the position of the largest value that is not greater than a key in an ascending range,
+        or of the smallest value that is not less than the key in a descending range.
+
+        :param key: The index key to look up.
+        :param descending: True if the range is sorted from the largest value to the smallest.
+        :return: The position in the range, or None if there is no such value.
+        """
+        if isinstance(key, float):
+            values, positions = self.numbers, self.number_positions
+        elif key is not None:
+            values, positions = self.texts, self.text_positions
+        else:
+            return
+        if descending:
+            index = last_true(len(values), lambda middle: values[middle] >= key)
+        else:
+            index = last_true(len(values), lambda middle: values[middle] <= key)
+        return None if index is None else positions[index]
@@ -1,18 +1,43 @@
 import sys
+import time
+import argparse
 from workbook import *
+from autosave import AutoSaver, DEFAULT_AUTOSAVE_INTERVAL
+
+# The size of the part of the sheet that is printed after every change
+VIEWPORT_COLS = 8
+VIEWPORT_ROWS = 40
 
 HELP_TEXT = """
                 The Optional Commands:
                   - set [cell] [value] - Set the value of a cell (value can be a number or words).
                   - set [cell] [formula] - Set the formula for a cell and updates its value.
                             PAY ATTENTION! the formula must start with "=" sign.
-                            the formulas should be combination of numbers and cells only.
+                            the formulas should be combination of numbers, cells, the operations + - * /
+                            and parentheses, for example: =-(A1+A2)*3/B1. the formula must not contain spaces.
                             there are 5 special formulas: 'AVERAGE' 'MIN' 'MAX' 'SUM' 'SQRT'. 
                             these formulas should be typed in a specific form: 
                             for example: =MAX(A1:B2) is correct and set the maximum number in the range of A1 and B2. 
                             for SQRT operator a valid form: =SQRT(A1).
+                            special formulas can be part of a bigger formula: =SUM(A1:A10)/MAX(A1:A10)*2.
+                            statistical formulas: 'COUNT' 'COUNTA' 'VAR' 'STDEV' 'MEDIAN' take ranges and cells,
+                            =PERCENTILE(A1:A10,0.9) takes the percentile last and =SUMPRODUCT(A1:A10,B1:B10)
+                            takes ranges of the same size.
+                            conditional formulas: =SUMIF(A1:A10,"apple",B1:B10), =COUNTIF(B1:B10,">5")
+                            and =AVERAGEIF(A1:A10,"<>apple",B1:B10). texts are written in double quotes.
+                            lookup formulas: =VLOOKUP("apple",A1:C10,3,FALSE), =HLOOKUP(5,A1:J3,2,TRUE),
+                            =MATCH("apple",A1:A10,0) and =INDEX(A1:C10,2,3).
+                            cells of other sheets are written with the sheet's name: =Sheet2!A1*2, =SUM(Sheet2!A1:A10).
+                            a formula that cannot be calculated shows an error, which passes on to the cells that use it:
+                            #DIV/0!, #VALUE!, #REF!, #NAME?, #N/A, #NUM!, or #CYCLE! for a circular reference.
                   - quit - Exit the program with option to save.
-                  - show - shows the spreadsheet in an organized table
+                  - show - shows the visible part of the spreadsheet in an organized table
+                  - show [range] - moves the visible part to a range and shows it, for example: show A1:H40.
+                    'show all' shows the whole spreadsheet.
+                  - scroll [up/down/left/right] [amount] - moves the visible part of the spreadsheet.
+                    without an amount, it moves by a whole page.
+                  - format [number format] - shows numbers in a format and aligns number columns to the right.
+                    for example: 'format .2f' shows two digits after the point. 'format off' shows numbers as they are.
                   - remove [cell] - Removes the cell's value
                   - new - opens a new sheet in your workbook
                   - sheets - if you want to see the sheet's list and choose which sheet to open
@@ -20,6 +45,11 @@ HELP_TEXT = """
                   - 'remove sheet' - if you want to removes a sheet
                   - save - if you want to save the workbook
                   - export - if you want to export the workbook to a different file type
+                  - autosave [seconds] - saves the workbook in the background every few seconds.
+                    'autosave off' turns it off, 'autosave' alone shows the current setting.
+                  - profile on/off - records how many times every formula is evaluated and how long it takes.
+                    'profile [number]' shows the slowest cells of the sheet, 10 by default.
+                    'profile export [file]' saves the statistics, to a JSON file or to a pstats file if it ends with .prof
                   - graph [type] [range1] [range2] - if you want to create a graph. 
                     the graph types are: 'bar', 'pie'. 
                     the first range needs to include one columns that represent the topics of the graph.
@@ -33,9 +63,100 @@ HELP_COMMAND = """
                 Once the workbook is open, you can interact with it by entering various commands:
                 """
 
+BATCH_HELP = """
+                Batch mode runs the commands of a script without asking anything and without printing the sheets:
+                  python main.py --script commands.txt --open workbook.json
+                  python main.py --script - --new workbook --sheet Sheet1 --save   (reads the commands from stdin)
+                The script can contain the following commands, one per line:
+                  - set [cell] [value] / set [cell] =[formula]
+                  - remove [cell]
+                  - new [sheet] - adds a sheet and moves to it
+                  - sheet [sheet] - moves to an existing sheet
+                  - export [csv/pdf/excel/json] - exports the workbook, named after the workbook
+                  - save - saves the workbook
+                Empty lines and lines that start with '#' are skipped.
+                Formulas are evaluated once, at the end of the script.
+                """
+
 VALID_FILE_FORMATS = ["csv", "pdf", "excel"]
 
 
+class Viewport:
+    """
+    Represents the visible part of a sheet, which is the only part that is evaluated and printed,
+    similar to the window of a spreadsheet program.
+    """
+
+    def __init__(self, first_col_index: int = 0, first_row: int = 1,
+                 cols: int = VIEWPORT_COLS, rows: int = VIEWPORT_ROWS) -> None:
+        """
+        Initializes a new Viewport.
+
+        :param first_col_index: The index of the leftmost visible column.
+        :param first_row: The topmost visible row.
+        :param cols: The number of visible columns.
+        :param rows: The number of visible rows.
+        """
+        self.first_col_index = first_col_index
+        self.first_row = first_row
+        self.cols = cols
+        self.rows = rows
+        # A format specification for numbers, for example ".2f", or None to show them as they are
+        self.number_format: Optional[str] = None
+
+    def set_range(self, spreadsheet: Spreadsheet, cells_range: str) -> bool:
+        """
+        Moves and resizes the viewport to a range of cells.
+
+        :param spreadsheet: The spreadsheet the range belongs to.
+        :param cells_range: The range of cells, for example: "A1:H40".
+        :return: True if the range is valid, False otherwise.
+        """
+        cells = cells_range.split(":")
+        if len(cells) != 2 or not all(spreadsheet.is_valid_cell_name(cell) for cell in cells):
+            return False
+        first_col_index, first_row = spreadsheet.cell_coordinates(cells[0])
+        last_col_index, last_row = spreadsheet.cell_coordinates(cells[1])
+        if first_col_index > last_col_index or first_row > last_row:
+            return False
+        self.first_col_index, self.first_row = first_col_index, first_row
+        self.cols, self.rows = last_col_index - first_col_index + 1, last_row - first_row + 1
+        return True
+
+    def scroll(self, direction: str, amount: Optional[int] = None) -> bool:
+        """
+        Moves the viewport, without moving it before the first row or column.
+
+        :param direction: "up", "down", "left" or "right".
+        :param amount: The number of rows or columns to move by. If not provided, a whole page.
+        :return: True if the direction is valid, False otherwise.
+        """
+        if direction == "up":
+            self.first_row = max(1, self.first_row - (amount or self.rows))
+        elif direction == "down":
+            self.first_row += amount or self.rows
+        elif direction == "left":
+            self.first_col_index = max(0, self.first_col_index - (amount or self.cols))
+        elif direction == "right":
+            self.first_col_index += amount or self.cols
+        else:
+            return False
+        return True
+
+    def render(self, spreadsheet: Spreadsheet) -> str:
+        """
+        Generates the table of the visible part of a spreadsheet.
+
+        :param spreadsheet: The spreadsheet to show.
+        :return: A string representing the visible part in a structured table format.
+        """
+        first_cell = f"{spreadsheet.col_index_to_letter(self.first_col_index)}{self.first_row}"
+        last_cell = f"{spreadsheet.col_index_to_letter(self.first_col_index + self.cols - 1)}" \
+                    f"{self.first_row + self.rows - 1}"
+        return spreadsheet.render(first_cell, last_cell, number_format=self.number_format,
+                                  align_numbers=self.number_format is not None)
+
+
 def get_spreadsheet() -> Tuple[Workbook, Spreadsheet]:
     """
     Prompts the user to either open an existing workbook or create a new one.
@@ -93,7 +214,7 @@ def get_spreadsheet() -> Tuple[Workbook, Spreadsheet]:
                 spreadsheet = temp_spreadsheet
                 print(f"You're in {sheet_name} sheet.")
                 print(spreadsheet.name, ": ")
-                print(spreadsheet)
+                print(Viewport().render(spreadsheet))
         except EOFError:
             pass
     else:
@@ -122,18 +243,22 @@ def main() -> None:
     The user can also enter 'quit' to exit the program, with an option to save the workbook before exiting.
     """
     workbook, spreadsheet = get_spreadsheet()
+    viewport = Viewport()
+    autosaver = AutoSaver(workbook, interval=DEFAULT_AUTOSAVE_INTERVAL)
+    autosaver.start()
     while True:
         print("Type 'help' for options, or type a command.")
         try:
             command = input("> ").strip()
         except EOFError:
+            autosaver.stop()
             break
         if command.lower() == "quit":
             try:
                 if input("Are you sure you want to quit? ").lower() == "yes":
                     if input("Would you like to save the workbook? ").lower() == "yes":
                         if workbook.name is not None:
-                            workbook.export_to_json(workbook.name)
+                            autosaver.save_now(force=True)
                         else:
                             try:
                                 filename = input("what file name? ")
@@ -144,6 +269,7 @@ def main() -> None:
                                 continue
                     else:
                         print("exiting workbook... Bye!")
+                        autosaver.stop()
                         break
                 else:
                     continue
@@ -155,7 +281,7 @@ def main() -> None:
 
         if command.lower() == "save":
             if workbook.name is not None:
-                workbook.export_to_json(workbook.name)
+                autosaver.save_now(force=True)
                 print(f"Saved {workbook.name} successfully.")
             else:
                 try:
@@ -237,12 +363,39 @@ def main() -> None:
                 continue
             if spreadsheet.cells != {}:
                 print(spreadsheet.name, ": ")
+                print(viewport.render(spreadsheet))
+            continue
+
+        if command.lower().startswith("show"):
+            command_parts = command.split()
+            if len(command_parts) > 2:
+                print("Invalid command. Please use the format 'show', 'show [range]' or 'show all'.")
+                continue
+            print(spreadsheet.name, ": ")
+            if len(command_parts) == 1:
+                print(viewport.render(spreadsheet))
+            elif command_parts[1].lower() == "all":
                 print(spreadsheet)
+            elif viewport.set_range(spreadsheet, command_parts[1]):
+                print(viewport.render(spreadsheet))
+            else:
+                print("Invalid range. Please use the format 'show A1:H40'.")
             continue
 
-        if command.lower() == "show":
+        if command.lower().startswith("scroll"):
+            command_parts = command.split()
+            try:
+                amount = int(command_parts[2]) if len(command_parts) == 3 else None
+                if len(command_parts) not in [2, 3] or (amount is not None and amount <= 0):
+                    raise ValueError
+            except ValueError:
+                print("Invalid command. Please use the format 'scroll [up/down/left/right] [amount]'.")
+                continue
+            if not viewport.scroll(command_parts[1].lower(), amount):
+                print("Invalid direction. Please use 'up', 'down', 'left' or 'right'.")
+                continue
             print(spreadsheet.name, ": ")
-            print(spreadsheet)
+            print(viewport.render(spreadsheet))
             continue
 
         if command.lower().startswith("remove sheet"):
@@ -260,7 +413,7 @@ def main() -> None:
                 continue
             spreadsheet.remove_cell(cell_name)
             print(spreadsheet.name, ": ")
-            print(spreadsheet)
+            print(viewport.render(spreadsheet))
             continue
 
         if command.lower() == "new":
@@ -293,7 +446,7 @@ def main() -> None:
                 spreadsheet = temp_spreadsheet
                 print(f"You're in {sheet_name} sheet.")
                 print(spreadsheet.name, ": ")
-                print(spreadsheet)
+                print(viewport.render(spreadsheet))
             continue
 
         if command.lower().startswith("rename sheet"):
@@ -350,15 +503,253 @@ def main() -> None:
                 continue
             spreadsheet.create_graph(graph_type, range1, range2)
 
+        if command.lower().startswith("format"):
+            command_parts = command.split()
+            if len(command_parts) != 2:
+                print("Invalid command. Please use the format 'format [number format]' or 'format off'.")
+                continue
+            if command_parts[1].lower() == "off":
+                viewport.number_format = None
+            else:
+                try:
+                    format(1.5, command_parts[1])
+                except ValueError:
+                    print("Invalid number format. For example: 'format .2f' or 'format ,.0f'.")
+                    continue
+                viewport.number_format = command_parts[1]
+            print(spreadsheet.name, ": ")
+            print(viewport.render(spreadsheet))
+            continue
+
+        if command.lower().startswith("autosave"):
+            command_parts = command.split()
+            if len(command_parts) == 1:
+                if autosaver.is_running():
+                    print(f"Autosave is on, every {autosaver.interval:g} seconds.")
+                else:
+                    print("Autosave is off.")
+                continue
+            if len(command_parts) != 2:
+                print("Invalid command. Please use the format 'autosave [seconds]' or 'autosave off'.")
+                continue
+            if command_parts[1].lower() == "off":
+                autosaver.stop()
+                print("Autosave is off.")
+                continue
+            try:
+                interval = float(command_parts[1])
+                if interval <= 0:
+                    raise ValueError
+            except ValueError:
+                print("The autosave interval should be a positive number of seconds.")
+                continue
+            autosaver.stop()
+            autosaver.interval = interval
+            autosaver.start()
+            print(f"Autosave is on, every {interval:g} seconds.")
+            continue
+
+        if command.lower().startswith("profile"):
+            command_parts = command.split()
+            if len(command_parts) == 2 and command_parts[1].lower() == "on":
+                spreadsheet.start_profiling()
+                print(f"Profiling {spreadsheet.name} is on.")
+                continue
+            profiler = spreadsheet.profiler
+            if profiler is None:
+                print("Profiling is off. Type 'profile on' to start it.")
+                continue
+            if len(command_parts) == 3 and command_parts[1].lower() == "export":
+                filename = command_parts[2]
+                try:
+                    if filename.endswith(".prof"):
+                        profiler.export_pstats(filename)
+                    else:
+                        profiler.export_json(filename)
+                except OSError as err:
+                    print(f"Error: {str(err)}")
+                    continue
+                print(f"The statistics were saved to {filename}.")
+                continue
+            if len(command_parts) == 2 and command_parts[1].lower() == "off":
+                spreadsheet.stop_profiling()
+                print(profiler.report())
+                print("Profiling is off.")
+                continue
+            count = PROFILE_TOP_CELLS
+            if len(command_parts) == 2:
+                try:
+                    count = int(command_parts[1])
+                    if count <= 0:
+                        raise ValueError
+                except ValueError:
+                    print("Invalid command. Please use the format 'profile [number]', 'profile on/off' "
+                          "or 'profile export [file]'.")
+                    continue
+            elif len(command_parts) != 1:
+                print("Invalid command. Please use the format 'profile [number]', 'profile on/off' "
+                      "or 'profile export [file]'.")
+                continue
+            print(profiler.report(count))
+            continue
+
         if command.lower() == "details":
             print(workbook.to_dict())
 
 
-if __name__ == "__main__":
+def apply_batch_command(workbook: Workbook, spreadsheet: Spreadsheet, command: str) -> Spreadsheet:
+    """
+    Applies a single command of a batch script to the workbook.
+
+    :param workbook: The workbook the script runs on.
+    :param spreadsheet: The current sheet.
+    :param command: The command to apply.
+    :return: The current sheet after the command, which changes with the 'new' and 'sheet' commands.
+    :raises ValueError: If the command is invalid.
+    """
+    command_parts = command.split()
+    name = command_parts[0].lower()
+    if name == "set":
+        if len(command_parts) != 3:
+            raise ValueError("Please use the format 'set [cell] [value]' or 'set [cell] [formula]'.")
+        _, cell_name, value = command_parts
+        if not spreadsheet.is_valid_cell_name(cell_name):
+            raise ValueError(f"Invalid cell name '{cell_name}'.")
+        if value.startswith("="):
+            spreadsheet.set_cell(cell_name, formula=value[1:])
+        else:
+            spreadsheet.set_cell(cell_name, value=value)
+    elif name == "remove":
+        if len(command_parts) != 2 or not spreadsheet.is_valid_cell_name(command_parts[1]):
+            raise ValueError("Please use the format 'remove [cell]'.")
+        spreadsheet.remove_cell(command_parts[1])
+    elif name in ["new", "sheet"]:
+        if len(command_parts) != 2:
+            raise ValueError(f"Please use the format '{name} [sheet]'.")
+        sheet_name = command_parts[1]
+        if name == "new":
+            workbook.add_sheet(sheet_name)
+        new_spreadsheet = workbook.get_sheet(sheet_name)
+        if new_spreadsheet is None:
+            raise ValueError(f"Sheet '{sheet_name}' does not exist.")
+        new_spreadsheet.defer_recalculation = True
+        return new_spreadsheet
+    elif name == "export":
+        if len(command_parts) != 2 or command_parts[1].lower() not in VALID_FILE_FORMATS + ["json"]:
+            raise ValueError("Please use the format 'export [csv/pdf/excel/json]'.")
+        if workbook.name is None:
+            raise ValueError("The workbook has no name to export it with.")
+        export_format = command_parts[1].lower()
+        if export_format == "csv":
+            workbook.export_to_csv(workbook.name)
+        elif export_format == "pdf":
+            workbook.export_to_pdf(workbook.name)
+        elif export_format == "excel":
+            workbook.export_to_excel(workbook.name)
+        else:
+            workbook.export_to_json(workbook.name)
+    elif name == "save":
+        if workbook.name is None:
+            raise ValueError("The workbook has no name to save it with.")
+        workbook.export_to_json(workbook.name)
+    else:
+        raise ValueError(f"Unknown command '{command_parts[0]}'.")
+    return spreadsheet
+
+
+def run_script(workbook: Workbook, spreadsheet: Spreadsheet, lines: Iterable[str]) -> int:
+    """
+    Runs the commands of a batch script on a workbook.
+    The sheets are not printed, and formulas are evaluated once, at the end of the script.
+    A summary with the number of commands per second is printed at the end.
+
+    :param workbook: The workbook to run the script on.
+    :param spreadsheet: The sheet the script starts in.
+    :param lines: The lines of the script.
+    :return: The number of commands that failed.
+    """
+    for sheet in workbook.sheets.values():
+        sheet.defer_recalculation = True
+    spreadsheet.defer_recalculation = True
+    commands = 0
+    failures = 0
+    start = time.perf_counter()
     try:
-        if sys.argv[1] == "--help":
-            print(HELP_COMMAND)
-            print(HELP_TEXT)
-    except IndexError:
+        for line_number, line in enumerate(lines, start=1):
+            command = line.strip()
+            if not command or command.startswith("#"):
+                continue
+            commands += 1
+            try:
+                spreadsheet = apply_batch_command(workbook, spreadsheet, command)
+            except ValueError as err:
+                failures += 1
+                print(f"Line {line_number}: {str(err)}")
+    finally:
+        for sheet in workbook.sheets.values():
+            sheet.defer_recalculation = False
+            sheet.recalculate()
+    elapsed = time.perf_counter() - start
+    rate = commands / elapsed if elapsed > 0 else float(commands)
+    print(f"Applied {commands - failures} of {commands} commands in {elapsed:.3f} seconds "
+          f"({rate:.0f} commands per second).")
+    return failures
+
+
+def run_batch(args: List[str]) -> int:
+    """
+    Runs the program in batch mode: opens or creates a workbook from the command line arguments
+    and runs a script of commands on it, without asking the user anything.
+
+    :param args: The command line arguments, without the program name.
+    :return: The exit code of the program: 0 if every command succeeded, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(prog="main.py", add_help=False)
+    parser.add_argument("--script", required=True, help="the script to run, or '-' to read it from stdin")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--open", help="the JSON workbook file to open")
+    group.add_argument("--new", help="the name of a new workbook")
+    parser.add_argument("--sheet", help="the sheet to start in, created if the workbook is new")
+    parser.add_argument("--save", action="store_true", help="save the workbook when the script ends")
+    options = parser.parse_args(args)
+
+    if options.open:
+        try:
+            workbook = load_and_open_workbook(options.open)
+        except (OSError, ValueError) as err:
+            print(f"Could not open {options.open}: {str(err)}")
+            return 1
+    else:
+        workbook = Workbook(options.new)
+        workbook.add_sheet(options.sheet or "Sheet1")
+    sheet_name = options.sheet or (workbook.list_sheets()[0] if workbook.list_sheets() else None)
+    spreadsheet = workbook.get_sheet(sheet_name) if sheet_name is not None else None
+    if spreadsheet is None:
+        print(f"Sheet '{sheet_name}' does not exist.")
+        return 1
+
+    if options.script == "-":
+        failures = run_script(workbook, spreadsheet, sys.stdin)
+    else:
+        try:
+            with open(options.script, 'r') as f:
+                failures = run_script(workbook, spreadsheet, f)
+        except OSError as err:
+            print(f"Could not read {options.script}: {str(err)}")
+            return 1
+    if options.save:
+        workbook.export_to_json(workbook.name)
+        print(f"Saved {workbook.name}.json successfully.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--help":
+        print(HELP_COMMAND)
+        print(HELP_TEXT)
+        print(BATCH_HELP)
+    elif len(sys.argv) > 1:
+        sys.exit(run_batch(sys.argv[1:]))
+    else:
         main()
 
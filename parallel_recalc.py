@@ -0,0 +1,407 @@
+import io
+import os
+import contextlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import *
+from electronic_sheet import *
+
+# Fewer dirty cells than this are recalculated serially, since starting the processes takes longer
+PARALLEL_MIN_CELLS = 10000
+
+# The number of tasks every worker gets, so workers that finish early can take more
+TASKS_PER_WORKER = 4
+
+# The kinds of values in the shared buffer: empty cells, floats,
+# and anything else (text, ints), which is sent to the workers as it is
+EMPTY, NUMBER, OTHER = 0, 1, 2
+
+# The values of the sheet as seen by a worker process, set by attach_shared_values
+_shared: Optional[Dict[str, Any]] = None
+
+
+class SharedValues:
+    """
+    The values of a sheet's cells, column by column, in one shared memory block,
+    so worker processes read them without the cells being pickled.
+    The block holds a float64 value and a one byte kind for every row of every column.
+    """
+
+    def __init__(self, spreadsheet: Spreadsheet) -> None:
+        """
+        Copies the values of a sheet into a new shared memory block.
+
+        :param spreadsheet: The spreadsheet.
+        """
+        # The attributes of the sheet that change how formulas are evaluated
+        self.settings = {'name': spreadsheet.name, 'formula_backend': spreadsheet.formula_backend,
+                         'vectorize_formulas': spreadsheet.vectorize_formulas,
+                         'index_ranges': spreadsheet.index_ranges, 'cache_ranges': spreadsheet.cache_ranges}
+        last_rows: Dict[str, int] = {}
+        numbers: List[Tuple[str, int, float]] = []
+        self.others: Dict[str, Any] = {}
+        for cell_name, cell in spreadsheet.cells.items():
+            value = cell.value
+            if value is None:
+                continue
+            col_letter = cell_name.rstrip(ALL_DIGITS)
+            row = int(cell_name[len(col_letter):])
+            if row > last_rows.get(col_letter, 0):
+                last_rows[col_letter] = row
+            if type(value) is float:
+                numbers.append((col_letter, row, value))
+            else:
+                self.others[cell_name] = value
+        # The position of every column's first row in the block, and the number of rows it has
+        self.columns: Dict[str, Tuple[int, int]] = {}
+        size = 0
+        for col_letter, rows in last_rows.items():
+            self.columns[col_letter] = (size, rows)
+            size += rows
+        values = array('d', bytes(8 * size))
+        kinds = bytearray(size)
+        for col_letter, row, value in numbers:
+            position = self.columns[col_letter][0] + row - 1
+            values[position] = value
+            kinds[position] = NUMBER
+        for cell_name in self.others:
+            col_letter = cell_name.rstrip(ALL_DIGITS)
+            kinds[self.columns[col_letter][0] + int(cell_name[len(col_letter):]) - 1] = OTHER
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, 9 * size))
+        self.memory.buf[:8 * size] = values.tobytes()
+        self.memory.buf[8 * size:9 * size] = kinds
+        self.size = size
+
+    def arguments(self) -> Tuple[str, int, Dict[str, Tuple[int, int]], Dict[str, Any], Dict[str, Any]]:
+        """
+        Retrieves what a worker process needs to open the values, see open_shared_values.
+
+        :return: The name of the block, the number of values, the columns, the other values and the settings.
+        """
+        return self.memory.name, self.size, self.columns, self.others, self.settings
+
+    def close(self) -> None:
+        """
+        Releases the shared memory block.
+        """
+        self.memory.close()
+        self.memory.unlink()
+
+
+def open_shared_values(memory_name: str, size: int, columns: Dict[str, Tuple[int, int]],
+                       others: Dict[str, Any], settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Opens the shared values of a sheet in a worker process.
+
+    :param memory_name: The name of the shared memory block.
+    :param size: The number of values in the block.
+    :param columns: The position and the number of rows of every column, see SharedValues.
+    :param others: The values that are not floats, by cell name.
+    :param settings: The attributes of the sheet that change how formulas are evaluated.
+    :return: The opened values, for shared_value.
+    """
+    memory = shared_memory.SharedMemory(name=memory_name)
+    return {'memory': memory, 'values': memory.buf[:8 * size].cast('d'), 'kinds': memory.buf[8 * size:9 * size],
+            'columns': columns, 'others': others, 'settings': settings}
+
+
+def close_shared_values(shared: Dict[str, Any]) -> None:
+    """
+    Closes the shared values of a sheet in a worker process. The block itself is released by the main process.
+
+    :param shared: The values opened by open_shared_values.
+    """
+    shared['values'].release()
+    shared['kinds'].release()
+    shared['memory'].close()
+
+
+def attach_shared_values(*arguments: Any) -> None:
+    """
+    Opens the shared values of a sheet in a worker process once, when the process starts.
+
+    :param arguments: The arguments of open_shared_values.
+    """
+    global _shared
+    _shared = open_shared_values(*arguments)
+
+
+def shared_value(shared: Dict[str, Any], cell_name: str) -> Any:
+    """
+    Reads the value of a cell from the shared values of a sheet.
+
+    :param shared: The values opened by open_shared_values.
+    :param cell_name: The name of the cell.
+    :return: The value of the cell, None if it is empty.
+    """
+    col_letter = cell_name.rstrip(ALL_DIGITS)
+    row = int(cell_name[len(col_letter):])
+    column = shared['columns'].get(col_letter)
+    if column is None or row > column[1]:
+        return
+    position = column[0] + row - 1
+    kind = shared['kinds'][position]
+    if kind == NUMBER:
+        return shared['values'][position]
+    if kind == OTHER:
+        return shared['others'][cell_name]
+    return
+
+
+def recalculate_task(formulas: List[Tuple[str, str, Optional[tuple]]]) -> Tuple[List[Any], str]:
+    """
+    Recalculates a group of formulas of the sheet that the worker process opened when it started.
+
+    :param formulas: The formulas, see recalculate_formulas.
+    :return: The values of the formulas and what was printed, see recalculate_formulas.
+    """
+    return recalculate_formulas(_shared, formulas)
+
+
+def recalculate_sheet_task(arguments: tuple, formulas: List[Tuple[str, str, Optional[tuple]]]) -> Tuple[List[Any], str]:
+    """
+    Recalculates the dirty formulas of a whole sheet in a worker process, which opens the sheet's values for the task.
+
+    :param arguments: The arguments of open_shared_values.
+    :param formulas: The formulas, see recalculate_formulas.
+    :return: The values of the formulas and what was printed, see recalculate_formulas.
+    """
+    shared = open_shared_values(*arguments)
+    try:
+        return recalculate_formulas(shared, formulas)
+    finally:
+        close_shared_values(shared)
+
+
+def recalculate_formulas(shared: Dict[str, Any], formulas: List[Tuple[str, str, Optional[tuple]]]) \
+        -> Tuple[List[Any], str]:
+    """
+    Recalculates a group of formulas in a worker process.
+    The formulas are put in a new sheet together with the cells they refer to, read from the shared values,
+    and recalculated the same way Spreadsheet.recalculate does.
+
+    :param shared: The values of the sheet, opened by open_shared_values.
+    :param formulas: The cell name, the formula and the cached template of every formula in the group,
+    see task_formula. The group must hold every dirty cell that one of its formulas depends on.
+    :return: The values of the formulas, in the same order, and what was printed while calculating them.
+    """
+    settings = shared['settings']
+    spreadsheet = Spreadsheet(settings['name'], settings['formula_backend'])
+    spreadsheet.vectorize_formulas = settings['vectorize_formulas']
+    spreadsheet.index_ranges = settings['index_ranges']
+    spreadsheet.cache_ranges = settings['cache_ranges']
+    cells = spreadsheet.cells
+    for cell_name, formula, _ in formulas:
+        cells[cell_name] = Cell(formula=formula)
+    for cell_name, formula, template in formulas:
+        if template is not None:
+            # The references of a cached template are known without parsing the formula
+            spreadsheet.formula_templates[cell_name] = (formula, template)
+            col_index, row, relative = template
+            dependencies = [f"{spreadsheet.col_index_to_letter(col_index + col_offset)}{row + row_offset}"
+                            for col_offset, row_offset in template_offsets(relative)]
+        else:
+            dependencies = spreadsheet.formula_dependencies(formula)
+        for dep_name in dependencies:
+            dep_cell = cells.get(dep_name)
+            if dep_cell is None:
+                dep_cell = cells[dep_name] = Cell(shared_value(shared, dep_name))
+            dep_cell.add_dependent(cell_name)
+    cell_names = [cell_name for cell_name, _, _ in formulas]
+    spreadsheet.dirty_cells.update(cell_names)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        spreadsheet.recalculate_cells(set(cell_names))
+    return [cells[cell_name].value for cell_name in cell_names], output.getvalue()
+
+
+def task_formula(spreadsheet: Spreadsheet, cell_name: str, formula: str) -> Tuple[str, str, Optional[tuple]]:
+    """
+    Prepares a formula to be sent to a worker process, with its cached template if the sheet has one,
+    so the worker neither parses copied-down formulas nor loses their array evaluation, see cell_template.
+
+    :param spreadsheet: The spreadsheet of the formula.
+    :param cell_name: The name of the formula cell.
+    :param formula: The formula.
+    :return: The cell name, the formula and the cached position and template, or None instead of them.
+    """
+    cached = spreadsheet.formula_templates.get(cell_name)
+    if cached is not None and cached[0] == formula and cached[1][2] is not None:
+        return cell_name, formula, cached[1]
+    return cell_name, formula, None
+
+
+def store_results(spreadsheet: Spreadsheet, formulas: List[Tuple[str, str, Optional[tuple]]],
+                  result: Tuple[List[Any], str]) -> None:
+    """
+    Stores the values that a worker process calculated in the formula cells, which are not dirty anymore,
+    and prints what the worker printed while calculating them.
+
+    :param spreadsheet: The spreadsheet of the formulas.
+    :param formulas: The formulas that were sent to the worker.
+    :param result: The values of the formulas and what was printed.
+    """
+    values, output = result
+    if output:
+        print(output, end="")
+    for (cell_name, _, _), value in zip(formulas, values):
+        spreadsheet.cells[cell_name].value = value
+        spreadsheet.dirty_cells.discard(cell_name)
+
+
+def cell_order(cell_name: str) -> Tuple[int, str, int]:
+    """
+    Sorts cells column by column and then row by row, without converting the column to an index.
+
+    :param cell_name: The name of the cell.
+    :return: The sort key of the cell.
+    """
+    col_letter = cell_name.rstrip(ALL_DIGITS)
+    return len(col_letter), col_letter, int(cell_name[len(col_letter):])
+
+
+def recalculation_components(spreadsheet: Spreadsheet, cell_names: Set[str]) -> List[List[str]]:
+    """
+    Splits cells into groups that do not depend on each other, with a union-find over their dependents:
+    two cells are in the same group if one depends on the other, directly or through cells of the group.
+
+    :param spreadsheet: The spreadsheet of the cells.
+    :param cell_names: The names of the cells.
+    :return: The groups, each one a list of cell names.
+    """
+    parents: Dict[str, str] = {}
+
+    def find(cell_name: str) -> str:
+        root = cell_name
+        while parents.get(root, root) != root:
+            root = parents[root]
+        # Point everything on the way straight at the root
+        while cell_name != root:
+            parents[cell_name], cell_name = root, parents[cell_name]
+        return root
+
+    for cell_name in cell_names:
+        cell = spreadsheet.cells.get(cell_name)
+        if cell is None:
+            continue
+        for dependent in cell.dependents:
+            if dependent in cell_names:
+                root, dependent_root = find(cell_name), find(dependent)
+                if root != dependent_root:
+                    parents[dependent_root] = root
+    components: Dict[str, List[str]] = {}
+    for cell_name in cell_names:
+        components.setdefault(find(cell_name), []).append(cell_name)
+    return list(components.values())
+
+
+def recalculate_in_parallel(spreadsheet: Spreadsheet, cell_names: Set[str], workers: Optional[int] = None) -> Set[str]:
+    """
+    Recalculates dirty cells on a pool of processes.
+    The cells are split into groups that do not depend on each other, see recalculation_components,
+    and the groups are recalculated by the workers, which read the other cells from shared memory.
+    The results are the same as the results of recalculating the cells serially.
+
+    Groups with formulas that refer to other sheets are left for serial recalculation,
+    and so is everything when there are too few cells, a single worker,
+    or the processes or the shared memory cannot be created.
+
+    :param spreadsheet: The spreadsheet of the cells.
+    :param cell_names: The names of the dirty cells to recalculate.
+    :param workers: The number of processes, the number of CPUs by default.
+    :return: The names of the cells that are left for serial recalculation.
+    """
+    workers = workers or os.cpu_count() or 1
+    if len(cell_names) < PARALLEL_MIN_CELLS or workers < 2:
+        return cell_names
+    serial: Set[str] = set()
+    groups = []
+    for component in recalculation_components(spreadsheet, cell_names):
+        formulas = []
+        for cell_name in component:
+            cell = spreadsheet.cells.get(cell_name)
+            if cell is None or not cell.formula or cell_name in spreadsheet.sheet_references:
+                break
+            formulas.append(task_formula(spreadsheet, cell_name, cell.formula))
+        else:
+            groups.append(formulas)
+            continue
+        serial.update(component)
+    # Copied-down formulas are kept together, in order, so the workers can evaluate them as array operations
+    groups.sort(key=lambda formulas: min(cell_order(cell_name) for cell_name, _, _ in formulas))
+    total = sum(len(formulas) for formulas in groups)
+    task_size = max(1, total // (workers * TASKS_PER_WORKER))
+    tasks = []
+    for formulas in groups:
+        if not tasks or len(tasks[-1]) >= task_size:
+            tasks.append([])
+        tasks[-1].extend(formulas)
+
+    try:
+        shared = SharedValues(spreadsheet)
+    except OSError:
+        return cell_names
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=attach_shared_values,
+                                 initargs=shared.arguments()) as pool:
+            results = list(pool.map(recalculate_task, tasks))
+    except (OSError, RuntimeError):
+        return cell_names
+    finally:
+        shared.close()
+
+    for formulas, result in zip(tasks, results):
+        store_results(spreadsheet, formulas, result)
+    return serial
+
+
+def recalculate_sheets_in_parallel(sheets: List[Spreadsheet], workers: Optional[int] = None) -> List[Spreadsheet]:
+    """
+    Recalculates the dirty cells of whole sheets on a pool of processes, one task per sheet,
+    the sheets with the most dirty formulas first.
+    Every sheet's values are shipped in its own shared memory block, see SharedValues.
+
+    Sheets whose formulas refer to other sheets, or that other sheets refer to, are left for serial recalculation,
+    and so is everything when there are too few cells, a single worker,
+    or the processes or the shared memory cannot be created.
+
+    :param sheets: The sheets to recalculate.
+    :param workers: The number of processes, the number of CPUs by default.
+    :return: The sheets that are left for serial recalculation.
+    """
+    workers = workers or os.cpu_count() or 1
+    serial = []
+    independent = []
+    for spreadsheet in sheets:
+        if not spreadsheet.dirty_cells:
+            continue
+        if spreadsheet.sheet_references or spreadsheet.sheet_dependents():
+            serial.append(spreadsheet)
+        else:
+            independent.append(spreadsheet)
+    total = sum(len(spreadsheet.dirty_cells) for spreadsheet in independent)
+    if len(independent) < 2 or total < PARALLEL_MIN_CELLS or workers < 2:
+        return serial + independent
+    independent.sort(key=lambda spreadsheet: len(spreadsheet.dirty_cells), reverse=True)
+    tasks = []
+    for spreadsheet in independent:
+        tasks.append([task_formula(spreadsheet, cell_name, spreadsheet.cells[cell_name].formula)
+                      for cell_name in spreadsheet.dirty_cells
+                      if cell_name in spreadsheet.cells and spreadsheet.cells[cell_name].formula])
+
+    shared_sheets: List[SharedValues] = []
+    try:
+        for spreadsheet in independent:
+            shared_sheets.append(SharedValues(spreadsheet))
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results = list(pool.map(recalculate_sheet_task, [shared.arguments() for shared in shared_sheets], tasks))
+    except (OSError, RuntimeError):
+        return serial + independent
+    finally:
+        for shared in shared_sheets:
+            shared.close()
+
+    for spreadsheet, formulas, result in zip(independent, tasks, results):
+        store_results(spreadsheet, formulas, result)
+    return serial
@@ -0,0 +1,199 @@
+import math
+import operator
+from typing import *
+from formula_errors import FormulaError
+
+# Ranges with fewer cells than this are scanned directly, without building an index
+RANGE_INDEX_MIN_CELLS = 64
+
+# The most range aggregates a spreadsheet keeps in its range cache
+RANGE_CACHE_MAX_ENTRIES = 10000
+
+
+class RangeStatistics(NamedTuple):
+    """
+    The aggregates of the numbers in a range of cells, and the error of the first cell that holds one, if any.
+    """
+    total: float
+    count: int
+    minimum: float
+    maximum: float
+    error: Optional[FormulaError] = None
+
+
+class ColumnIndex:
+    """
+    A segment tree over the numbers of one column, answering SUM, COUNT, MIN and MAX of any rows in O(log n).
+    Every node keeps the sum, the count, the minimum and the maximum of the rows under it.
+    Sums are combined from whole nodes rather than taken as the difference of two prefix sums,
+    so a small range below a large one does not lose precision.
+
+    Rows whose value may have changed are marked stale instead of being read at once,
+    and are read again when a query covers them.
+    Every node also counts the stale rows under it, so a query finds the stale rows in its range
+    without looking at the rest.
+    """
+
+    def __init__(self, rows: int) -> None:
+        """
+        Initializes an index without numbers.
+
+        :param rows: The number of rows the index has to cover, starting at row 1.
+        """
+        size = 1
+        while size < rows:
+            size *= 2
+        self.size = size
+        self.sums = [0.0] * (2 * size)
+        self.counts = [0] * (2 * size)
+        self.mins = [math.inf] * (2 * size)
+        self.maxs = [-math.inf] * (2 * size)
+        self.stale = [0] * (2 * size)
+        # The rows that hold an error, which are counted as empty rows in the tree
+        self.errors: Dict[int, FormulaError] = {}
+
+    def load(self, values: Dict[int, float], stale_rows: Iterable[int],
+             errors: Optional[Dict[int, FormulaError]] = None) -> None:
+        """
+        Fills an empty index in O(n).
+
+        :param values: The numbers of the column, by row.
+        :param stale_rows: The rows whose value is not known yet.
+        :param errors: The errors of the column, by row.
+        """
+        self.errors = dict(errors or {})
+        size = self.size
+        for row, value in values.items():
+            position = size + row - 1
+            self.sums[position] = value
+            self.counts[position] = 1
+            self.mins[position] = value
+            self.maxs[position] = value
+        for row in stale_rows:
+            self.stale[size + row - 1] = 1
+        # Every level of the tree at once, from the leaves up, instead of node by node
+        level = size
+        while level > 1:
+            children = slice(level, 2 * level, 2), slice(level + 1, 2 * level, 2)
+            self.sums[level // 2:level] = map(operator.add, self.sums[children[0]], self.sums[children[1]])
+            self.counts[level // 2:level] = map(operator.add, self.counts[children[0]], self.counts[children[1]])
+            self.mins[level // 2:level] = map(min, self.mins[children[0]], self.mins[children[1]])
+            self.maxs[level // 2:level] = map(max, self.maxs[children[0]], self.maxs[children[1]])
+            self.stale[level // 2:level] = map(operator.add, self.stale[children[0]], self.stale[children[1]])
+            level //= 2
+
+    def combine(self, position: int) -> None:
+        """
+        Recomputes a node from its two children.
+
+        :param position: The position of the node.
+        """
+        left, right = 2 * position, 2 * position + 1
+        self.sums[position] = self.sums[left] + self.sums[right]
+        self.counts[position] = self.counts[left] + self.counts[right]
+        self.mins[position] = min(self.mins[left], self.mins[right])
+        self.maxs[position] = max(self.maxs[left], self.maxs[right])
+
+    def set_value(self, row: int, value: Any) -> None:
+        """
+        Sets the value of a row and clears its stale mark, in O(log n).
+
+        :param row: The row, starting at 1.
+        :param value: The new value. Only ints and floats are counted, anything else is treated as empty,
+        and errors are kept apart for first_error.
+        """
+        if isinstance(value, FormulaError):
+            self.errors[row] = value
+        elif self.errors:
+            self.errors.pop(row, None)
+        position = self.size + row - 1
+        if isinstance(value, int) or isinstance(value, float):
+            self.sums[position] = float(value)
+            self.counts[position] = 1
+            self.mins[position] = self.maxs[position] = float(value)
+        else:
+            self.sums[position] = 0.0
+            self.counts[position] = 0
+            self.mins[position] = math.inf
+            self.maxs[position] = -math.inf
+        was_stale = self.stale[position]
+        position //= 2
+        while position:
+            self.combine(position)
+            self.stale[position] -= was_stale
+            position //= 2
+        self.stale[self.size + row - 1] = 0
+
+    def mark_stale(self, row: int) -> None:
+        """
+        Marks a row whose value may have changed, in O(log n).
+
+        :param row: The row, starting at 1. Rows the index does not cover are ignored.
+        """
+        position = self.size + row - 1
+        if row < 1 or row > self.size or self.stale[position]:
+            return
+        while position:
+            self.stale[position] += 1
+            position //= 2
+
+    def stale_rows(self, first: int, last: int) -> List[int]:
+        """
+        Finds the stale rows in a range of rows.
+
+        :param first: The first row of the range.
+        :param last: The last row of the range.
+        :return: The stale rows, from top to bottom.
+        """
+        rows = []
+        # (node position, first row of the node, last row of the node)
+        stack = [(1, 1, self.size)]
+        while stack:
+            position, node_first, node_last = stack.pop()
+            if not self.stale[position] or node_last < first or node_first > last:
+                continue
+            if position >= self.size:
+                rows.append(node_first)
+                continue
+            middle = (node_first + node_last) // 2
+            stack.append((2 * position + 1, middle + 1, node_last))
+            stack.append((2 * position, node_first, middle))
+        return rows
+
+    def first_error(self, first: int, last: int) -> Optional[FormulaError]:
+        """
+        Finds the error of the first row of a range that holds one, in O(number of errors in the column).
+
+        :param first: The first row of the range.
+        :param last: The last row of the range.
+        :return: The error, or None if no row of the range holds one.
+        """
+        rows = [row for row in self.errors if first <= row <= last]
+        return self.errors[min(rows)] if rows else None
+
+    def query(self, first: int, last: int) -> RangeStatistics:
+        """
+        Aggregates the numbers of a range of rows, in O(log n). Stale rows are counted with their old value.
+
+        :param first: The first row of the range.
+        :param last: The last row of the range.
+        :return: The sum, the count, the minimum and the maximum of the numbers in the range.
+        """
+        total, count, minimum, maximum = 0.0, 0, math.inf, -math.inf
+        low, high = self.size + first - 1, self.size + last
+        while low < high:
+            if low % 2:
+                total += self.sums[low]
+                count += self.counts[low]
+                minimum = min(minimum, self.mins[low])
+                maximum = max(maximum, self.maxs[low])
+                low += 1
+            if high % 2:
+                high -= 1
+                total += self.sums[high]
+                count += self.counts[high]
+                minimum = min(minimum, self.mins[high])
+                maximum = max(maximum, self.maxs[high])
+            low //= 2
+            high //= 2
+        return RangeStatistics(total, count, minimum, maximum)
@@ -0,0 +1,116 @@
+import math
+from typing import *
+from formula_vectorizer import numpy_module
+
+# Lists shorter than this are sorted instead of partitioned
+SELECT_SORT_SIZE = 16
+
+
+def welford(values: Iterable[float]) -> Tuple[int, float, float]:
+    """
+    Calculates the count, the mean and the sum of squared deviations of numbers in a single pass,
+    with Welford's algorithm, which does not lose precision the way sum of squares minus square of sums does.
+
+    :param values: The numbers. They are read once, so any iterator can be used.
+    :return: A tuple of the count, the mean and the sum of squared deviations from the mean.
+    """
+    count = 0
+    mean = 0.0
+    squares = 0.0
+    for value in values:
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        squares += delta * (value - mean)
+    return count, mean, squares
+
+
+def variance(values: Iterable[float]) -> Optional[float]:
+    """
+    Calculates the sample variance of numbers, like VAR in Excel.
+
+    :param values: The numbers.
+    :return: The sample variance, or None if there are less than two numbers.
+    """
+    count, _, squares = welford(values)
+    if count < 2:
+        return
+    return squares / (count - 1)
+
+
+def select(values: List[float], ks: List[int]) -> List[float]:
+    """
+    Finds the k-th smallest numbers without sorting all of them.
+    With numpy, numpy.partition is used, which is an introselect.
+    Without it, a quickselect with a median of three pivot is used,
+    which sorts what is left if it needs too many rounds, like an introselect does.
+
+    :param values: The numbers. The list may be reordered.
+    :param ks: The positions to find, starting at 0, in the order of the sorted numbers.
+    :return: The number at every position.
+    """
+    numpy = numpy_module()
+    if numpy is not None:
+        array = numpy.array(values, dtype=numpy.float64)
+        array.partition(ks)
+        return [float(array[k]) for k in ks]
+    return [quickselect(values, k) for k in ks]
+
+
+def quickselect(values: List[float], k: int) -> float:
+    """
+    Finds the k-th smallest number with a quickselect.
+
+    :param values: The numbers.
+    :param k: The position to find, starting at 0.
+    :return: The number at position k of the sorted numbers.
+    """
+    rounds = 2 * max(1, len(values).bit_length())
+    while len(values) > SELECT_SORT_SIZE and rounds:
+        rounds -= 1
+        pivot = sorted([values[0], values[len(values) // 2], values[-1]])[1]
+        lows = [value for value in values if value < pivot]
+        if k < len(lows):
+            values = lows
+            continue
+        highs = [value for value in values if value > pivot]
+        pivots = len(values) - len(lows) - len(highs)
+        if k < len(lows) + pivots:
+            return pivot
+        k -= len(lows) + pivots
+        values = highs
+    return sorted(values)[k]
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Calculates a percentile of numbers, interpolating between the closest ranks like PERCENTILE in Excel.
+
+    :param values: The numbers. The list may be reordered.
+    :param fraction: The percentile, between 0 and 1.
+    :return: The percentile, or None if there are no numbers.
+    """
+    if not values:
+        return
+    rank = fraction * (len(values) - 1)
+    lower_rank = math.floor(rank)
+    if lower_rank == rank:
+        return select(values, [lower_rank])[0]
+    lower, upper = select(values, [lower_rank, lower_rank + 1])
+    return lower + (upper - lower) * (rank - lower_rank)
+
+
+def median(values: List[float]) -> Optional[float]:
+    """
+    Calculates the median of numbers.
+
+    :param values: The numbers. The list may be reordered.
+    :return: The median, or None if there are no numbers.
+    """
+    if not values:
+        return
+    middle = len(values) // 2
+    if len(values) % 2:
+        return select(values, [middle])[0]
+    lower, upper = select(values, [middle - 1, middle])
+    return (lower + upper) / 2
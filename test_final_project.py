@@ -1,5 +1,15 @@
 from workbook import *
+from autosave import AutoSaver
+from benchmark import legacy_workbook_dict, range_formula_workbook, grid_spreadsheet, formula_chain_spreadsheet, \
+    best_time
+from main import Viewport, run_script, run_batch
 import matplotlib.pyplot as plt
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import time
 from unittest.mock import patch
 
 
@@ -338,10 +348,7 @@ def test_regular_formula():
 
     # Test a formula with a valid cell name and a division by zero operation
     spreadsheet.set_cell('B2', 0)
-    try:
-        spreadsheet.regular_formula('A1/B2')
-    except Exception as e:
-        assert str(e) == "Error: Division by zero."
+    assert spreadsheet.regular_formula('A1/B2') == DIV_ZERO
 
 def test_find_min():
     spreadsheet = Spreadsheet()
@@ -422,3 +429,987 @@ def test_create_graph():
         spreadsheet.create_graph('bar', 'A1:A3', 'B1:2B')
     except Exception as e:
         assert str(e) == "Invalid cells range. '2B' comes after 'B1'"
+
+
+def test_autosave_writes_dirty_workbook(tmp_path):
+    workbook = Workbook(str(tmp_path / "book"))
+    workbook.add_sheet('Sheet1')
+    workbook.get_sheet('Sheet1').set_cell('A1', 10)
+    autosaver = AutoSaver(workbook, interval=0.01)
+    assert autosaver.save_now()
+    # Nothing changed since the last save, so nothing is written
+    assert not autosaver.save_now()
+    workbook.get_sheet('Sheet1').set_cell('A2', formula='A1*2')
+    assert autosaver.save_now()
+    loaded = load_and_open_workbook(str(tmp_path / "book.json"))
+    assert loaded.get_sheet('Sheet1').get_cell_value('A2') == 20
+
+    # The background thread saves on its own
+    workbook.get_sheet('Sheet1').set_cell('A3', 5)
+    autosaver.start()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if 'A3' in load_and_open_workbook(str(tmp_path / "book.json")).get_sheet('Sheet1').cells:
+            break
+        time.sleep(0.01)
+    autosaver.stop()
+    assert load_and_open_workbook(str(tmp_path / "book.json")).get_sheet('Sheet1').get_cell_value('A3') == 5
+
+
+def test_autosave_snapshot_isolation(tmp_path):
+    workbook = Workbook(str(tmp_path / "book"))
+    workbook.add_sheet('Sheet1')
+    sheet = workbook.get_sheet('Sheet1')
+    sheet.set_cell('A1', 1)
+    sheet.set_cell('B1', formula='A1+1')
+    autosaver = AutoSaver(workbook)
+
+    started = threading.Event()
+    release = threading.Event()
+    real_dump = json.dump
+
+    def slow_dump(obj, f):
+        started.set()
+        release.wait(5)
+        real_dump(obj, f)
+
+    with patch('autosave.json.dump', slow_dump):
+        saving = threading.Thread(target=autosaver.save_now)
+        saving.start()
+        assert started.wait(5)
+        # The save is in progress: commands must neither wait for it nor leak into it
+        before = time.perf_counter()
+        sheet.set_cell('A1', 100)
+        sheet.set_cell('A2', 'late')
+        workbook.add_sheet('Sheet2')
+        assert time.perf_counter() - before < 1
+        release.set()
+        saving.join()
+
+    saved = load_and_open_workbook(str(tmp_path / "book.json"))
+    assert saved.list_sheets() == ['Sheet1']
+    assert saved.get_sheet('Sheet1').get_cell_value('A1') == 1
+    assert saved.get_sheet('Sheet1').get_cell_value('B1') == 2
+    assert 'A2' not in saved.get_sheet('Sheet1').cells
+    # The live workbook kept the new values
+    assert sheet.get_cell_value('B1') == 101
+
+
+def test_to_dict_uses_computed_values():
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_cell('A1', 10)
+    spreadsheet.set_cell('A2', formula='A1*2')
+    spreadsheet.set_cell('A3', formula='A2+1')
+    with patch.object(Spreadsheet, 'evaluate_formula') as evaluate:
+        assert spreadsheet.to_dict()['A3']['value'] == 21
+        evaluate.assert_not_called()
+
+    # Changing A1 marks only its dependents dirty, and only they are evaluated again
+    spreadsheet.set_cell('A1', 20)
+    assert spreadsheet.dirty_cells == {'A2', 'A3'}
+    assert spreadsheet.to_dict()['A3']['value'] == 41
+    assert spreadsheet.dirty_cells == set()
+
+    spreadsheet.remove_cell('A1')
+    assert spreadsheet.get_cell_value('A2') is None
+
+
+def test_load_trusts_saved_values(tmp_path):
+    workbook = Workbook()
+    workbook.add_sheet('Sheet1')
+    sheet = workbook.get_sheet('Sheet1')
+    sheet.set_cell('A1', 3)
+    sheet.set_cell('B1', formula='A1*2')
+    sheet.set_cell('C1', formula='A1')
+    workbook.export_to_json(str(tmp_path / "book"))
+
+    with patch.object(Spreadsheet, 'evaluate_formula') as evaluate:
+        loaded = load_and_open_workbook(str(tmp_path / "book.json"))
+        assert loaded.get_sheet('Sheet1').get_cell_value('B1') == 6
+        evaluate.assert_not_called()
+    # The dependencies are known after loading, so changes still reach the formulas
+    loaded.get_sheet('Sheet1').set_cell('A1', 4)
+    assert loaded.get_sheet('Sheet1').get_cell_value('B1') == 8
+    assert loaded.get_sheet('Sheet1').get_cell_value('C1') == 4
+
+    # A stale saved value is corrected in verify mode
+    with open(tmp_path / "book.json") as f:
+        workbook_dict = json.load(f)
+    workbook_dict['sheets']['Sheet1']['B1']['value'] = 100
+    with open(tmp_path / "stale.json", 'w') as f:
+        json.dump(workbook_dict, f)
+    assert load_and_open_workbook(str(tmp_path / "stale.json")).get_sheet('Sheet1').get_cell_value('B1') == 100
+    verified = load_and_open_workbook(str(tmp_path / "stale.json"), verify=True)
+    assert verified.get_sheet('Sheet1').get_cell_value('B1') == 6
+
+
+def test_file_format_versions(tmp_path):
+    workbook = range_formula_workbook(200)
+    workbook.export_to_json(str(tmp_path / "current"))
+    with open(tmp_path / "current.json") as f:
+        assert json.load(f)['format_version'] == FORMAT_VERSION
+    with open(tmp_path / "legacy.json", 'w') as f:
+        json.dump(legacy_workbook_dict(workbook), f)
+    # The dependents are not saved anymore, so the range formulas do not repeat the cell names
+    assert os.path.getsize(tmp_path / "current.json") < os.path.getsize(tmp_path / "legacy.json") / 2
+
+    for path in [tmp_path / "current.json", tmp_path / "legacy.json"]:
+        loaded = load_and_open_workbook(str(path)).get_sheet('Sheet1')
+        assert loaded.get_cell_value('B1') == sum(range(1, 201))
+        # Both formats give the same dependency graph
+        for cell_name, cell in workbook.get_sheet('Sheet1').cells.items():
+            assert loaded.cells[cell_name].dependents == cell.dependents
+        loaded.set_cell('A1', 1001)
+        assert loaded.get_cell_value('B3') == 1001
+
+
+def test_render_viewport():
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_cell('A1', 10)
+    spreadsheet.set_cell('B1', 20)
+    spreadsheet.set_cell('A2', 30)
+    spreadsheet.set_cell('B2', formula='A1+B1')
+    assert spreadsheet.render('B1', 'C5') == ('     B         \n'
+                                              '---------------\n'
+                                              '1    20.0      \n'
+                                              '2    30.0      ')
+    assert spreadsheet.render() == str(spreadsheet)
+    assert spreadsheet.render('C1', 'D4') == "There are no cells in this part of the spreadsheet."
+
+    # Only the visible cells are evaluated
+    spreadsheet.set_cell('A1', 1)
+    spreadsheet.render('A1', 'A2')
+    assert spreadsheet.dirty_cells == {'B2'}
+
+    viewport = Viewport(cols=1, rows=1)
+    assert viewport.render(spreadsheet) == ('     A         \n'
+                                            '---------------\n'
+                                            '1    1.0       ')
+    assert viewport.scroll('down')
+    assert viewport.scroll('right')
+    assert viewport.render(spreadsheet) == ('     B         \n'
+                                            '---------------\n'
+                                            '2    21.0      ')
+    assert not viewport.scroll('sideways')
+    assert not viewport.set_range(spreadsheet, 'B2:A1')
+    assert viewport.set_range(spreadsheet, 'A2:B2')
+    assert viewport.render(spreadsheet).endswith('2    30.0       21.0      ')
+
+
+def test_render_column_widths():
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_cell('A1', 'a long piece of text')
+    spreadsheet.set_cell('B1', 1234.5)
+    spreadsheet.set_cell('B2', 7)
+    assert str(spreadsheet) == ('     A                    B         \n'
+                                '------------------------------------\n'
+                                '1    a long piece of text 1234.5    \n'
+                                '2    -                    7.0       ')
+    assert spreadsheet.render(number_format=',.2f', align_numbers=True, min_width=1) == (
+        '     A                    B       \n'
+        '----------------------------------\n'
+        '1    a long piece of text 1,234.50\n'
+        '2    -                        7.00')
+    assert spreadsheet.render('A1', 'A1', max_width=6) == ('     A     \n'
+                                                          '-----------\n'
+                                                          '1    a lon~')
+
+
+def test_render_benchmark():
+    spreadsheet = grid_spreadsheet(100, 100)
+    # 10,000 visible cells
+    assert best_time(lambda: spreadsheet.render('A1', 'CV100')) < 0.05
+
+
+def test_startup_import_time():
+    # Importing the program must not import the graph and export libraries
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0
+    cumulative_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        cumulative_times[package.strip()] = int(cumulative)
+    for heavy_package in ["matplotlib", "xlsxwriter", "reportlab"]:
+        assert heavy_package not in cumulative_times
+    # In microseconds: well under the time matplotlib alone takes to import
+    assert cumulative_times["main"] < 300000
+
+
+def test_export_imports_backends_on_use(tmp_path):
+    workbook = Workbook()
+    workbook.add_sheet('Sheet1')
+    workbook.get_sheet('Sheet1').set_cell('A1', 10)
+    workbook.get_sheet('Sheet1').set_cell('B1', formula='A1*2')
+    workbook.export_to_excel(str(tmp_path / "book"))
+    workbook.export_to_pdf(str(tmp_path / "book"))
+    assert os.path.exists(tmp_path / "book.xlsx")
+    assert os.path.exists(tmp_path / "book_Sheet1.pdf")
+
+
+def test_run_script_defers_recalculation(capsys):
+    workbook = Workbook()
+    workbook.add_sheet('Sheet1')
+    spreadsheet = workbook.get_sheet('Sheet1')
+    lines = ["set B1 =SUM(A1:A100)", "# a comment", ""]
+    lines += [f"set A{row} {row}" for row in range(1, 101)]
+    lines += ["remove A100", "new Sheet2", "set A1 =B1+1", "sheet Sheet1", "set", "unknown"]
+    with patch.object(Spreadsheet, 'evaluate_formula', autospec=True,
+                      side_effect=Spreadsheet.evaluate_formula) as evaluate:
+        failures = run_script(workbook, spreadsheet, lines)
+        # Every formula is evaluated once, at the end
+        assert evaluate.call_count == 2
+    assert failures == 2
+    assert spreadsheet.get_cell_value('B1') == sum(range(1, 100))
+    assert workbook.get_sheet('Sheet2').get_cell_value('A1') is None
+    assert not spreadsheet.defer_recalculation
+    output = capsys.readouterr().out
+    assert "Line 108: Please use the format" in output
+    assert "Line 109: Unknown command 'unknown'." in output
+    assert "Applied 105 of 107 commands" in output
+    # Nothing is rendered in batch mode
+    assert "----" not in output
+
+
+def test_run_batch(tmp_path):
+    script = tmp_path / "commands.txt"
+    script.write_text("set A1 2\nset A2 =A1*3\nexport csv\n")
+    book = str(tmp_path / "book")
+    assert run_batch(["--script", str(script), "--new", book, "--save"]) == 0
+    assert os.path.exists(book + "_Sheet1.csv")
+    loaded = load_and_open_workbook(book + ".json")
+    assert loaded.get_sheet('Sheet1').get_cell_value('A2') == 6
+
+    script.write_text("set A1 5\nset B1 =A2+1\n")
+    assert run_batch(["--script", str(script), "--open", book + ".json", "--save"]) == 0
+    loaded = load_and_open_workbook(book + ".json")
+    assert loaded.get_sheet('Sheet1').get_cell_value('B1') == 16
+    assert run_batch(["--script", str(script), "--open", book + ".json", "--sheet", "Missing"]) == 1
+
+
+def test_batch_recalculates_once_in_order():
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_cell('A1', 1)
+    with patch.object(Spreadsheet, 'evaluate_formula', autospec=True,
+                      side_effect=Spreadsheet.evaluate_formula) as evaluate:
+        with spreadsheet.batch():
+            # Set in reverse order: every formula refers to a cell that is set later
+            spreadsheet.set_cell('A4', formula='A3*2')
+            spreadsheet.set_cell('A3', formula='A2+1')
+            spreadsheet.set_cell('A2', formula='A1+1')
+            for value in range(10):
+                spreadsheet.set_cell('A1', value)
+            assert evaluate.call_count == 0
+            assert spreadsheet.get_cell('A1').dependents == set()
+        assert evaluate.call_count == 3
+        assert [call.args[1] for call in evaluate.call_args_list] == ['A1+1', 'A2+1', 'A3*2']
+    assert spreadsheet.get_cell_value('A4') == 22
+    assert spreadsheet.get_cell('A1').dependents == {'A2'}
+    assert spreadsheet.dirty_cells == set()
+    # The dependencies recorded by the batch work like any other
+    spreadsheet.set_cell('A1', 0)
+    assert spreadsheet.get_cell_value('A4') == 4
+
+
+def test_batch_rollback():
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_cell('A1', 1)
+    spreadsheet.set_cell('B1', formula='A1*10')
+    try:
+        with spreadsheet.batch():
+            spreadsheet.set_cell('A1', 5)
+            spreadsheet.set_cell('B1', formula='A1+A2')
+            spreadsheet.set_cell('C7', 'new')
+            spreadsheet.remove_cell('A1')
+            raise RuntimeError("failed in the middle")
+    except RuntimeError:
+        pass
+    assert spreadsheet.get_cell_value('A1') == 1
+    assert spreadsheet.get_cell('B1').formula == 'A1*10'
+    assert spreadsheet.get_cell_value('B1') == 10
+    assert 'C7' not in spreadsheet.cells
+    assert spreadsheet.used_range() == (1, 1)
+    spreadsheet.set_cell('A1', 2)
+    assert spreadsheet.get_cell_value('B1') == 20
+
+
+def test_set_many():
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_many([(f"A{row}", row, None) for row in range(1, 101)] +
+                         [("B1", None, "SUM(A1:A100)"), ("B2", None, "B2+1"), ("B3", None, "B1/2")])
+    assert spreadsheet.get_cell_value('B1') == 5050
+    assert spreadsheet.get_cell_value('B3') == 2525
+    # A formula that refers to its own cell is not set, like in set_cell
+    assert spreadsheet.get_cell('B2').formula is None
+    spreadsheet.set_many([("A1", 1001, None)])
+    assert spreadsheet.get_cell_value('B3') == 3025
+    # A formula that cannot be parsed is not set either
+    with patch('builtins.print') as mock_print:
+        spreadsheet.set_many([("B4", None, "A1+"), ("B3", None, "A1+"), ("B5", None, "B3*2")])
+        mock_print.assert_called_with("Error: The formula ended unexpectedly.")
+    assert spreadsheet.get_cell('B4') is None
+    assert spreadsheet.get_cell('B3').formula == "B1/2"
+    assert spreadsheet.get_cell_value('B5') == 6050
+
+
+def test_parse_formula():
+    assert parse_formula('A1+2*B1') == BinaryOp('+', CellRef('A1'), BinaryOp('*', Number(2.0), CellRef('B1')))
+    assert parse_formula('(A1+2)*B1') == BinaryOp('*', BinaryOp('+', CellRef('A1'), Number(2.0)), CellRef('B1'))
+    assert parse_formula('A1-A2-A3') == BinaryOp('-', BinaryOp('-', CellRef('A1'), CellRef('A2')), CellRef('A3'))
+    assert parse_formula('-A1*-2') == BinaryOp('*', UnaryOp('-', CellRef('A1')), Number(-2.0))
+    assert parse_formula('SUM(A1:A10)/COUNT(A1:A10)*2') == BinaryOp(
+        '*', BinaryOp('/', FunctionCall('SUM', (RangeRef('A1', 'A10'),)),
+                      FunctionCall('COUNT', (RangeRef('A1', 'A10'),))), Number(2.0))
+    assert parse_formula('sqrt(max(A1, 2.5e1))') == FunctionCall(
+        'SQRT', (FunctionCall('MAX', (CellRef('A1'), Number(25.0))),))
+    assert parse_formula('1e3+1E2*2E-1') == BinaryOp(
+        '+', Number(1000.0), BinaryOp('*', Number(100.0), Number(0.2)))
+    for invalid_formula, message in [('1A+10', "Invalid cell name '1A'"), ('A1^B1', "Unexpected character '^'"),
+                                     ('(A1+A2', "ended unexpectedly"), ('A1:A3', "Unexpected ':'"),
+                                     ('A1 A2', "Unexpected 'A2'"), ('A0+1', "Invalid cell name 'A0'"),
+                                     ('', "empty"), ('SUM(A1:2B)', "Invalid cell name '2B'"),
+                                     ('1e3x+1', "Invalid cell name '1e3x'")]:
+        try:
+            parse_formula(invalid_formula)
+            assert False, invalid_formula
+        except FormulaSyntaxError as err:
+            assert message in str(err)
+
+
+def test_evaluate_expressions():
+    spreadsheet = Spreadsheet()
+    for row in range(1, 11):
+        spreadsheet.set_cell(f'A{row}', row)
+    assert spreadsheet.evaluate_formula('SUM(A1:A10)/MAX(A1:A10)*2') == 11
+    assert spreadsheet.evaluate_formula('-(A1+A2)*3-4/2') == -11
+    assert spreadsheet.evaluate_formula('SQRT(SUM(A1:A3)+10)') == 4
+    assert spreadsheet.evaluate_formula('SUM(A1:A2,A10,100)') == 113
+    # Ranges that cross from one digit rows to two digit rows
+    assert spreadsheet.evaluate_formula('SUM(A9:A10)') == 19
+    assert spreadsheet.evaluate_formula('A1/(A2-2)') == DIV_ZERO
+    spreadsheet.set_cell('B1', 'text')
+    assert spreadsheet.evaluate_formula('B1*2') == VALUE_ERROR
+    assert spreadsheet.evaluate_formula('Z1*2') is None
+
+    # Every operand is a dependency, not only the first two
+    spreadsheet.set_cell('C1', formula='A1+A2*A3-MIN(A4:A5)')
+    assert spreadsheet.get_cell_value('C1') == 3
+    assert spreadsheet.formula_dependencies('A1+A2*A3-MIN(A4:A5)') == ['A1', 'A2', 'A3', 'A4', 'A5']
+    spreadsheet.set_cell('A4', 100)
+    assert spreadsheet.get_cell_value('C1') == 2
+    # A formula that cannot be parsed is not set
+    spreadsheet.set_cell('C2', formula='A1+')
+    assert spreadsheet.get_cell('C2').formula is None
+
+
+def test_compiled_backend_matches_interpreted():
+    formulas = ['SUM(A1:A10)/MAX(A1:A10)*2', '-(A1+A2)*3-4/2', 'SQRT(SUM(A1:A3)+10)', 'SUM(A1:A2,A10,100)',
+                'A1/(A2-2)', 'B1*2', 'Z9+1', 'AVERAGE(A1:A4)-MIN(A2:A3)']
+    sheets = [Spreadsheet(), Spreadsheet(formula_backend="compiled")]
+    for spreadsheet in sheets:
+        for row in range(1, 11):
+            spreadsheet.set_cell(f'A{row}', row)
+        spreadsheet.set_cell('B1', 'text')
+    for formula in formulas:
+        assert sheets[0].evaluate_formula(formula) == sheets[1].evaluate_formula(formula)
+
+    compiled = sheets[1]
+    compiled.set_cell('C1', formula='A1+D1')
+    compiled.set_cell('C2', formula='C1*2')
+    assert compiled.get_cell_value('C2') is None
+    compiled.set_cell('D1', 4)
+    assert compiled.get_cell_value('C2') == 10
+    # A cell created after the formula was compiled is still read
+    compiled.set_cell('C3', formula='E1+1')
+    compiled.set_cell('E1', 1)
+    assert compiled.get_cell_value('C3') == 2
+    with pytest.raises(ZeroDivisionError):
+        with compiled.batch():
+            compiled.set_cell('F1', 3)
+            compiled.set_cell('C4', formula='F1*2')
+            raise ZeroDivisionError
+    compiled.set_cell('C4', formula='F1*2')
+    compiled.set_cell('F1', 5)
+    assert compiled.get_cell_value('C4') == 10
+
+    interpreted = formula_chain_spreadsheet(200)
+    compiled = formula_chain_spreadsheet(200, "compiled")
+    assert interpreted.to_dict() == compiled.to_dict()
+    with pytest.raises(ValueError):
+        Spreadsheet(formula_backend="bytecode")
+
+
+def test_vectorized_copied_down_formulas():
+    def build(vectorize):
+        spreadsheet = Spreadsheet()
+        spreadsheet.vectorize_formulas = vectorize
+        items = [(f"A{row}", row / 7, None) for row in range(1, 41)]
+        items.extend((f"B{row}", (row % 5) * 0.1, None) for row in range(1, 41))
+        items.extend((f"C{row}", None, f"A{row}*B{row}+A{row}/3-0.1") for row in range(1, 41))
+        items.extend((f"D{row}", None, f"SQRT(C{row})/B{row}") for row in range(1, 41))
+        # A running total depends on the cell above it, so it is evaluated cell by cell
+        items.append(("E1", None, "C1"))
+        items.extend((f"E{row}", None, f"E{row - 1}+C{row}") for row in range(2, 41))
+        spreadsheet.set_many(items)
+        return spreadsheet
+
+    with patch('builtins.print'):
+        scalar, vectorized = build(False), build(True)
+        runs = formula_runs(vectorized, set(vectorized.cells))
+        assert sorted(run[0] for run in runs) == ['C1', 'D1']
+        # B5 is zero, so column D is evaluated cell by cell and reports the division by zero
+        assert vectorized.get_cell_value('D5') == DIV_ZERO
+        for cell_name, cell in scalar.cells.items():
+            assert repr(cell.value) == repr(vectorized.cells[cell_name].value)
+
+        items = [(f"B{row}", row * 0.5 + 1, None) for row in range(1, 41)]
+        scalar.set_many(items)
+        vectorized.set_many(items)
+        for cell_name, cell in scalar.cells.items():
+            assert repr(cell.value) == repr(vectorized.cells[cell_name].value)
+        assert all(evaluate_run(vectorized, run) for run in runs)
+        vectorized.set_cell('A3', 'text')
+        assert not evaluate_run(vectorized, runs[0])
+
+
+def test_range_indexes_match_scanning():
+    import random
+    generator = random.Random(7)
+    sheets = [Spreadsheet(), Spreadsheet()]
+    sheets[0].index_ranges = False
+    for spreadsheet in sheets:
+        for row in range(1, 201):
+            spreadsheet.set_cell(f'A{row}', row % 17)
+            spreadsheet.set_cell(f'B{row}', formula=f'A{row}*2')
+        spreadsheet.set_cell('C1', formula='SUM(A1:B200)')
+        spreadsheet.set_cell('C2', formula='MIN(B50:B150)')
+    functions = ['SUM', 'AVERAGE', 'MIN', 'MAX']
+    for step in range(200):
+        first, last = sorted(generator.randint(1, 220) for _ in range(2))
+        formula = f'{generator.choice(functions)}(A{first}:B{last})'
+        assert sheets[0].evaluate_formula(formula) == sheets[1].evaluate_formula(formula)
+        cell_name = f'A{generator.randint(1, 230)}'
+        value = generator.choice([generator.randint(-50, 50), 'text', None])
+        for spreadsheet in sheets:
+            if value is None:
+                spreadsheet.remove_cell(cell_name)
+            else:
+                spreadsheet.set_cell(cell_name, value)
+        assert sheets[0].get_cell_value('C1') == sheets[1].get_cell_value('C1')
+        assert sheets[0].get_cell_value('C2') == sheets[1].get_cell_value('C2')
+    assert set(sheets[1].range_indexes) == {'A', 'B'}
+
+    # Zeros are numbers too
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_cell('A1', 0)
+    spreadsheet.set_cell('A2', 10)
+    assert spreadsheet.calculate_average('A1', 'A2') == 5
+    assert spreadsheet.find_min('A1', 'A3') == 0
+    assert spreadsheet.evaluate_formula('AVERAGE(A2, 0)') == 5
+
+
+def test_range_cache():
+    spreadsheet = Spreadsheet()
+    for row in range(1, 101):
+        spreadsheet.set_cell(f'A{row}', row)
+    for row in range(1, 11):
+        spreadsheet.set_cell(f'B{row}', formula=f'SUM(A1:A100)+AVERAGE(A1:A100)+{row}')
+    info = spreadsheet.range_cache_info()
+    # SUM and AVERAGE of the same range share one calculation
+    assert info['misses'] == 1 and info['hits'] == 19 and info['entries'] == 1
+    assert spreadsheet.get_cell_value('B3') == 5050 + 50.5 + 3
+
+    spreadsheet.set_cell('C1', formula='MAX(A1:A10)')
+    # A write outside a cached range keeps it
+    spreadsheet.set_cell('A50', 1050)
+    assert spreadsheet.range_cache_info()['entries'] == 1
+    assert spreadsheet.get_cell_value('C1') == 10
+    assert spreadsheet.get_cell_value('B3') == 6050 + 60.5 + 3
+    spreadsheet.set_cell('A5', 500)
+    assert spreadsheet.get_cell_value('C1') == 500
+    spreadsheet.remove_cell('A5')
+    assert spreadsheet.get_cell_value('C1') == 10
+    assert spreadsheet.get_cell_value('B1') == 6045 + 6045 / 99 + 1
+
+
+def test_range_index_widened_past_padded_size():
+    spreadsheet = Spreadsheet("Sheet1")
+    for row in range(1, 121):
+        spreadsheet.set_cell(f"A{row}", row)
+    assert spreadsheet.evaluate_formula("SUM(A1:A100)") == 5050
+    # The index built for 100 rows is padded to 128, the rows past 100 have to be in it too
+    assert spreadsheet.evaluate_formula("SUM(A1:A120)") == 7260
+    assert spreadsheet.evaluate_formula("COUNT(A1:A120)") == 120
+    assert spreadsheet.evaluate_formula("MAX(A50:A120)") == 120
+
+
+def test_statistical_functions():
+    spreadsheet = Spreadsheet()
+    for row, value in enumerate([3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 'text'], 1):
+        spreadsheet.set_cell(f'A{row}', value)
+        spreadsheet.set_cell(f'B{row}', row)
+    assert spreadsheet.evaluate_formula('COUNT(A1:A13)') == 11
+    assert spreadsheet.evaluate_formula('COUNTA(A1:A13, 7)') == 13
+    assert spreadsheet.evaluate_formula('VAR(A1:A13)') == pytest.approx(5.6)
+    assert spreadsheet.evaluate_formula('STDEV(A1:A13)') == pytest.approx(5.6 ** 0.5)
+    assert spreadsheet.evaluate_formula('MEDIAN(A1:A13)') == 4
+    assert spreadsheet.evaluate_formula('MEDIAN(A1:A4)') == 2
+    assert spreadsheet.evaluate_formula('PERCENTILE(A1:A13, 0.3)') == 3
+    assert spreadsheet.evaluate_formula('PERCENTILE(A1:A4, 0.5)') == 2
+    assert spreadsheet.evaluate_formula('SUMPRODUCT(A1:A13, B1:B13)') == 292
+    error = spreadsheet.evaluate_formula('SUMPRODUCT(A1:A13, B1:B12)')
+    assert error == VALUE_ERROR
+    assert error.message == "The ranges of SUMPRODUCT must have the same size."
+    assert spreadsheet.evaluate_formula('PERCENTILE(A1:A13, 2)') == VALUE_ERROR
+    assert spreadsheet.evaluate_formula('VAR(A1)') is None
+
+    # The selection kernel with and without numpy
+    import random
+    import range_kernels
+    values = [random.random() for _ in range(101)]
+    with patch('range_kernels.numpy_module', return_value=None):
+        assert range_kernels.median(list(values)) == sorted(values)[50]
+    assert range_kernels.median(list(values)) == sorted(values)[50]
+    assert range_kernels.quickselect(list(values), 0) == min(values)
+
+
+def test_conditional_functions():
+    spreadsheet = Spreadsheet()
+    fruits = ['apple', 'pear', 'Apple', 'plum', 'apple', 'fig']
+    for row, fruit in enumerate(fruits, 1):
+        spreadsheet.set_cell(f'A{row}', fruit)
+        spreadsheet.set_cell(f'B{row}', row * 10)
+    spreadsheet.set_cell('C1', formula='SUMIF(A1:A6,"apple",B1:B6)')
+    spreadsheet.set_cell('C2', formula='COUNTIF(B1:B6,">=30")')
+    spreadsheet.set_cell('C3', formula='AVERAGEIF(A1:A6,"<>apple",B1:B6)')
+    spreadsheet.set_cell('C4', formula='SUMIF(B1:B6,20)')
+    spreadsheet.set_cell('C5', formula='COUNTIF(A1:B6,"p*")')
+    assert spreadsheet.get_cell_value('C1') == 90
+    assert spreadsheet.get_cell_value('C2') == 4
+    assert spreadsheet.get_cell_value('C3') == 40
+    assert spreadsheet.get_cell_value('C4') == 20
+    assert spreadsheet.get_cell_value('C5') == 0
+    assert set(spreadsheet.value_indexes) == {'A', 'B'}
+
+    # The indexes follow set_cell and remove_cell
+    spreadsheet.set_cell('A2', 'APPLE')
+    spreadsheet.remove_cell('A1')
+    spreadsheet.set_cell('B4', formula='B2+5')
+    spreadsheet.set_cell('B2', 15)
+    assert spreadsheet.get_cell_value('C1') == 15 + 30 + 50
+    # B4 is 20 now, through its formula
+    assert spreadsheet.get_cell_value('C4') == 20
+    assert spreadsheet.evaluate_formula('COUNTIF(B1:B6,20)') == 1
+    assert spreadsheet.evaluate_formula('SUMIF(B1:B6,15)') == 15
+    assert spreadsheet.evaluate_formula('COUNTIF(B4:B4,20)') == 1
+    # An empty criteria counts the empty cells
+    assert spreadsheet.evaluate_formula('COUNTIF(A1:A6,"")') == 1
+    assert spreadsheet.evaluate_formula('COUNTIF(A1:A6,"say ""hi""")') == 0
+    assert spreadsheet.evaluate_formula('AVERAGEIF(A1:A6,"kiwi")') == DIV_ZERO
+    # An error as the criteria is given back, not matched as text
+    spreadsheet.set_cell('A7', '#DIV/0!')
+    spreadsheet.set_cell('D1', formula='1/0')
+    for function in ['COUNTIF(A1:A7,D1)', 'SUMIF(A1:A7,D1,B1:B7)', 'AVERAGEIF(A1:A7,D1,B1:B7)']:
+        assert spreadsheet.evaluate_formula(function) == DIV_ZERO
+
+
+def test_lookup_functions():
+    spreadsheet = Spreadsheet()
+    for row, (name, score) in enumerate([('ann', 50), ('bob', 60), ('cid', 70), ('dan', 80)], 1):
+        spreadsheet.set_cell(f'A{row}', name)
+        spreadsheet.set_cell(f'B{row}', score)
+        spreadsheet.set_cell(f'C{row}', score * 2)
+    assert spreadsheet.evaluate_formula('VLOOKUP("cid",A1:C4,3,FALSE)') == 140
+    assert spreadsheet.evaluate_formula('VLOOKUP(65,B1:C4,2)') == 120
+    assert spreadsheet.evaluate_formula('VLOOKUP(80,B1:C4,2,TRUE)') == 160
+    assert spreadsheet.evaluate_formula('MATCH("Bob",A1:A4,0)') == 2
+    assert spreadsheet.evaluate_formula('MATCH(75,B1:B4)') == 3
+    assert spreadsheet.evaluate_formula('INDEX(A1:C4,4,2)') == 80
+    assert spreadsheet.evaluate_formula('INDEX(C1:C4,2)') == 120
+    assert spreadsheet.evaluate_formula('INDEX(A1:C4,MATCH("dan",A1:A4,0),3)') == 160
+    for col, value in zip('DEFG', [40, 30, 20, 10]):
+        spreadsheet.set_cell(f'{col}1', value)
+        spreadsheet.set_cell(f'{col}2', value + 1)
+    assert spreadsheet.evaluate_formula('HLOOKUP(20,D1:G2,2,0)') == 21
+    assert spreadsheet.evaluate_formula('MATCH(25,D1:G1,-1)') == 2
+    error = spreadsheet.evaluate_formula('VLOOKUP("eve",A1:C4,2,0)')
+    assert error == NA_ERROR
+    assert error.message == "VLOOKUP did not find 'eve'."
+    assert spreadsheet.evaluate_formula('VLOOKUP(10,B1:C4,2)') == NA_ERROR
+    assert spreadsheet.evaluate_formula('INDEX(A1:C4,5,1)') == REF_ERROR
+
+    # Lookups follow the changes of the table
+    spreadsheet.set_cell('E1', formula='VLOOKUP("cid",A1:C4,2,FALSE)')
+    spreadsheet.set_cell('E2', formula='VLOOKUP(65,B1:C4,2)')
+    assert spreadsheet.get_cell_value('E2') == 120
+    spreadsheet.set_cell('B3', 64)
+    spreadsheet.set_cell('A2', 'cid')
+    assert spreadsheet.get_cell_value('E1') == 60
+    assert spreadsheet.get_cell_value('E2') == 140
+
+
+def test_cross_sheet_references(tmp_path):
+    workbook = Workbook(str(tmp_path / "book"))
+    with patch('builtins.print'):
+        workbook.add_sheet('Sheet1')
+        workbook.add_sheet('My Sheet')
+    summary, data = workbook.get_sheet('Sheet1'), workbook.get_sheet('My Sheet')
+    data.set_cell('A1', 5)
+    data.set_cell('A2', 7)
+    summary.set_cell('B1', formula="'My Sheet'!A1*2")
+    summary.set_cell('B2', formula="SUM('My Sheet'!A1:A2)+B1")
+    summary.set_cell('B3', formula="INDEX('My Sheet'!A2:A3,1)")
+    assert summary.get_cell_value('B2') == 22
+    assert summary.get_cell_value('B3') == 7
+
+    # Only the formulas that refer to the changed cell are marked dirty
+    data.set_cell('A1', 10)
+    assert summary.dirty_cells == {'B1', 'B2'}
+    assert summary.get_cell_value('B2') == 37
+
+    # Renaming the sheet rewrites the formulas that refer to it
+    with patch('builtins.print'):
+        workbook.rename_sheet('My Sheet', 'Data')
+    assert summary.get_cell('B2').formula == "SUM(Data!A1:A2)+B1"
+    data.set_cell('A2', 1)
+    assert summary.get_cell_value('B2') == 31
+    workbook.export_to_json(workbook.name)
+    loaded = load_and_open_workbook(str(tmp_path / "book.json"))
+    loaded.get_sheet('Data').set_cell('A1', 0)
+    assert loaded.get_sheet('Sheet1').get_cell_value('B2') == 1
+
+    # Removing the sheet turns the formulas that refer to it into #REF!
+    with patch('builtins.print') as mock_print:
+        workbook.remove_sheet('Data')
+        assert summary.get_cell_value('B1') == REF_ERROR
+        assert summary.get_cell_value('B1').message == "Sheet 'Data' does not exist."
+        summary.set_cell('C1', formula='Sheet1!C1')
+        mock_print.assert_called_with("The cell cannot be dependent on itself.")
+
+
+def test_parallel_recalculation_matches_serial():
+    def build():
+        spreadsheet = formula_chain_spreadsheet(50)
+        spreadsheet.set_many([(f"C{row}", None, f"A{row}/B{row}+SQRT(A{row})") for row in range(1, 51)])
+        spreadsheet.set_many([('D1', 'text', None), ('D2', None, 'D1'), ('D3', None, 'COUNT(A1:A20)'),
+                              ('D4', None, 'D3/0')])
+        spreadsheet.dirty_cells.update(name for name, cell in spreadsheet.cells.items() if cell.formula)
+        return spreadsheet
+
+    serial, parallel = build(), build()
+    with patch('builtins.print'):
+        serial.recalculate()
+        with patch('parallel_recalc.PARALLEL_MIN_CELLS', 0):
+            parallel.recalculate(parallel=True, workers=2)
+    assert not parallel.dirty_cells
+    for cell_name, cell in serial.cells.items():
+        assert parallel.cells[cell_name].value == cell.value
+        assert type(parallel.cells[cell_name].value) is type(cell.value)
+
+
+def test_parallel_workbook_recalculation():
+    def build():
+        workbook = Workbook()
+        with patch('builtins.print'):
+            for index in range(4):
+                workbook.add_sheet(f'Sheet{index}')
+        for index, sheet in enumerate(workbook.sheets.values()):
+            sheet.set_many([(f'A{row}', row * (index + 1), None) for row in range(1, 21)])
+            sheet.set_many([(f'B{row}', None, f'A{row}*2+SUM(A1:A{row})') for row in range(1, 21)])
+        workbook.get_sheet('Sheet3').set_cell('C1', formula='Sheet2!B20')
+        for sheet in workbook.sheets.values():
+            sheet.dirty_cells.update(name for name, cell in sheet.cells.items() if cell.formula)
+        return workbook
+
+    serial, parallel = build(), build()
+    serial.recalculate()
+    with patch('parallel_recalc.PARALLEL_MIN_CELLS', 0):
+        parallel.recalculate(parallel=True, workers=2)
+    for sheet_name, sheet in serial.sheets.items():
+        assert not parallel.get_sheet(sheet_name).dirty_cells
+        assert parallel.get_sheet(sheet_name).to_dict() == sheet.to_dict()
+
+
+def test_formula_profiling(tmp_path):
+    import pstats
+    for backend in FORMULA_BACKENDS:
+        spreadsheet = Spreadsheet("Sheet1", backend)
+        for row in range(1, 6):
+            spreadsheet.set_cell(f"A{row}", row)
+        spreadsheet.set_cell("B1", formula="SUM(A1:A5)*2")
+        profiler = spreadsheet.start_profiling()
+        spreadsheet.set_cell("A1", 10)
+        spreadsheet.set_cell("B2", formula="SQRT(B1)+1")
+        assert spreadsheet.get_cell_value("B1") == 48
+        stats = profiler.stats()
+        assert stats['cells']['B1']['count'] == 1
+        assert stats['cells']['B2']['count'] == 1
+        assert stats['functions']['SUM']['count'] == 1
+        assert stats['functions']['SQRT']['count'] == 1
+        assert stats['cells']['B1']['total_time'] >= stats['cells']['B1']['own_time']
+        assert profiler.hottest_cells(1)[0][0] in ("B1", "B2")
+        assert spreadsheet.stop_profiling() is profiler
+        spreadsheet.set_cell("A2", 20)
+        assert profiler.stats()['cells']['B1']['count'] == 1
+    profiler.export_json(tmp_path / "profile.json")
+    with open(tmp_path / "profile.json") as file:
+        assert json.load(file)['cells']['B2']['count'] == 1
+    profiler.export_pstats(str(tmp_path / "profile.prof"))
+    assert pstats.Stats(str(tmp_path / "profile.prof")).total_calls == 4
+
+
+def test_benchmark_suite(tmp_path):
+    from benchmark_suite import GENERATORS, run_suite, save_results, load_results, compare_results
+    for generate in GENERATORS.values():
+        workbook = generate(40)
+        assert any(cell.formula for sheet in workbook.sheets.values() for cell in sheet.cells.values())
+    results = run_suite(40, operations=["set_cell", "get_cell_value", "load_and_open_workbook"], repeat=1)
+    assert set(results) == set(GENERATORS)
+    assert all(seconds >= 0 for times in results.values() for seconds in times.values())
+    chain = GENERATORS["chain"](40).get_sheet("Chain")
+    assert chain.get_cell_value("B40") == pytest.approx(sum((row % 89 + 0.5) / row for row in range(1, 41)))
+    save_results(results, str(tmp_path / "results.json"), 40)
+    assert load_results(str(tmp_path / "results.json")) == results
+    baseline = {'chain': {'set_cell': 0.001, 'get_cell_value': 1000.0}}
+    slower = {'chain': {'set_cell': 1.0, 'get_cell_value': 1.0, 'str': 1.0}}
+    assert compare_results(slower, baseline) == [('chain', 'set_cell', 0.001, 1.0)]
+
+
+def test_memory_measurement():
+    from benchmark_suite import measure_memory, memory_table
+    measurements = measure_memory(200, references=3)
+    assert measurements['cells']['count'] == 203
+    assert measurements['formulas']['count'] == 400
+    assert measurements['edges']['count'] == 800
+    assert all(measurement['bytes_per_item'] > 0 for measurement in measurements.values())
+    assert "bytes per item" in memory_table(measurements)
+
+
+def test_error_values(tmp_path):
+    import logging
+    for backend in FORMULA_BACKENDS:
+        spreadsheet = Spreadsheet("Sheet1", backend)
+        spreadsheet.set_cell('A1', 10)
+        spreadsheet.set_cell('A2', 0)
+        spreadsheet.set_cell('A3', 'text')
+        with patch('builtins.print') as mock_print:
+            spreadsheet.set_cell('B1', formula='A1/A2')
+            spreadsheet.set_cell('B2', formula='B1*2+1')
+            spreadsheet.set_cell('B3', formula='-A3')
+            spreadsheet.set_cell('B4', formula='SQRT(A1-20)')
+            spreadsheet.set_cell('B5', formula='SUM(A1:A3,B1)')
+            spreadsheet.set_cell('B6', formula='MAX(B1:B2)')
+            spreadsheet.set_cell('B7', formula='A1+Z9')
+            mock_print.assert_not_called()
+        assert spreadsheet.get_cell_value('B1') == DIV_ZERO
+        # Errors propagate to the cells that depend on them
+        assert spreadsheet.get_cell_value('B2') == DIV_ZERO
+        assert spreadsheet.get_cell_value('B3') == VALUE_ERROR
+        assert spreadsheet.get_cell_value('B4') == NUM_ERROR
+        assert spreadsheet.get_cell_value('B5') == DIV_ZERO
+        assert spreadsheet.get_cell_value('B6') == DIV_ZERO
+        # An empty cell is not an error
+        assert spreadsheet.get_cell_value('B7') is None
+        assert "#DIV/0!" in str(spreadsheet)
+        spreadsheet.set_cell('A2', 5)
+        assert spreadsheet.get_cell_value('B2') == 5
+        assert spreadsheet.get_cell_value('B6') == 5
+
+        # A circular reference gets #CYCLE! in every cell of the circle
+        spreadsheet.set_cell('C1', formula='C2+1')
+        spreadsheet.set_cell('C2', formula='C1+1')
+        assert spreadsheet.get_cell_value('C2') == CYCLE_ERROR
+        assert spreadsheet.get_cell_value('C1') == CYCLE_ERROR
+        spreadsheet.set_cell('C2', 1)
+        assert spreadsheet.get_cell_value('C1') == 2
+
+    # Errors in large ranges are found through the range index
+    spreadsheet = Spreadsheet()
+    spreadsheet.set_many([(f"A{row}", row, None) for row in range(1, 201)])
+    spreadsheet.set_cell('B1', formula='SUM(A1:A200)')
+    assert spreadsheet.get_cell_value('B1') == 20100
+    spreadsheet.set_cell('A150', formula='1/0')
+    assert spreadsheet.get_cell_value('B1') == DIV_ZERO
+    assert spreadsheet.evaluate_formula('SUM(A1:A100)') == 5050
+    assert spreadsheet.evaluate_formula('COUNT(A1:A200)') == 199
+    spreadsheet.set_cell('A150', 150)
+    assert spreadsheet.get_cell_value('B1') == 20100
+
+    # COUNT skips an error, while the other aggregates of the range give it
+    for backend in FORMULA_BACKENDS:
+        spreadsheet = Spreadsheet("Sheet1", backend)
+        spreadsheet.set_many([('A1', 1, None), ('A2', 2, None), ('A3', None, '1/0'), ('A4', 4, None), ('A5', 5, None)])
+        assert spreadsheet.evaluate_formula('COUNT(A1:A5)') == 4
+        assert spreadsheet.evaluate_formula('COUNT(A5:A1)') == REF_ERROR
+        assert spreadsheet.evaluate_formula('SUM(A1:A5)') == DIV_ZERO
+        assert spreadsheet.evaluate_formula('MAX(A1:A5)') == DIV_ZERO
+        assert spreadsheet.evaluate_formula('AVERAGE(A1:A5)') == DIV_ZERO
+
+    # Errors are saved as their code and read back as errors
+    workbook = Workbook("errors")
+    workbook.attach_sheet("Sheet1", Spreadsheet())
+    sheet = workbook.get_sheet("Sheet1")
+    sheet.set_cell('A1', '#N/A')
+    sheet.set_cell('B1', formula='1/0')
+    workbook.export_to_json(str(tmp_path / "errors"))
+    loaded = load_and_open_workbook(str(tmp_path / "errors.json"), verify=True).get_sheet("Sheet1")
+    assert loaded.get_cell_value('B1') == DIV_ZERO
+    assert loaded.get_cell_value('A1') == '#N/A'
+
+    # Diagnostics go to the spreadsheet's logger
+    messages = []
+    handler = logging.Handler()
+    handler.emit = lambda record: messages.append(record.getMessage())
+    sheet.logger = logging.getLogger("test_error_values")
+    sheet.logger.addHandler(handler)
+    sheet.logger.setLevel(logging.DEBUG)
+    assert sheet.evaluate_formula('NOPE(A1)') == NAME_ERROR
+    assert messages == ["Error in formula 'NOPE(A1)': Unknown function 'NOPE'."]
+    # A bug of the spreadsheet itself is logged as a warning, with its traceback
+    records = []
+    handler.emit = records.append
+    with patch.object(sheet, 'evaluate_node', side_effect=KeyError("bug")):
+        assert sheet.evaluate_formula('A1') == VALUE_ERROR
+    assert records[-1].levelno == logging.WARNING and records[-1].exc_info is not None
+
+
+def test_deep_chain_is_not_a_cycle():
+    for backend in FORMULA_BACKENDS:
+        spreadsheet = Spreadsheet("Sheet1", backend)
+        for row in range(3000, 1, -1):
+            spreadsheet.set_cell(f"A{row}", formula=f"A{row - 1}+1")
+        spreadsheet.set_cell('A1', 1)
+        # The chain of dirty cells is deeper than the Python stack allows
+        assert spreadsheet.get_cell_value('A3000') == 3000
+        assert not spreadsheet.dirty_cells
+        assert spreadsheet.evaluate_formula("(" * 5000 + "1" + ")" * 5000) == NUM_ERROR
+
+
+def test_workbook_server(tmp_path):
+    import asyncio
+    from workbook_server import WorkbookServer
+    from load_test import HttpClient, load_test_workbook, run_load_test
+
+    async def scenario():
+        server = WorkbookServer(load_test_workbook(20), port=0, export_directory=str(tmp_path))
+        await server.start()
+        client = HttpClient("127.0.0.1", server.port)
+        await client.connect()
+        try:
+            # Every request goes on the same kept-alive connection
+            assert await client.request("GET", "/sheets") == (200, {'sheets': ["Sheet1"]})
+            assert await client.request("GET", "/sheets/Sheet1/cells/C1") == \
+                (200, {'cell': "C1", 'value': 420, 'formula': "SUM(B1:B20)"})
+            assert (await client.request("PUT", "/sheets/Sheet1/cells/A1", {'value': 11}))[1]['value'] == 11
+            status, body = await client.request("PUT", "/sheets/Sheet1/cells/D1", {'formula': "=A1/0"})
+            assert status == 200 and body['value'] == "#DIV/0!"
+            status, body = await client.request("PUT", "/sheets/Sheet1/cells/D2", {'formula': "D2+1"})
+            assert status == 400 and "itself" in body['error']
+            status, body = await client.request("PUT", "/sheets/Sheet1/ranges/A2:B3", {'values': [[5, "=A2+"], [6, 1]]})
+            assert status == 400 and "B2" in body['error']
+            assert await client.request("PUT", "/sheets/Sheet1/ranges/A2:B3", {'values': [[5, None], [6, "=A2+A3"]]}) \
+                == (200, {'set': 3})
+            assert await client.request("GET", "/sheets/Sheet1/ranges/A1:B3") == \
+                (200, {'range': "A1:B3", 'values': [[11, 22], [5, 10], [6, 11]]})
+            assert (await client.request("POST", "/recalculate"))[0] == 200
+            assert (await client.request("GET", "/sheets/Sheet1/cells/C1"))[1]['value'] == 451
+            assert (await client.request("PUT", "/sheets/Sheet1/ranges/A1:A2", {'values': [[1]]}))[0] == 400
+            assert (await client.request("GET", "/sheets/Other/cells/A1"))[0] == 404
+            assert (await client.request("GET", "/sheets/Sheet1/cells/1A"))[0] == 400
+            assert (await client.request("POST", "/export", {'name': "../book"}))[0] == 400
+            assert await client.request("POST", "/export", {'format': "json", 'name': "book"}) == \
+                (200, {'format': "json", 'name': "book"})
+            # Changes are applied while an export is being written
+            release = threading.Event()
+            exporter = HttpClient("127.0.0.1", server.port)
+            await exporter.connect()
+            with patch.object(Workbook, 'export_to_csv', side_effect=lambda path: release.wait(5)):
+                export = asyncio.ensure_future(exporter.request("POST", "/export", {'format': "csv"}))
+                await asyncio.sleep(0.05)
+                assert (await client.request("PUT", "/sheets/Sheet1/cells/E1", {'value': 1}))[0] == 200
+                assert not export.done()
+                release.set()
+                assert (await export)[0] == 200
+            await exporter.close()
+        finally:
+            await client.close()
+        results = await run_load_test("127.0.0.1", server.port, connections=4, requests=200, write_ratio=0.2, rows=20)
+        await server.stop()
+        return results
+
+    results = asyncio.run(scenario())
+    assert results['requests'] == 200 and results['errors'] == 0
+    assert results['p99_ms'] >= results['p50_ms'] > 0
+    exported = load_and_open_workbook(str(tmp_path / "book.json")).get_sheet("Sheet1")
+    assert exported.get_cell_value("B3") == 11
+    assert exported.get_cell_value("D1") == DIV_ZERO
+
+
+def test_workbook_cache(tmp_path):
+    from workbook_cache import WorkbookCache, WorkbookConflictError, estimate_workbook_size, CELL_SIZE_ESTIMATE
+    paths = []
+    for index in range(3):
+        workbook = Workbook(f"book{index}")
+        workbook.add_sheet("Sheet1")
+        sheet = workbook.get_sheet("Sheet1")
+        for row in range(1, 11):
+            sheet.set_cell(f"A{row}", row * index)
+        workbook.export_to_json(str(tmp_path / f"book{index}"))
+        paths.append(str(tmp_path / f"book{index}.json"))
+    assert estimate_workbook_size(load_and_open_workbook(paths[0])) == 10 * CELL_SIZE_ESTIMATE
+
+    # Room for two of the three workbooks
+    cache = WorkbookCache(memory_budget=25 * CELL_SIZE_ESTIMATE)
+    first = cache.get(paths[0])
+    assert cache.get(paths[0]) is first
+    first.get_sheet("Sheet1").set_cell("A1", 100)
+    assert cache.is_dirty(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[2])
+    # The least recently used workbook was evicted and its change written back
+    assert paths[0] not in cache and paths[1] in cache and paths[2] in cache
+    assert load_and_open_workbook(paths[0]).get_sheet("Sheet1").get_cell_value("A1") == 100
+    reloaded = cache.get(paths[0])
+    assert reloaded is not first and reloaded.get_sheet("Sheet1").get_cell_value("A1") == 100
+    assert paths[1] not in cache
+    metrics = cache.metrics()
+    assert (metrics['hits'], metrics['misses'], metrics['evictions'], metrics['write_backs']) == (1, 4, 2, 1)
+    assert metrics['hit_rate'] == pytest.approx(0.2)
+    assert metrics['resident_workbooks'] == 2 and metrics['resident_bytes'] == 20 * CELL_SIZE_ESTIMATE
+
+    # A file that changed on disk is loaded again
+    changed = Workbook("book2")
+    changed.add_sheet("Sheet1")
+    changed.get_sheet("Sheet1").set_cell("A1", -1)
+    changed.export_to_json(str(tmp_path / "book2"))
+    os.utime(paths[2], (time.time() + 10, time.time() + 10))
+    assert cache.get(paths[2]).get_sheet("Sheet1").get_cell_value("A1") == -1
+    assert cache.resident_size() == 11 * CELL_SIZE_ESTIMATE
+
+    # A file that changed on disk while its workbook changed in memory is a conflict, not a reload
+    resident = cache.get(paths[2])
+    resident.get_sheet("Sheet1").set_cell("A2", 7)
+    changed.export_to_json(str(tmp_path / "book2"))
+    os.utime(paths[2], (time.time() + 20, time.time() + 20))
+    with pytest.raises(WorkbookConflictError):
+        cache.get(paths[2])
+    assert cache.is_dirty(paths[2])
+    assert cache.flush() == 1
+    assert cache.get(paths[2]) is resident
+    assert load_and_open_workbook(paths[2]).get_sheet("Sheet1").get_cell_value("A2") == 7
+
+    reloaded.get_sheet("Sheet1").set_cell("B1", formula="A1*2")
+    assert cache.flush() == 1 and not cache.is_dirty(paths[0])
+    hits = cache.hits
+    assert cache.get(paths[0]) is reloaded and cache.hits == hits + 1
+
+    # A resident workbook whose file was deleted is served and written back
+    reloaded.get_sheet("Sheet1").set_cell("C1", 5)
+    os.remove(paths[0])
+    assert cache.get(paths[0]) is reloaded and not cache.is_dirty(paths[0])
+    assert load_and_open_workbook(paths[0]).get_sheet("Sheet1").get_cell_value("C1") == 5
+    cache.clear()
+    assert cache.metrics()['resident_bytes'] == 0
+    assert load_and_open_workbook(paths[0]).get_sheet("Sheet1").get_cell_value("B1") == 200
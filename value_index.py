@@ -0,0 +1,132 @@
+from typing import *
+from formula_errors import FormulaError, FormulaErrorException
+
+# The comparison operators a criteria can start with, longest first so ">=" is not read as ">"
+CRITERIA_OPERATORS = ["<>", ">=", "<=", "=", ">", "<"]
+
+
+def value_key(value: Any) -> Any:
+    """
+    Converts a cell value to the key it is indexed under.
+    Numbers are compared by value and texts without regard to case, like the criteria of SUMIF in Excel.
+
+    :param value: The value of a cell.
+    :return: The key, or None for empty cells.
+    """
+    if isinstance(value, int) or isinstance(value, float):
+        return float(value)
+    if value is None or value == "":
+        return
+    return str(value).lower()
+
+
+def parse_criteria(criteria: Any) -> Tuple[str, Any]:
+    """
+    Splits the criteria of SUMIF, COUNTIF and AVERAGEIF into an operator and an operand.
+    for example: 5 -> ("=", 5.0), ">=10" -> (">=", 10.0), "apple" -> ("=", "apple"), "<>" -> ("<>", None)
+
+    :param criteria: A number or a text, which may start with =, <>, >, >=, < or <=.
+    :return: The operator and the operand as an index key.
+    :raises FormulaErrorException: If the criteria is an error, so the function gives that error.
+    """
+    if isinstance(criteria, FormulaError):
+        raise FormulaErrorException(criteria)
+    if not isinstance(criteria, str):
+        return "=", value_key(criteria)
+    operator = "="
+    for candidate in CRITERIA_OPERATORS:
+        if criteria.startswith(candidate):
+            operator = candidate
+            criteria = criteria[len(candidate):]
+            break
+    try:
+        return operator, float(criteria)
+    except ValueError:
+        return operator, value_key(criteria)
+
+
+def matches_criteria(operator: str, operand: Any, value: Any) -> bool:
+    """
+    Checks whether a cell value meets a criteria.
+    Numbers are only compared to numbers and texts to texts.
+
+    :param operator: The operator of the criteria.
+    :param operand: The operand of the criteria, as an index key.
+    :param value: The value of the cell.
+    :return: True if the value meets the criteria.
+    """
+    key = value_key(value)
+    if operator == "=":
+        return key == operand
+    if operator == "<>":
+        return key != operand
+    if key is None or operand is None or isinstance(key, float) != isinstance(operand, float):
+        return False
+    if operator == ">":
+        return key > operand
+    if operator == ">=":
+        return key >= operand
+    if operator == "<":
+        return key < operand
+    return key <= operand
+
+
+class ColumnValueIndex:
+    """
+    A hash index from the values of one column to the rows that hold them,
+    so an equality criteria finds its rows in O(matching rows) instead of scanning the range.
+    Rows whose value may have changed are marked stale and indexed again before the next query.
+    """
+
+    def __init__(self, rows: int, keys: Dict[int, Any], stale_rows: Iterable[int]) -> None:
+        """
+        Initializes the index of a column.
+
+        :param rows: The number of rows the index covers, starting at row 1.
+        :param keys: The key of every row that is not empty, see value_key.
+        :param stale_rows: The rows whose value is not known yet.
+        """
+        self.rows = rows
+        self.key_of_row: Dict[int, Any] = {}
+        self.rows_of_key: Dict[Any, Set[int]] = {}
+        self.stale: Set[int] = set(stale_rows)
+        for row, key in keys.items():
+            self.set_key(row, key)
+
+    def set_key(self, row: int, key: Any) -> None:
+        """
+        Moves a row to the rows of a new key and clears its stale mark.
+
+        :param row: The row.
+        :param key: The new key of the row, None if the row is empty.
+        """
+        self.stale.discard(row)
+        old_key = self.key_of_row.pop(row, None)
+        if old_key is not None:
+            rows = self.rows_of_key[old_key]
+            rows.discard(row)
+            if not rows:
+                del self.rows_of_key[old_key]
+        if key is not None:
+            self.key_of_row[row] = key
+            self.rows_of_key.setdefault(key, set()).add(row)
+
+    def mark_stale(self, row: int) -> None:
+        """
+        Marks a row whose value may have changed.
+
+        :param row: The row. Rows the index does not cover are ignored.
+        """
+        if row <= self.rows:
+            self.stale.add(row)
+
+    def matching_rows(self, key: Any, first: int, last: int) -> List[int]:
+        """
+        Finds the rows of a range that hold a key. Stale rows have to be indexed again before.
+
+        :param key: The key to find.
+        :param first: The first row of the range.
+        :param last: The last row of the range.
+        :return: The matching rows, from top to bottom.
+        """
+        return sorted(row for row in self.rows_of_key.get(key, ()) if first <= row <= last)
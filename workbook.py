@@ -1,10 +1,13 @@
 from electronic_sheet import *
 import csv, json
-import xlsxwriter  # type: ignore
-from reportlab.pdfgen import canvas  # type: ignore
-from reportlab.lib.pagesizes import letter  # type: ignore
+import threading
 from typing import *
 
+# Version 1 files store every sheet at the top level, with the dependents of every cell.
+# Version 2 files store the sheets under "sheets" with only values and formulas,
+# and the dependents are rebuilt from the formulas when the file is loaded.
+FORMAT_VERSION = 2
+
 
 class Workbook:
     """
@@ -19,6 +22,16 @@ class Workbook:
         """
         self.sheets: Dict[str, Spreadsheet] = {}
         self.name = name
+        # Incremented whenever sheets are added, removed or renamed
+        self.version = 0
+        # Guards the sheets dictionary against being copied while it is being modified
+        self.lock = threading.RLock()
+        # The formulas that refer to the cells of every sheet, as (sheet, cell name), by sheet name
+        # and then by referenced cell name, so a change marks only the affected cells of other sheets dirty
+        self.reference_dependents: Dict[str, Dict[str, Set[Tuple[Spreadsheet, str]]]] = {}
+        # The formulas that refer to every sheet, by sheet name,
+        # so renaming or removing a sheet only visits the formulas that refer to it
+        self.referencing_cells: Dict[str, Set[Tuple[Spreadsheet, str]]] = {}
 
     def add_sheet(self, sheet_name: str) -> None:
         """
@@ -30,9 +43,77 @@ class Workbook:
         if sheet_name in self.sheets:
             print(f"Sheet '{sheet_name}' already exists.")
         else:
-            self.sheets[sheet_name] = Spreadsheet(sheet_name)
+            with self.lock:
+                self.attach_sheet(sheet_name, Spreadsheet(sheet_name))
+                # Formulas that referred to the sheet before it existed can be calculated now
+                self.mark_referencing_cells_dirty(sheet_name)
+                self.version += 1
             print(f"Sheet '{sheet_name}' added to the workbook.")
 
+    def attach_sheet(self, sheet_name: str, spreadsheet: Spreadsheet) -> None:
+        """
+        Puts a spreadsheet in the workbook under a name and records the references of its formulas to other sheets.
+
+        :param sheet_name: The name of the sheet.
+        :param spreadsheet: The spreadsheet.
+        """
+        spreadsheet.name = sheet_name
+        spreadsheet.workbook = self
+        self.sheets[sheet_name] = spreadsheet
+        for cell_name, sheet_references in spreadsheet.sheet_references.items():
+            self.add_references(spreadsheet, cell_name, sheet_references)
+
+    def add_references(self, spreadsheet: Spreadsheet, cell_name: str,
+                       sheet_references: Dict[str, List[str]]) -> None:
+        """
+        Records the cells that a formula refers to in other sheets.
+
+        :param spreadsheet: The sheet of the formula.
+        :param cell_name: The name of the formula cell.
+        :param sheet_references: The referenced cell names, by sheet name.
+        """
+        formula_cell = (spreadsheet, cell_name)
+        for sheet_name, cell_names in sheet_references.items():
+            dependents = self.reference_dependents.setdefault(sheet_name, {})
+            for name in cell_names:
+                dependents.setdefault(name, set()).add(formula_cell)
+            self.referencing_cells.setdefault(sheet_name, set()).add(formula_cell)
+
+    def remove_references(self, spreadsheet: Spreadsheet, cell_name: str,
+                          sheet_references: Dict[str, List[str]]) -> None:
+        """
+        Forgets the cells that a formula referred to in other sheets, in O(references).
+
+        :param spreadsheet: The sheet of the formula.
+        :param cell_name: The name of the formula cell.
+        :param sheet_references: The referenced cell names, by sheet name, as they were recorded.
+        """
+        formula_cell = (spreadsheet, cell_name)
+        for sheet_name, cell_names in sheet_references.items():
+            dependents = self.reference_dependents.get(sheet_name, {})
+            for name in cell_names:
+                formula_cells = dependents.get(name)
+                if formula_cells is not None:
+                    formula_cells.discard(formula_cell)
+                    if not formula_cells:
+                        del dependents[name]
+            if not dependents:
+                self.reference_dependents.pop(sheet_name, None)
+            formula_cells = self.referencing_cells.get(sheet_name)
+            if formula_cells is not None:
+                formula_cells.discard(formula_cell)
+                if not formula_cells:
+                    del self.referencing_cells[sheet_name]
+
+    def mark_referencing_cells_dirty(self, sheet_name: str) -> None:
+        """
+        Marks every formula that refers to a sheet dirty, after the sheet was added, removed or replaced.
+
+        :param sheet_name: The name of the sheet.
+        """
+        for spreadsheet, cell_name in self.referencing_cells.get(sheet_name, ()):
+            spreadsheet.mark_dirty(cell_name)
+
     def remove_sheet(self, sheet_name: str) -> None:
         """
         Removes the spreadsheet with the given name from the workbook, if it exists.
@@ -41,7 +122,14 @@ class Workbook:
         :param sheet_name: The name of the sheet to be removed.
         """
         if sheet_name in self.sheets:
-            del self.sheets[sheet_name]
+            with self.lock:
+                spreadsheet = self.sheets.pop(sheet_name)
+                for cell_name, sheet_references in spreadsheet.sheet_references.items():
+                    self.remove_references(spreadsheet, cell_name, sheet_references)
+                spreadsheet.workbook = None
+                # The formulas that refer to the sheet cannot be calculated anymore
+                self.mark_referencing_cells_dirty(sheet_name)
+                self.version += 1
             print(f"Sheet '{sheet_name}' has been removed.")
         else:
             print(f"Sheet '{sheet_name}' does not exist.")
@@ -76,6 +164,7 @@ class Workbook:
         """
         Renames an existing sheet from old_name to new_name, if old_name exists and new_name does not.
         If old_name does not exist or new_name already exists, a message is printed and no sheet is renamed.
+        The formulas that refer to the sheet are rewritten with the new name.
 
         :param old_name: The current name of the sheet to be renamed.
         :param new_name: The new name for the sheet.
@@ -85,9 +174,56 @@ class Workbook:
         elif new_name in self.sheets:
             print(f"Sheet '{new_name}' already exists.")
         else:
-            self.sheets[new_name] = self.sheets.pop(old_name)
+            with self.lock:
+                spreadsheet = self.sheets.pop(old_name)
+                spreadsheet.name = new_name
+                self.sheets[new_name] = spreadsheet
+                self.rename_references(old_name, new_name)
+                self.version += 1
             print(f"Sheet '{old_name}' has been renamed to '{new_name}'.")
 
+    def rename_references(self, old_name: str, new_name: str) -> None:
+        """
+        Rewrites the formulas that refer to a renamed sheet, visiting only those formulas.
+        Their values do not change, so they are not calculated again.
+        Formulas that referred to a sheet with the new name before it existed refer to the renamed sheet now,
+        so they are marked dirty.
+
+        :param old_name: The old name of the sheet.
+        :param new_name: The new name of the sheet.
+        """
+        self.mark_referencing_cells_dirty(new_name)
+        formula_cells = self.referencing_cells.pop(old_name, set())
+        dependents = self.reference_dependents.pop(old_name, {})
+        for spreadsheet, cell_name in formula_cells:
+            cell = spreadsheet.cells[cell_name]
+            cell.formula = rename_sheet_references(cell.formula, old_name, new_name)
+            sheet_references = spreadsheet.sheet_references[cell_name]
+            sheet_references.setdefault(new_name, []).extend(sheet_references.pop(old_name))
+            spreadsheet.version += 1
+        if formula_cells:
+            self.referencing_cells.setdefault(new_name, set()).update(formula_cells)
+        if dependents:
+            new_dependents = self.reference_dependents.setdefault(new_name, {})
+            for name, cells in dependents.items():
+                new_dependents.setdefault(name, set()).update(cells)
+
+    def recalculate(self, parallel: bool = False, workers: Optional[int] = None) -> None:
+        """
+        Recalculates the dirty cells of every sheet.
+        A formula that refers to a dirty cell of another sheet calculates that cell first, when it reads it.
+
+        :param parallel: If True, sheets without references to or from other sheets
+        are recalculated at the same time on a pool of processes, see parallel_recalc.
+        :param workers: The number of processes, the number of CPUs by default.
+        """
+        sheets = list(self.sheets.values())
+        if parallel:
+            from parallel_recalc import recalculate_sheets_in_parallel
+            sheets = recalculate_sheets_in_parallel(sheets, workers)
+        for spreadsheet in sheets:
+            spreadsheet.recalculate()
+
     def to_dict(self) -> Dict[str, Dict[str, Any]]:
         """
         Converts the workbook to a dictionary where each key is a sheet name and each value is a dictionary representation of the corresponding sheet.
@@ -95,6 +231,14 @@ class Workbook:
         """
         return {sheet_name: sheet.to_dict() for sheet_name, sheet in self.sheets.items()}
 
+    def to_json_dict(self) -> Dict[str, Any]:
+        """
+        Converts the workbook to the dictionary that is saved in JSON files.
+
+        :return: A dictionary with the format version and the dictionary representation of every sheet.
+        """
+        return {'format_version': FORMAT_VERSION, 'sheets': self.to_dict()}
+
     def dict_print(self) -> None:
         """
         Prints the dictionary representation of the workbook to the console.
@@ -107,9 +251,8 @@ class Workbook:
 
         :param filename: The name of the file to save the workbook to.
         """
-        workbook_dict = {name: sheet.to_dict() for name, sheet in self.sheets.items()}
         with open(filename + ".json", 'w') as f:
-            json.dump(workbook_dict, f)
+            json.dump(self.to_json_dict(), f)
 
 
     def export_to_csv(self, filename: str) -> None:
@@ -137,6 +280,8 @@ class Workbook:
         Each sheet is saved to a separate tab in the Excel file.
         :param filename: The name of the Excel file to be created. The .xlsx extension is added automatically.
         """
+        # Imported here rather than at the top, so the program starts fast when nothing is exported
+        import xlsxwriter  # type: ignore
 
         # Create a new Excel workbook
         workbook = xlsxwriter.Workbook(f"{filename}.xlsx")
@@ -147,7 +292,7 @@ class Workbook:
             for i in range(1, spreadsheet.max_row() + 1):
                 for j in range(spreadsheet.max_col_index() + 1):
                     cell_name = f"{spreadsheet.col_index_to_letter(j)}{i}"
-                    cell_value = spreadsheet.get_cell_value(cell_name)
+                    cell_value = stored_value(spreadsheet.get_cell_value(cell_name))
                     # Write the cell value to the Excel worksheet
                     worksheet.write(i - 1, j, cell_value)
 
@@ -161,6 +306,9 @@ class Workbook:
         :param filename: The base name of the PDF files to be created.
         The sheet name and .pdf extension are added automatically.
         """
+        # Imported here rather than at the top, so the program starts fast when nothing is exported
+        from reportlab.pdfgen import canvas  # type: ignore
+        from reportlab.lib.pagesizes import letter  # type: ignore
 
         for sheet_name, spreadsheet in self.sheets.items():
             c = canvas.Canvas(f"{filename}_{sheet_name}.pdf", pagesize=letter)
@@ -208,18 +356,28 @@ class Workbook:
             c.save()
 
 
-def load_and_open_workbook(filename: str) -> Workbook:
+def load_and_open_workbook(filename: str, verify: bool = False) -> Workbook:
     """
     Loads a workbook file and opens it for editing.
-    The file is expected to be in JSON format,
-    with each key being a sheet name and each value being a dictionary representation of the corresponding sheet.
+    The file is expected to be in JSON format, as written by export_to_json.
+    Files in the older format, with each key being a sheet name
+    and each value being a dictionary representation of the corresponding sheet, are supported as well.
+    The values saved for formula cells are trusted, so no formula is evaluated while loading.
     :param filename: The name of the workbook file to be opened.
     The .json extension is expected to be included in the filename.
+    :param verify: If True, every formula is evaluated after loading,
+    and a message is printed for each cell whose saved value was out of date.
     :return: The loaded Workbook instance.
     """
     # Open the JSON file
     with open(filename, 'r') as f:
         workbook_dict = json.load(f)
+    format_version = workbook_dict.get('format_version')
+    if isinstance(format_version, int):
+        if format_version > FORMAT_VERSION:
+            raise ValueError(f"The file was saved in format version {format_version}, "
+                             f"which is newer than the supported version {FORMAT_VERSION}.")
+        workbook_dict = workbook_dict['sheets']
     # Remove the .json extension from the filename
     workbook_name = filename.rsplit('.', 1)[0]
     workbook = Workbook(workbook_name)
@@ -229,13 +387,40 @@ def load_and_open_workbook(filename: str) -> Workbook:
         for cell_name, cell_data in sheet_data.items():
             value = cell_data.get('value')
             formula = cell_data.get('formula')
-            dependents = cell_data.get('dependents', [])
-            cell = Cell(value=value, formula=formula)
-            # Update the cell's dependents
-            cell.update_dependents(dependents)
+            if formula:
+                # Errors are saved as their code, see stored_value
+                value = loaded_value(value)
             # Set the cell in the Spreadsheet object
-            spreadsheet.cells[cell_name] = cell
+            spreadsheet.cells[cell_name] = Cell(value=value, formula=formula)
+        # Rebuild the dependents from the formulas,
+        # version 1 files have them saved but older versions may have saved them wrong
+        spreadsheet.rebuild_dependencies()
         # Add the Spreadsheet object to the workbook
-        workbook.sheets[sheet_name] = spreadsheet
+        workbook.attach_sheet(sheet_name, spreadsheet)
+    if verify:
+        # Only once every sheet is loaded, since formulas may refer to other sheets
+        for spreadsheet in workbook.sheets.values():
+            verify_computed_values(spreadsheet)
 
     return workbook
+
+
+def verify_computed_values(spreadsheet: Spreadsheet) -> List[str]:
+    """
+    Evaluates every formula in a spreadsheet and compares the result with the value that was stored for it.
+    A message is printed for every cell whose stored value was different, and the evaluated value is kept.
+
+    :param spreadsheet: The spreadsheet to verify.
+    :return: A list of the names of the cells whose stored value was different.
+    """
+    saved_values = {cell_name: cell.value for cell_name, cell in spreadsheet.cells.items() if cell.formula}
+    spreadsheet.dirty_cells.update(saved_values.keys())
+    spreadsheet.recalculate()
+    mismatches = []
+    for cell_name, saved_value in saved_values.items():
+        computed_value = spreadsheet.cells[cell_name].value
+        if computed_value != saved_value:
+            print(f"Cell '{cell_name}' in sheet '{spreadsheet.name}' was saved as {saved_value}, "
+                  f"but its formula evaluates to {computed_value}.")
+            mismatches.append(cell_name)
+    return mismatches
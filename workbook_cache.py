@@ -0,0 +1,287 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import *
+from workbook import *
+
+# The estimated memory of the parts of a workbook, in bytes, close to what
+# python benchmark_suite.py --memory measures: a cell with a value, a cell with a formula
+# (with its parse tree), and every dependency edge between two cells
+CELL_SIZE_ESTIMATE = 400
+FORMULA_SIZE_ESTIMATE = 600
+DEPENDENT_SIZE_ESTIMATE = 300
+
+# The memory the resident workbooks may take when no budget is given, in bytes
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def estimate_workbook_size(workbook: Workbook) -> int:
+    """
+    Estimates the memory a workbook takes from the number of its cells, formulas and dependency edges.
+
+    :param workbook: The workbook.
+    :return: The estimated size in bytes.
+    """
+    size = 0
+    with workbook.lock:
+        sheets = list(workbook.sheets.values())
+    for sheet in sheets:
+        with sheet.lock:
+            for cell in sheet.cells.values():
+                size += FORMULA_SIZE_ESTIMATE if cell.formula else CELL_SIZE_ESTIMATE
+                size += len(cell.dependents) * DEPENDENT_SIZE_ESTIMATE
+    return size
+
+
+def workbook_versions(workbook: Workbook) -> Tuple[Any, ...]:
+    """
+    Retrieves the versions of a workbook and of its sheets, which change whenever anything in the workbook changes.
+
+    :param workbook: The workbook.
+    :return: A tuple that is equal for two calls only if nothing changed in between.
+    """
+    with workbook.lock:
+        return (workbook.version,) + tuple((sheet_name, id(sheet), sheet.version)
+                                           for sheet_name, sheet in workbook.sheets.items())
+
+
+class WorkbookConflictError(Exception):
+    """
+    Raised when the file of a resident workbook changed on disk while the workbook has changes of its own,
+    so either the changes in memory or the changes on disk would be lost.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Initializes the error.
+
+        :param path: The absolute path of the workbook's JSON file.
+        """
+        super().__init__(f"The file '{path}' changed on disk while its workbook has unsaved changes.")
+        self.path = path
+
+
+class CacheEntry:
+    """
+    A workbook resident in a WorkbookCache, with what the cache knows about it.
+    """
+
+    def __init__(self, workbook: Workbook, mtime: float, size: int) -> None:
+        """
+        Initializes an entry of a workbook that was just loaded or written.
+
+        :param workbook: The workbook.
+        :param mtime: The modification time of the file, when it was loaded or written.
+        :param size: The estimated size of the workbook, see estimate_workbook_size.
+        """
+        self.workbook = workbook
+        self.mtime = mtime
+        self.size = size
+        # The versions of the workbook when it was last loaded or written, and when its size was last estimated
+        self.saved_versions = workbook_versions(workbook)
+        self.sized_versions = self.saved_versions
+
+    def is_dirty(self) -> bool:
+        """
+        Checks whether the workbook changed since it was loaded or written.
+
+        :return: True if it changed, False otherwise.
+        """
+        return workbook_versions(self.workbook) != self.saved_versions
+
+
+class WorkbookCache:
+    """
+    Keeps recently used workbooks in memory, so serving the same file again does not load it again.
+
+    Workbooks are keyed by the path of their file and its modification time: a file that changed on disk
+    since it was loaded is loaded again, unless the workbook changed in memory too. The workbooks are evicted from the least recently used one whenever
+    their estimated size is over the memory budget, and a workbook that changed since it was loaded
+    is written back to its file before it is evicted.
+    The cache can be used from several threads.
+    """
+
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                 loader: Callable[[str], Workbook] = load_and_open_workbook) -> None:
+        """
+        Initializes an empty cache.
+
+        :param memory_budget: The estimated size the resident workbooks may take, in bytes.
+        The most recently used workbook stays resident even if it is larger.
+        :param loader: The function that loads a workbook from its path.
+        """
+        self.memory_budget = memory_budget
+        self.loader = loader
+        # The resident workbooks by absolute path, from the least recently used
+        self.entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+
+    def get(self, path: str) -> Workbook:
+        """
+        Retrieves the workbook of a file, loading it if it is not resident or if the file changed since it was loaded.
+        If the file of a resident workbook was deleted, the workbook is written back to it.
+
+        :param path: The path of the workbook's JSON file.
+        :return: The workbook.
+        :raises WorkbookConflictError: If the file changed on disk while the resident workbook has changes too.
+        Evict it with write_back=False to load the file, or call flush() to overwrite the file.
+        :raises FileNotFoundError: If the file does not exist and the workbook is not resident.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and not os.path.exists(path):
+                self.write_back(path, entry)
+            mtime = os.path.getmtime(path)
+            if entry is not None and entry.mtime != mtime and entry.is_dirty():
+                raise WorkbookConflictError(path)
+            if entry is not None and entry.mtime == mtime:
+                self.hits += 1
+                self.entries.move_to_end(path)
+                self.update_size(entry)
+            else:
+                self.misses += 1
+                workbook = self.loader(path)
+                entry = self.entries[path] = CacheEntry(workbook, mtime, estimate_workbook_size(workbook))
+                self.entries.move_to_end(path)
+            self.enforce_budget()
+            return entry.workbook
+
+    def __contains__(self, path: str) -> bool:
+        """
+        Checks whether the workbook of a file is resident.
+
+        :param path: The path of the workbook's JSON file.
+        :return: True if it is resident, False otherwise.
+        """
+        with self.lock:
+            return os.path.abspath(path) in self.entries
+
+    def is_dirty(self, path: str) -> bool:
+        """
+        Checks whether the resident workbook of a file changed since it was loaded or written.
+
+        :param path: The path of the workbook's JSON file.
+        :return: True if it changed, False if it did not or if it is not resident.
+        """
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(path))
+            return entry is not None and entry.is_dirty()
+
+    def update_size(self, entry: CacheEntry) -> None:
+        """
+        Estimates the size of a workbook again if it changed since its size was estimated.
+
+        :param entry: The entry of the workbook.
+        """
+        versions = workbook_versions(entry.workbook)
+        if versions != entry.sized_versions:
+            entry.size = estimate_workbook_size(entry.workbook)
+            entry.sized_versions = versions
+
+    def enforce_budget(self) -> None:
+        """
+        Evicts the least recently used workbooks until the resident size is within the memory budget.
+        """
+        with self.lock:
+            for entry in self.entries.values():
+                self.update_size(entry)
+            while len(self.entries) > 1 and self.resident_size() > self.memory_budget:
+                self.evict(next(iter(self.entries)))
+
+    def write_back(self, path: str, entry: CacheEntry) -> None:
+        """
+        Writes a workbook to its file. The file is written under a temporary name first and then replaced,
+        like AutoSaver.write_snapshot does.
+
+        :param path: The absolute path of the workbook's JSON file.
+        :param entry: The entry of the workbook.
+        """
+        versions = workbook_versions(entry.workbook)
+        workbook_dict = entry.workbook.to_json_dict()
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(workbook_dict, f)
+        os.replace(temp_path, path)
+        # The file is now the workbook itself, so the next get is a hit
+        entry.mtime = os.path.getmtime(path)
+        entry.saved_versions = versions
+        self.write_backs += 1
+
+    def evict(self, path: str, write_back: bool = True) -> bool:
+        """
+        Removes the workbook of a file from the cache, writing it back first if it changed.
+
+        :param path: The path of the workbook's JSON file.
+        :param write_back: If False, the changes of the workbook are discarded instead of written back.
+        :return: True if the workbook was resident, False otherwise.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return False
+            if write_back and entry.is_dirty():
+                self.write_back(path, entry)
+            del self.entries[path]
+            self.evictions += 1
+            return True
+
+    def flush(self) -> int:
+        """
+        Writes back every resident workbook that changed, keeping it resident.
+
+        :return: The number of workbooks that were written.
+        """
+        written = 0
+        with self.lock:
+            for path, entry in self.entries.items():
+                if entry.is_dirty():
+                    self.write_back(path, entry)
+                    written += 1
+        return written
+
+    def clear(self) -> None:
+        """
+        Evicts every workbook, writing back the ones that changed.
+        """
+        with self.lock:
+            for path in list(self.entries):
+                self.evict(path)
+
+    def resident_size(self) -> int:
+        """
+        Retrieves the estimated size of the resident workbooks, as of their last use.
+
+        :return: The size in bytes.
+        """
+        with self.lock:
+            return sum(entry.size for entry in self.entries.values())
+
+    def hit_rate(self) -> float:
+        """
+        Retrieves the fraction of the calls to get that found the workbook resident.
+
+        :return: The hit rate, 0 if get was never called.
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return self.hits / requests if requests else 0.0
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Retrieves the metrics of the cache.
+
+        :return: The hits, misses, hit rate, evictions and write backs,
+        and the number and estimated size of the resident workbooks with the memory budget.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate(),
+                    'evictions': self.evictions, 'write_backs': self.write_backs,
+                    'resident_workbooks': len(self.entries), 'resident_bytes': self.resident_size(),
+                    'memory_budget': self.memory_budget}
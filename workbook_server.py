@@ -0,0 +1,482 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+from urllib.parse import unquote
+from typing import *
+from workbook import *
+from autosave import AutoSaver
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# The largest request body the server reads, in bytes
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# The export formats, by the name used in requests, and the Workbook method of each one
+EXPORT_METHODS = {'json': 'export_to_json', 'csv': 'export_to_csv', 'excel': 'export_to_excel', 'pdf': 'export_to_pdf'}
+
+STATUS_TEXTS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class Request(NamedTuple):
+    """
+    An HTTP request, with its path split into parts.
+    """
+    method: str
+    parts: List[str]
+    headers: Dict[str, str]
+    body: bytes
+    keep_alive: bool
+
+
+class RequestError(Exception):
+    """
+    Raised by a handler when a request cannot be served. The message is sent back with the status.
+    """
+
+    def __init__(self, status: int, message: str) -> None:
+        """
+        Initializes the error.
+
+        :param status: The HTTP status of the response.
+        :param message: What went wrong.
+        """
+        super().__init__(message)
+        self.status = status
+
+
+class WorkbookServer:
+    """
+    Serves a workbook over HTTP with JSON bodies, on asyncio streams of the standard library.
+
+    Reads are answered directly by the connection that asked, so many connections are served at once.
+    Changes are queued and applied one at a time by a single writer task, in the order they arrived,
+    so a change never sees the workbook in the middle of another change.
+    Connections are kept alive between requests, like every HTTP/1.1 connection by default.
+
+    The requests are:
+      GET  /sheets                                - the names of the sheets
+      GET  /sheets/[sheet]/cells/[cell]           - the value and formula of a cell
+      PUT  /sheets/[sheet]/cells/[cell]           - sets a cell, with {"value": ...} or {"formula": ...}
+      GET  /sheets/[sheet]/ranges/[first:last]    - the values of a range, as rows, like {"values": [[1, 2]]}
+      PUT  /sheets/[sheet]/ranges/[first:last]    - sets a range from rows of values, texts that start with "="
+                                                    are formulas, like the set command of main.py
+      POST /recalculate                           - recalculates every dirty cell
+      POST /export                                - exports the workbook, with {"format": "csv", "name": "book"}
+    """
+
+    def __init__(self, workbook: Workbook, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 export_directory: str = ".") -> None:
+        """
+        Initializes a server. The server does not accept connections until start() is called.
+
+        :param workbook: The workbook to serve.
+        :param host: The address to listen on.
+        :param port: The port to listen on, 0 for any free port.
+        :param export_directory: The directory the exported files are written to.
+        """
+        self.workbook = workbook
+        self.host = host
+        self.port = port
+        self.export_directory = export_directory
+        # Exports are written from snapshots, so reads and changes go on while a file is written
+        self.snapshots = AutoSaver(workbook)
+        self.changes: Optional[asyncio.Queue] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.writer_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """
+        Starts listening and starts the writer task. If the port is 0, self.port is set to the chosen port.
+        """
+        self.changes = asyncio.Queue()
+        self.writer_task = asyncio.ensure_future(self.apply_changes())
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """
+        Stops listening and stops the writer task once the queued changes are applied.
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.writer_task is not None:
+            await self.changes.join()
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+
+    async def apply_changes(self) -> None:
+        """
+        The writer task: applies the queued changes one by one and hands every result to the request that waits.
+        """
+        while True:
+            change, future = await self.changes.get()
+            try:
+                result = change()
+                if not future.cancelled():
+                    future.set_result(result)
+            except Exception as err:
+                if not future.cancelled():
+                    future.set_exception(err)
+            finally:
+                self.changes.task_done()
+
+    async def change(self, change: Callable[[], Any]) -> Any:
+        """
+        Queues a change for the writer task and waits until it is applied.
+
+        :param change: A function without arguments that changes the workbook.
+        :return: The result of the function.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.changes.put((change, future))
+        return await future
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves the requests of a connection, one after the other, until the client closes it.
+
+        :param reader: The stream of the connection's requests.
+        :param writer: The stream of the connection's responses.
+        """
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except RequestError as err:
+                    await send_response(writer, err.status, {'error': str(err)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                status, body = await self.respond(request)
+                await send_response(writer, status, body, request.keep_alive)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, request: Request) -> Tuple[int, Any]:
+        """
+        Serves a request.
+
+        :param request: The request.
+        :return: The status and the JSON body of the response.
+        """
+        try:
+            return 200, await self.dispatch(request)
+        except RequestError as err:
+            return err.status, {'error': str(err)}
+        except Exception as err:
+            return 500, {'error': str(err)}
+
+    async def dispatch(self, request: Request) -> Any:
+        """
+        Finds the handler of a request and calls it.
+
+        :param request: The request.
+        :return: The JSON body of the response.
+        :raises RequestError: If there is no such request, or it is not valid.
+        """
+        method, parts = request.method, request.parts
+        if parts == ["sheets"] and method == "GET":
+            return {'sheets': self.workbook.list_sheets()}
+        if parts == ["recalculate"] and method == "POST":
+            await self.change(self.workbook.recalculate)
+            return {'recalculated': True}
+        if parts == ["export"] and method == "POST":
+            return await self.export(json_body(request))
+        if len(parts) == 4 and parts[0] == "sheets" and parts[2] in ["cells", "ranges"]:
+            spreadsheet = self.workbook.get_sheet(parts[1])
+            if spreadsheet is None:
+                raise RequestError(404, f"Sheet '{parts[1]}' does not exist.")
+            if parts[2] == "cells" and method == "GET":
+                return cell_body(spreadsheet, valid_cell_name(spreadsheet, parts[3]))
+            if parts[2] == "cells" and method == "PUT":
+                return await self.set_cell(spreadsheet, valid_cell_name(spreadsheet, parts[3]), json_body(request))
+            if parts[2] == "ranges" and method == "GET":
+                return {'range': parts[3], 'values': [[stored_value(spreadsheet.get_cell_value(cell_name))
+                                                       for cell_name in row]
+                                                      for row in range_rows(spreadsheet, parts[3])]}
+            if parts[2] == "ranges" and method == "PUT":
+                return await self.set_range(spreadsheet, parts[3], json_body(request))
+            raise RequestError(405, f"{method} is not supported for {parts[2]}.")
+        raise RequestError(404, f"Unknown request {method} /{'/'.join(parts)}.")
+
+    async def set_cell(self, spreadsheet: Spreadsheet, cell_name: str, body: Any) -> Dict[str, Any]:
+        """
+        Sets the value or the formula of a cell.
+
+        :param spreadsheet: The sheet of the cell.
+        :param cell_name: The name of the cell.
+        :param body: The request body, {"value": ...} or {"formula": ...}.
+        :return: The cell after the change, see cell_body.
+        :raises RequestError: If the body has neither a value nor a formula, or the formula is not valid.
+        """
+        if not isinstance(body, dict) or ('value' in body) == ('formula' in body):
+            raise RequestError(400, 'The body should have either a "value" or a "formula".')
+        value, formula = body.get('value'), body.get('formula')
+        if formula is not None:
+            formula = str(formula).lstrip("=")
+            check_formula(spreadsheet, cell_name, formula)
+
+        def change() -> None:
+            if formula is not None:
+                spreadsheet.set_cell(cell_name, formula=formula)
+            elif value is None:
+                spreadsheet.remove_cell(cell_name)
+            else:
+                spreadsheet.set_cell(cell_name, value)
+        await self.change(change)
+        return cell_body(spreadsheet, cell_name)
+
+    async def set_range(self, spreadsheet: Spreadsheet, range_text: str, body: Any) -> Dict[str, Any]:
+        """
+        Sets the cells of a range from rows of values, in one batch, see Spreadsheet.set_many.
+        Texts that start with "=" are set as formulas, and None leaves a cell unchanged.
+        If a formula is not valid, no cell is set.
+
+        :param spreadsheet: The sheet of the range.
+        :param range_text: The range, like "A1:C10".
+        :param body: The request body, {"values": [[...], ...]} with a list for every row of the range.
+        :return: The number of cells that were set.
+        :raises RequestError: If the rows do not have the size of the range, or a formula is not valid.
+        """
+        rows = range_rows(spreadsheet, range_text)
+        values = body.get('values') if isinstance(body, dict) else None
+        if not isinstance(values, list) or len(values) != len(rows) or \
+                any(not isinstance(row, list) or len(row) != len(rows[0]) for row in values):
+            raise RequestError(400, f'The body should have "values" with {len(rows)} rows of {len(rows[0])} values.')
+        items = []
+        for cell_names, row_values in zip(rows, values):
+            for cell_name, value in zip(cell_names, row_values):
+                if isinstance(value, str) and value.startswith("="):
+                    check_formula(spreadsheet, cell_name, value[1:])
+                    items.append((cell_name, None, value[1:]))
+                elif value is not None:
+                    items.append((cell_name, value, None))
+        await self.change(lambda: spreadsheet.set_many(items))
+        return {'set': len(items)}
+
+    async def export(self, body: Any) -> Dict[str, Any]:
+        """
+        Exports the workbook to the export directory.
+        A snapshot of the workbook is taken in turn with the other changes, and written on another thread
+        while the next changes are applied.
+
+        :param body: The request body, {"format": "json", "name": "book"}. The name is the workbook's by default.
+        :return: The format and the base name of the exported files.
+        :raises RequestError: If the format is unknown or the name is not a plain file name.
+        """
+        body = body if isinstance(body, dict) else {}
+        export_format = body.get('format', 'json')
+        name = body.get('name') or self.workbook.name
+        if export_format not in EXPORT_METHODS:
+            raise RequestError(400, f"Unknown format '{export_format}'. "
+                                    f"Available formats: {', '.join(EXPORT_METHODS.keys())}")
+        if not isinstance(name, str) or not name or os.path.basename(name) != name or name.startswith("."):
+            raise RequestError(400, "The name should be a plain file name, without a directory.")
+        path = os.path.join(self.export_directory, name)
+
+        # Only the snapshot is taken by the writer task, so the changes queued after it
+        # do not wait for the file to be written
+        _, snapshot = await self.change(lambda: self.snapshots.take_snapshot(force=True))
+        method = getattr(snapshot, EXPORT_METHODS[export_format])
+        await asyncio.get_running_loop().run_in_executor(None, method, path)
+        return {'format': export_format, 'name': name}
+
+
+def json_body(request: Request) -> Any:
+    """
+    Reads the JSON body of a request.
+
+    :param request: The request.
+    :return: The body, None if the request has no body.
+    :raises RequestError: If the body is not valid JSON.
+    """
+    if not request.body:
+        return None
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        raise RequestError(400, "The body is not valid JSON.")
+
+
+def valid_cell_name(spreadsheet: Spreadsheet, cell_name: str) -> str:
+    """
+    Checks the cell name of a request.
+
+    :param spreadsheet: The sheet of the cell.
+    :param cell_name: The name of the cell.
+    :return: The same name.
+    :raises RequestError: If the name is not valid.
+    """
+    if not spreadsheet.is_valid_cell_name(cell_name):
+        raise RequestError(400, f"Invalid cell name '{cell_name}'. Cell names must be in the format 'A1', 'B2', 'AZ10' etc.")
+    return cell_name
+
+
+def check_formula(spreadsheet: Spreadsheet, cell_name: str, formula: str) -> None:
+    """
+    Checks a formula before it is set, the same way Spreadsheet.set_cell_formula does.
+
+    :param spreadsheet: The sheet of the cell.
+    :param cell_name: The name of the cell.
+    :param formula: The formula, without the "=" sign.
+    :raises RequestError: If the formula is not valid or refers to its own cell.
+    """
+    try:
+        parse_formula(formula)
+    except FormulaSyntaxError as err:
+        raise RequestError(400, f"Invalid formula of {cell_name}: {str(err)}")
+    if cell_name in spreadsheet.formula_dependencies(formula) or \
+            cell_name in spreadsheet.formula_sheet_references(formula).get(spreadsheet.name, []):
+        raise RequestError(400, f"The formula of {cell_name} cannot depend on the cell itself.")
+
+
+def range_rows(spreadsheet: Spreadsheet, range_text: str) -> List[List[str]]:
+    """
+    Splits a range into the names of its cells, row by row.
+
+    :param spreadsheet: The sheet of the range.
+    :param range_text: The range, like "A1:C10".
+    :return: A list of the cell names of every row.
+    :raises RequestError: If the range is not valid.
+    """
+    start, _, end = range_text.partition(":")
+    valid_cell_name(spreadsheet, start)
+    valid_cell_name(spreadsheet, end or start)
+    start_col_index, first_row = spreadsheet.cell_coordinates(start)
+    end_col_index, last_row = spreadsheet.cell_coordinates(end or start)
+    if start_col_index > end_col_index or first_row > last_row:
+        raise RequestError(400, f"Invalid cells range '{range_text}'.")
+    col_letters = [spreadsheet.col_index_to_letter(col_index) for col_index in range(start_col_index, end_col_index + 1)]
+    return [[f"{col_letter}{row}" for col_letter in col_letters] for row in range(first_row, last_row + 1)]
+
+
+def cell_body(spreadsheet: Spreadsheet, cell_name: str) -> Dict[str, Any]:
+    """
+    Creates the response body of a cell.
+
+    :param spreadsheet: The sheet of the cell.
+    :param cell_name: The name of the cell.
+    :return: The name, the up-to-date value and the formula of the cell. Errors are given as their code.
+    """
+    cell = spreadsheet.get_cell(cell_name)
+    value = None if cell is None else spreadsheet.updated_value(cell_name, cell)
+    return {'cell': cell_name, 'value': stored_value(value), 'formula': None if cell is None else cell.formula}
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """
+    Reads an HTTP request from a connection.
+
+    :param reader: The stream of the connection.
+    :return: The request, or None if the client closed the connection.
+    :raises RequestError: If the request is not valid HTTP.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise RequestError(400, "Invalid request line.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise RequestError(400, "Invalid Content-Length.")
+    if length > MAX_BODY_SIZE:
+        raise RequestError(413, f"The body is larger than {MAX_BODY_SIZE} bytes.")
+    body = await reader.readexactly(length) if length else b""
+    connection = headers.get('connection', "").lower()
+    # HTTP/1.1 connections are kept alive unless the client asks otherwise, HTTP/1.0 ones only if it asks
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    path = target.split("?", 1)[0]
+    parts = [unquote(part) for part in path.strip("/").split("/") if part]
+    return Request(method.upper(), parts, headers, body, keep_alive)
+
+
+async def send_response(writer: asyncio.StreamWriter, status: int, body: Any, keep_alive: bool) -> None:
+    """
+    Sends an HTTP response with a JSON body.
+
+    :param writer: The stream of the connection.
+    :param status: The HTTP status.
+    :param body: The body, which is converted to JSON.
+    :param keep_alive: True to keep the connection open for the next request.
+    """
+    payload = json.dumps(body).encode()
+    head = (f"HTTP/1.1 {status} {STATUS_TEXTS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + payload)
+    await writer.drain()
+
+
+async def serve(workbook: Workbook, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                export_directory: str = ".") -> None:
+    """
+    Serves a workbook until the program is stopped.
+
+    :param workbook: The workbook to serve.
+    :param host: The address to listen on.
+    :param port: The port to listen on.
+    :param export_directory: The directory the exported files are written to.
+    """
+    server = WorkbookServer(workbook, host, port, export_directory)
+    await server.start()
+    print(f"Serving {workbook.name} on http://{host}:{server.port}")
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main(arguments: List[str]) -> None:
+    """
+    Serves a workbook from the command line, for example:
+        python workbook_server.py --open workbook.json --port 8080
+        python workbook_server.py --new workbook --sheet Sheet1
+
+    :param arguments: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Serves a workbook over HTTP with JSON bodies.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--open", metavar="FILE", help="a workbook JSON file to serve")
+    source.add_argument("--new", metavar="NAME", help="the name of a new workbook to serve")
+    parser.add_argument("--sheet", default="Sheet1", help="the sheet of a new workbook")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="the address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="the port to listen on")
+    parser.add_argument("--export-directory", default=".", help="the directory exported files are written to")
+    args = parser.parse_args(arguments)
+
+    if args.open:
+        workbook = load_and_open_workbook(args.open)
+    else:
+        workbook = Workbook(args.new)
+        workbook.attach_sheet(args.sheet, Spreadsheet(args.sheet))
+    try:
+        asyncio.run(serve(workbook, args.host, args.port, args.export_directory))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])